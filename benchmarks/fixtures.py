@@ -0,0 +1,285 @@
+'''
+Synthetic inputs for benchmarking the extractors without the real corpora.
+
+Each generator writes files in the layout of one corpus, filled with text
+sampled from a Zipf-distributed vocabulary of made-up words (plus digits,
+punctuation and the markup each extractor has to deal with), and returns a
+fixture description:
+  path          :: what to hand the extractor (directory, glob or file)
+  documents     :: number of documents written
+  raw_bytes     :: size of the files before compression
+  input_bytes   :: size of the files on disk
+
+Output is deterministic for a given seed.
+
+To generate all four fixtures by hand:
+    python -m benchmarks.fixtures OUTDIR --documents=N
+'''
+
+import bz2
+import gzip
+import io
+import json
+import os
+import random
+import tarfile
+from xml.sax.saxutils import escape
+
+DEFAULT_VOCAB_SIZE = 20000
+_LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+_PUNCTUATION = [',', ',', ',', ';', ':', '(', ')', '"', "'s", '-', '%']
+
+class TextSampler:
+    '''Samples words, sentences and paragraphs of synthetic English-like
+    text.
+    '''
+
+    def __init__(self, seed=0, vocab_size=DEFAULT_VOCAB_SIZE):
+        self.random = random.Random(seed)
+        words = set()
+        while len(words) < vocab_size:
+            length = min(2 + int(self.random.expovariate(0.3)), 14)
+            words.add(''.join(self.random.choice(_LETTERS) for _ in range(length)))
+        self.vocab = sorted(words, key=len)
+        # Zipf weights, as cumulative weights for random.choices
+        self._cum_weights = []
+        total = 0
+        for rank in range(1, len(self.vocab) + 1):
+            total += 1.0 / rank
+            self._cum_weights.append(total)
+
+    def words(self, n):
+        return self.random.choices(self.vocab, cum_weights=self._cum_weights, k=n)
+
+    def sentence(self, min_words=5, max_words=30):
+        words = self.words(self.random.randint(min_words, max_words))
+        words[0] = words[0].capitalize()
+        for i in range(1, len(words)):
+            r = self.random.random()
+            if r < 0.08:
+                words[i] = self.random.choice(_PUNCTUATION)
+            elif r < 0.11:
+                words[i] = str(self.random.randint(0, 5000))
+        return '%s.' % ' '.join(words)
+
+    def paragraph(self, min_sentences=1, max_sentences=6):
+        return ' '.join(self.sentence() for _ in range(self.random.randint(min_sentences, max_sentences)))
+
+def _fixture(path, documents, raw_bytes, files):
+    return {
+        'path': path,
+        'documents': documents,
+        'raw_bytes': raw_bytes,
+        'input_bytes': sum([os.path.getsize(f) for f in files]),
+    }
+
+def _splitCounts(n_documents, n_files):
+    n_files = max(1, min(n_files, n_documents))
+    return [n_documents // n_files + (1 if i < n_documents % n_files else 0) for i in range(n_files)]
+
+def writeMedline(outdir, n_documents, n_files=4, seed=0):
+    '''Writes MEDLINE baseline files (medline17n0001.xml.gz, ...) to outdir;
+    about 60% of citations have an abstract.
+    '''
+    sampler = TextSampler(seed=seed)
+    os.makedirs(outdir, exist_ok=True)
+    files, raw_bytes, pmid = [], 0, 1
+    for (i, n_citations) in enumerate(_splitCounts(n_documents, n_files)):
+        path = os.path.join(outdir, 'medline17n%04d.xml.gz' % (i + 1))
+        with gzip.open(path, 'wb', compresslevel=6) as stream:
+            chunks = ['<?xml version="1.0" encoding="utf-8"?>\n<PubmedArticleSet>\n']
+            for _ in range(n_citations):
+                chunks.append(
+                    '<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM">'
+                    '<PMID Version="1">%d</PMID><Article PubModel="Print">'
+                    '<ArticleTitle>%s</ArticleTitle>' % (pmid, escape(sampler.sentence(4, 15)))
+                )
+                if sampler.random.random() < 0.6:
+                    chunks.append('<Abstract>%s</Abstract>' % ''.join([
+                        '<AbstractText>%s</AbstractText>' % escape(sampler.paragraph(3, 10))
+                            for _ in range(sampler.random.randint(1, 3))
+                    ]))
+                chunks.append('</Article></MedlineCitation></PubmedArticle>\n')
+                pmid += 1
+            chunks.append('</PubmedArticleSet>\n')
+            data = ''.join(chunks).encode('utf-8')
+            stream.write(data)
+        raw_bytes += len(data)
+        files.append(path)
+    return _fixture(outdir, n_documents, raw_bytes, files)
+
+def writePMC(outdir, n_documents, n_files=4, seed=0):
+    '''Writes PMC Open Access text tarballs (articles.A-B.txt.tar.gz, ...)
+    to outdir, in the ==== Front/Body/Refs layout of the OA text files.
+    '''
+    sampler = TextSampler(seed=seed)
+    os.makedirs(outdir, exist_ok=True)
+    files, raw_bytes, pmcid = [], 0, 1
+    for (i, n_articles) in enumerate(_splitCounts(n_documents, n_files)):
+        path = os.path.join(outdir, 'articles.%s-%s.txt.tar.gz' % (chr(65 + 2*i % 26), chr(66 + 2*i % 26)))
+        with tarfile.open(path, 'w:gz') as tar:
+            for _ in range(n_articles):
+                data = '\n'.join(
+                    ['==== Front', sampler.sentence(4, 15), '==== Body']
+                    + [sampler.paragraph(2, 8) for _ in range(sampler.random.randint(5, 40))]
+                    + ['==== Refs', sampler.sentence(), '']
+                ).encode('utf-8')
+                member = tarfile.TarInfo('Journal_%d/PMC%d.txt' % (i, pmcid))
+                member.size = len(data)
+                tar.addfile(member, io.BytesIO(data))
+                raw_bytes += len(data)
+                pmcid += 1
+        files.append(path)
+    return _fixture(os.path.join(outdir, 'articles.*.txt.tar.gz'), n_documents, raw_bytes, files)
+
+_GIGAWORD_DIRS = ['afp_eng', 'apw_eng', 'cna_eng', 'ltw_eng', 'nyt_eng', 'wpb_eng', 'xin_eng']
+
+def writeGigaword(outdir, n_documents, n_files=7, seed=0):
+    '''Writes Gigaword <DOC> files to the standard subdirectories of outdir
+    (afp_eng/afp_eng_200101.gz, ...), spread over the agencies in turn.
+    '''
+    sampler = TextSampler(seed=seed)
+    for datadir in _GIGAWORD_DIRS:
+        os.makedirs(os.path.join(outdir, datadir), exist_ok=True)
+    files, raw_bytes = [], 0
+    for (i, n_docs) in enumerate(_splitCounts(n_documents, n_files)):
+        datadir = _GIGAWORD_DIRS[i % len(_GIGAWORD_DIRS)]
+        months = i // len(_GIGAWORD_DIRS)
+        date = '%04d%02d' % (2001 + months // 12, months % 12 + 1)
+        path = os.path.join(outdir, datadir, '%s_%s.gz' % (datadir, date))
+        chunks = []
+        for j in range(n_docs):
+            doc_type = 'story' if sampler.random.random() < 0.9 else 'multi'
+            chunks.append('<DOC id="%s_%s.%04d" type="%s" >\n<HEADLINE>\n%s\n</HEADLINE>\n<TEXT>\n' % (
+                datadir.upper(), date, j + 1, doc_type, escape(sampler.sentence(3, 10))))
+            for _ in range(sampler.random.randint(2, 12)):
+                chunks.append('<P>\n%s\n</P>\n' % escape(sampler.paragraph(1, 4)))
+            chunks.append('</TEXT>\n</DOC>\n')
+        data = ''.join(chunks).encode('utf-8')
+        with gzip.open(path, 'wb', compresslevel=6) as stream:
+            stream.write(data)
+        raw_bytes += len(data)
+        files.append(path)
+    return _fixture(outdir, n_documents, raw_bytes, files)
+
+_WIKI_MARKUP = [
+    "[[%s]]", "[[%s|link text]]", "'''%s'''", "''%s''", '{{cite web|title=%s}}',
+    '<ref name="r">%s</ref>', '[http://example.org/%s external]', '[[Category:%s]]',
+]
+
+def _wikiText(sampler):
+    paragraphs = []
+    for _ in range(sampler.random.randint(2, 15)):
+        words = sampler.paragraph(1, 5).split(' ')
+        for _ in range(len(words) // 10):
+            i = sampler.random.randrange(len(words))
+            words[i] = sampler.random.choice(_WIKI_MARKUP) % words[i]
+        paragraphs.append(' '.join(words))
+        if sampler.random.random() < 0.2:
+            paragraphs.append('== %s ==' % sampler.sentence(1, 4))
+    return '\n\n'.join(paragraphs)
+
+def writeWikipedia(outdir, n_documents, pages_per_stream=100, seed=0):
+    '''Writes a MediaWiki pages-articles dump of n_documents articles (plus
+    about 20% redirects and non-article pages) to outdir, both as plain XML
+    (pages-articles.xml) and as a multistream .bz2 dump with its offset
+    index (pages-articles-multistream.xml.bz2 and
+    pages-articles-multistream-index.txt.bz2).
+
+    The fixture path is the plain XML dump; the multistream dump and index
+    are returned as multistream_path and index_path.
+    '''
+    sampler = TextSampler(seed=seed)
+    os.makedirs(outdir, exist_ok=True)
+    header = (
+        '<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" version="0.10" xml:lang="en">\n'
+        '  <siteinfo>\n    <sitename>Wikipedia</sitename>\n  </siteinfo>\n'
+    )
+    footer = '</mediawiki>\n'
+    pages, n_articles, page_id = [], 0, 1
+    while n_articles < n_documents:
+        r = sampler.random.random()
+        if r < 0.1:
+            (ns, text, redirect) = (0, '#REDIRECT [[%s]]' % sampler.sentence(1, 3), True)
+        elif r < 0.2:
+            (ns, text, redirect) = (sampler.random.choice([1, 4, 10, 14]), _wikiText(sampler), False)
+        else:
+            (ns, text, redirect) = (0, _wikiText(sampler), False)
+            n_articles += 1
+        pages.append((page_id,
+            '  <page>\n    <title>%s</title>\n    <ns>%d</ns>\n    <id>%d</id>\n%s'
+            '    <revision>\n      <id>%d</id>\n      <text xml:space="preserve">%s</text>\n'
+            '    </revision>\n  </page>\n' % (
+                escape(sampler.sentence(1, 4)), ns, page_id,
+                '    <redirect title="Target" />\n' if redirect else '',
+                page_id + 1000000, escape(text)
+            )
+        ))
+        page_id += 1
+
+    xml_path = os.path.join(outdir, 'pages-articles.xml')
+    with open(xml_path, 'w', encoding='utf-8') as stream:
+        stream.write(header)
+        for (_, page) in pages:
+            stream.write(page)
+        stream.write(footer)
+
+    multistream_path = os.path.join(outdir, 'pages-articles-multistream.xml.bz2')
+    index_path = os.path.join(outdir, 'pages-articles-multistream-index.txt.bz2')
+    index = []
+    with open(multistream_path, 'wb') as stream:
+        stream.write(bz2.compress(header.encode('utf-8')))
+        for i in range(0, len(pages), pages_per_stream):
+            offset = stream.tell()
+            for (page_id, _) in pages[i:i+pages_per_stream]:
+                index.append('%d:%d:Page %d\n' % (offset, page_id, page_id))
+            stream.write(bz2.compress(''.join([page for (_, page) in pages[i:i+pages_per_stream]]).encode('utf-8')))
+        stream.write(bz2.compress(footer.encode('utf-8')))
+    with bz2.open(index_path, 'wt', encoding='utf-8') as stream:
+        stream.write(''.join(index))
+
+    fixture = _fixture(xml_path, n_articles, os.path.getsize(xml_path), [xml_path])
+    fixture['multistream_path'] = multistream_path
+    fixture['index_path'] = index_path
+    return fixture
+
+GENERATORS = {
+    'pubmed': writeMedline,
+    'pmc': writePMC,
+    'gigaword': writeGigaword,
+    'wikipedia': writeWikipedia,
+}
+
+def writeAll(outdir, n_documents, corpora=None, seed=0):
+    '''Writes a fixture of n_documents documents for each corpus in corpora
+    (default: all of GENERATORS) to outdir/<corpus>, and returns a dict of
+    fixture descriptions by corpus.
+    '''
+    if corpora is None: corpora = sorted(GENERATORS.keys())
+    return dict([
+        (corpus, GENERATORS[corpus](os.path.join(outdir, corpus), n_documents, seed=seed))
+            for corpus in corpora
+    ])
+
+if __name__ == '__main__':
+    def _cli():
+        import optparse
+        parser = optparse.OptionParser(usage='Usage: %prog OUTDIR',
+                description='Writes synthetic PubMed, PMC, Gigaword and Wikipedia inputs to OUTDIR')
+        parser.add_option('--documents', dest='documents',
+                type='int', default=10000,
+                help='number of documents to write for each corpus (default: %default)')
+        parser.add_option('--corpora', dest='corpora',
+                default=','.join(sorted(GENERATORS.keys())),
+                help='comma-separated list of corpora to write fixtures for (default: %default)')
+        parser.add_option('--seed', dest='seed',
+                type='int', default=0,
+                help='random seed (default: %default)')
+        (options, args) = parser.parse_args()
+        if len(args) != 1:
+            parser.print_help()
+            exit()
+        return args, options
+    (outdir,), options = _cli()
+    fixtures = writeAll(outdir, options.documents, corpora=options.corpora.split(','), seed=options.seed)
+    print(json.dumps(fixtures, indent=2))
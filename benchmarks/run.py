@@ -0,0 +1,290 @@
+'''
+Benchmarks the PubMed, PMC, Gigaword and Wikipedia extractors on synthetic
+fixtures (see benchmarks.fixtures), and saves the results as JSON so runs
+can be compared for regressions.
+
+Each benchmark runs in its own process and reports wall-clock time,
+documents/s, MB/s (of uncompressed input) and peak RSS (of the largest
+single process in the benchmark, in MB).  Gigaword is tokenized with the
+regex backend by default, or with the corenlp backend against a pool of
+stand-in servers (see benchmarks.standin and utils.corenlp.ServerPool) with
+--tokenizer=corenlp.
+
+Run from the repository root:
+    python -m benchmarks.run --output=results.json [--compare=previous.json]
+'''
+
+import json
+import os
+import platform
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import multiprocessing as mp
+from drgriffis.common import log
+from . import fixtures
+
+BENCHMARKS = ('pubmed', 'pmc', 'gigaword', 'wikipedia', 'wikipedia-multistream')
+_CORPORA = {
+    'pubmed': 'pubmed',
+    'pmc': 'pmc',
+    'gigaword': 'gigaword',
+    'wikipedia': 'wikipedia',
+    'wikipedia-multistream': 'wikipedia',
+}
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _runScript(directory, args):
+    '''Runs an extractor script from its own directory, as the makefiles do,
+    with the repository root on the Python path.
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([_ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    subprocess.run([sys.executable] + args, cwd=os.path.join(_ROOT, directory), env=env,
+        stdout=sys.stdout, stderr=subprocess.STDOUT, check=True)
+
+def _benchPubmed(fixture, outf, settings):
+    from pubmed import parser
+    parser.generateCorpus(fixture['path'], outf, gz_threads=settings['workers'])
+
+def _benchPMC(fixture, outf, settings):
+    import glob
+    from pmc import plaintext
+    from utils import outputsink
+    with outputsink.openOutput(outf) as stream:
+        for tarf in sorted(glob.glob(fixture['path'])):
+            plaintext.extractArticleTexts(tarf, stream)
+
+def _benchGigaword(fixture, outf, settings):
+    args = ['plaintext.py', '--output=%s' % outf, '--threads=%d' % settings['workers'],
+        '--tokenizer=%s' % settings['tokenizer'], '--split-sentences']
+    if settings['tokenizer'] == 'corenlp':
+        args.extend(['--corenlp-pool=%s' % settings['corenlp_pool'],
+            '--annotation-batch-size=%d' % settings['annotation_batch_size'],
+            '--requests-in-flight=%d' % settings['requests_in_flight']])
+    _runScript('gigaword', args + [fixture['path']])
+
+def _benchWikipedia(fixture, outf, settings):
+    _runScript('wikipedia', ['-m', 'extract_articles', fixture['path'], outf,
+        '--format=text', '--workers=%d' % settings['workers']])
+
+def _benchWikipediaMultistream(fixture, outf, settings):
+    _runScript('wikipedia', ['-m', 'extract_articles', fixture['multistream_path'], outf,
+        '--index=%s' % fixture['index_path'], '--format=text', '--workers=%d' % settings['workers']])
+
+_FUNCTIONS = {
+    'pubmed': _benchPubmed,
+    'pmc': _benchPMC,
+    'gigaword': _benchGigaword,
+    'wikipedia': _benchWikipedia,
+    'wikipedia-multistream': _benchWikipediaMultistream,
+}
+
+def _t_measure(name, fixture, outf, settings, logf, result_q):
+    # keep extractor progress output out of the report
+    with open(logf, 'a') as stream:
+        sys.stdout.flush()
+        os.dup2(stream.fileno(), 1)
+        os.dup2(stream.fileno(), 2)
+    start = time.time()
+    _FUNCTIONS[name](fixture, outf, settings)
+    seconds = time.time() - start
+    # ru_maxrss is in kB on Linux; children are only counted once waited for
+    peak_kb = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    sys.stdout.flush()
+    result_q.put((seconds, peak_kb))
+
+def measure(name, fixture, workdir, settings):
+    '''Runs benchmark name on fixture in a new process, and returns its
+    results as a dict.
+    '''
+    outf = os.path.join(workdir, '%s.out' % name)
+    logf = os.path.join(workdir, '%s.log' % name)
+    result_q = mp.Queue()
+    process = mp.Process(target=_t_measure, args=(name, fixture, outf, settings, logf, result_q))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError('Benchmark %s failed (see %s)' % (name, logf))
+    (seconds, peak_kb) = result_q.get()
+    raw_mb = fixture['raw_bytes'] / 1024**2
+    return {
+        'benchmark': name,
+        'seconds': seconds,
+        'documents': fixture['documents'],
+        'raw_mb': raw_mb,
+        'input_mb': fixture['input_bytes'] / 1024**2,
+        'docs_per_second': fixture['documents'] / seconds,
+        'mb_per_second': raw_mb / seconds,
+        'peak_rss_mb': peak_kb / 1024,
+    }
+
+def loadFixtures(fixture_dir, n_documents, seed=0):
+    '''Returns fixtures of n_documents documents per corpus in fixture_dir,
+    generating them unless fixture_dir already holds a matching set.
+    '''
+    descriptionf = os.path.join(fixture_dir, 'fixtures.json')
+    if os.path.isfile(descriptionf):
+        with open(descriptionf, 'r') as stream:
+            description = json.load(stream)
+        if description['documents'] == n_documents and description['seed'] == seed:
+            return description['fixtures']
+    log.writeln('Generating fixtures of %d documents in %s...' % (n_documents, fixture_dir))
+    generated = fixtures.writeAll(fixture_dir, n_documents, seed=seed)
+    with open(descriptionf, 'w') as stream:
+        json.dump({'documents': n_documents, 'seed': seed, 'fixtures': generated}, stream, indent=2)
+    return generated
+
+def runBenchmarks(names, fixture_set, workdir, settings, repeat=1):
+    '''Runs each benchmark in names repeat times, and returns the list of
+    result dicts (from the fastest run of each).
+    '''
+    server_pool = None
+    if 'gigaword' in names and settings['tokenizer'] == 'corenlp':
+        from utils import corenlp
+        command = '%s %s --port={port} --latency=%f' % (shlex.quote(sys.executable),
+            shlex.quote(os.path.join(_ROOT, 'benchmarks', 'standin.py')), settings['latency'])
+        server_pool = corenlp.ServerPool(n_servers=settings['workers'], command=command).start()
+        settings = dict(settings, corenlp_pool=os.path.join(workdir, 'corenlp-pool.json'))
+        server_pool.save(settings['corenlp_pool'])
+    try:
+        results = []
+        for name in names:
+            runs = [measure(name, fixture_set[_CORPORA[name]], workdir, settings) for _ in range(repeat)]
+            best = min(runs, key=lambda run: run['seconds'])
+            results.append(best)
+            log.writeln('  %-22s %8.2fs %10.1f docs/s %8.2f MB/s %8.1f MB peak RSS' % (
+                name, best['seconds'], best['docs_per_second'], best['mb_per_second'], best['peak_rss_mb']))
+    finally:
+        if not server_pool is None: server_pool.close()
+    return results
+
+def compareResults(previous, current, tolerance=0.1):
+    '''Compares current results to previous ones (both as saved by this
+    module), logging the change in throughput for each benchmark in both.
+    Returns the names of benchmarks whose docs/s dropped by more than
+    tolerance (as a fraction).
+    '''
+    previous_results = dict([(result['benchmark'], result) for result in previous['results']])
+    regressions = []
+    log.writeln('Compared to %s:' % previous.get('created', 'previous run'))
+    for result in current['results']:
+        if not result['benchmark'] in previous_results: continue
+        before = previous_results[result['benchmark']]
+        change = result['docs_per_second'] / before['docs_per_second'] - 1
+        rss_change = result['peak_rss_mb'] / max(before['peak_rss_mb'], 1e-9) - 1
+        flag = ''
+        if change < -tolerance:
+            regressions.append(result['benchmark'])
+            flag = '  << REGRESSION'
+        log.writeln('  %-22s docs/s %+7.1f%%  peak RSS %+7.1f%%%s' % (
+            result['benchmark'], 100 * change, 100 * rss_change, flag))
+    return regressions
+
+if __name__ == '__main__':
+    def _cli():
+        import optparse
+        parser = optparse.OptionParser(usage='Usage: %prog --output=JSON',
+                description='Benchmarks the corpus extractors on synthetic fixtures')
+        parser.add_option('--output', dest='output',
+                help='JSON file to write results to (REQUIRED)')
+        parser.add_option('--compare', dest='compare',
+                help='JSON results of an earlier run to compare against')
+        parser.add_option('--tolerance', dest='tolerance',
+                type='float', default=0.1,
+                help='with --compare, fractional drop in docs/s to report as a'
+                     ' regression (exits with status 1) (default: %default)')
+        parser.add_option('--benchmarks', dest='benchmarks',
+                default=','.join(BENCHMARKS),
+                help='comma-separated list of benchmarks to run (default: %default)')
+        parser.add_option('--documents', dest='documents',
+                type='int', default=10000,
+                help='number of documents in each fixture (default: %default)')
+        parser.add_option('--seed', dest='seed',
+                type='int', default=0,
+                help='random seed for fixture generation (default: %default)')
+        parser.add_option('--fixtures', dest='fixture_dir',
+                help='directory to generate fixtures in, or reuse them from if'
+                     ' already generated with the same settings (default: a'
+                     ' temporary directory)')
+        parser.add_option('--workdir', dest='workdir',
+                help='directory to write extractor output and logs to (default: a'
+                     ' temporary directory, deleted when done)')
+        parser.add_option('--repeat', dest='repeat',
+                type='int', default=1,
+                help='number of times to run each benchmark, keeping the fastest'
+                     ' (default: %default)')
+        parser.add_option('--workers', dest='workers',
+                type='int', default=2,
+                help='number of worker processes/threads for each extractor (default: %default)')
+        parser.add_option('--tokenizer', dest='tokenizer',
+                type='choice', choices=('regex', 'corenlp'), default='regex',
+                help='Gigaword tokenization backend; "corenlp" runs against stand-in'
+                     ' servers (requires corenlp-protobuf) (default: %default)')
+        parser.add_option('--latency', dest='latency',
+                type='float', default=0,
+                help='with --tokenizer=corenlp, seconds the stand-in servers wait'
+                     ' before answering each request (default: %default)')
+        parser.add_option('--annotation-batch-size', dest='annotation_batch_size',
+                type='int', default=1,
+                help='with --tokenizer=corenlp, paragraphs per annotation request (default: %default)')
+        parser.add_option('--requests-in-flight', dest='requests_in_flight',
+                type='int', default=1,
+                help='with --tokenizer=corenlp, annotation requests in flight per thread'
+                     ' (default: %default)')
+        (options, args) = parser.parse_args()
+        if options.output is None:
+            parser.print_help()
+            exit()
+        options.benchmarks = options.benchmarks.split(',')
+        for name in options.benchmarks:
+            if not name in BENCHMARKS:
+                parser.error('unknown benchmark "%s"' % name)
+        return options
+    options = _cli()
+
+    settings = {
+        'workers': options.workers,
+        'tokenizer': options.tokenizer,
+        'latency': options.latency,
+        'annotation_batch_size': options.annotation_batch_size,
+        'requests_in_flight': options.requests_in_flight,
+    }
+    fixture_dir = options.fixture_dir or tempfile.mkdtemp(prefix='benchmark-fixtures-')
+    workdir = options.workdir or tempfile.mkdtemp(prefix='benchmark-work-')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        fixture_set = loadFixtures(fixture_dir, options.documents, seed=options.seed)
+        log.writeln('Running %d benchmarks (%d documents per fixture)' % (len(options.benchmarks), options.documents))
+        results = runBenchmarks(options.benchmarks, fixture_set, workdir, settings, repeat=options.repeat)
+    finally:
+        if options.fixture_dir is None: shutil.rmtree(fixture_dir)
+        if options.workdir is None: shutil.rmtree(workdir)
+
+    report = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'documents': options.documents,
+        'seed': options.seed,
+        'settings': settings,
+        'results': results,
+    }
+    with open(options.output, 'w') as stream:
+        json.dump(report, stream, indent=2)
+    log.writeln('Results written to %s' % options.output)
+
+    if options.compare:
+        with open(options.compare, 'r') as stream:
+            previous = json.load(stream)
+        if len(compareResults(previous, report, tolerance=options.tolerance)) > 0:
+            sys.exit(1)
@@ -0,0 +1,126 @@
+'''
+Stand-in for the CoreNLP server, for benchmarking the corenlp tokenizer
+backend (batching, requests in flight, one server per thread) without a
+JVM.
+
+Answers the same HTTP requests as StanfordCoreNLPServer does for the
+python-stanford-corenlp client: GET /ping, and POST / with the text to
+annotate, answered with a length-delimited protobuf Document holding the
+tokenize and ssplit annotations.  Tokens are simply runs of word characters
+or single punctuation characters, and sentences end at ., ! or ? or a blank
+line; the point is to reproduce the request/response cost, not CoreNLP's
+output.  latency adds a fixed delay to each request.
+
+Requires the corenlp-protobuf package (installed with stanford-corenlp).
+
+To run stand-in servers on ports 9000, 9001, ... by hand:
+    python -m benchmarks.standin --servers=N
+'''
+
+import itertools
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+try:
+    import corenlp_protobuf
+except ImportError:
+    corenlp_protobuf = None
+
+_SENTENCE = re.compile(r'\S(?:(?!\n\s*\n).)*?(?:[.!?](?=\s|$)|(?=\n\s*\n)|$)', re.S)
+_TOKEN = re.compile(r'\w+|[^\w\s]')
+
+def _varint(n):
+    out = bytearray()
+    while True:
+        bits = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+def _utf16Offsets(text):
+    # CoreNLP character offsets count Java (UTF-16) chars
+    if text.isascii(): return None
+    return list(itertools.accumulate([2 if ord(c) > 0xffff else 1 for c in text], initial=0))
+
+def annotate(text):
+    '''Returns the serialized (length-delimited) protobuf Document for text.'''
+    offsets = _utf16Offsets(text)
+    convert = (lambda i: i) if offsets is None else (lambda i: offsets[i])
+    doc = corenlp_protobuf.Document()
+    doc.text = text
+    n_tokens = 0
+    for sentence_match in _SENTENCE.finditer(text):
+        sentence = doc.sentence.add()
+        sentence.tokenOffsetBegin = n_tokens
+        for token_match in _TOKEN.finditer(text, sentence_match.start(), sentence_match.end()):
+            token = sentence.token.add()
+            token.word = token.originalText = token_match.group()
+            token.beginChar = convert(token_match.start())
+            token.endChar = convert(token_match.end())
+            n_tokens += 1
+        sentence.tokenOffsetEnd = n_tokens
+    data = doc.SerializeToString()
+    return _varint(len(data)) + data
+
+def _handler(latency):
+    class _StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def _respond(self, body, content_type):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self._respond(b'pong\n', 'text/plain')
+
+        def do_POST(self):
+            text = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+            if latency > 0: time.sleep(latency)
+            self._respond(annotate(text), 'application/x-protobuf')
+
+        def log_message(self, *args):
+            pass
+    return _StandInHandler
+
+def serve(start_port=9000, n_servers=1, latency=0):
+    '''Runs n_servers stand-in servers, on ports start_port, start_port+1,
+    ..., until the process is killed.
+    '''
+    if corenlp_protobuf is None:
+        raise ImportError('The CoreNLP stand-in requires the corenlp-protobuf package')
+    servers = [
+        ThreadingHTTPServer(('localhost', start_port + i), _handler(latency))
+            for i in range(n_servers)
+    ]
+    threads = [threading.Thread(target=server.serve_forever, daemon=True) for server in servers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+if __name__ == '__main__':
+    def _cli():
+        import optparse
+        parser = optparse.OptionParser(usage='Usage: %prog',
+                description='Runs stand-in CoreNLP servers for benchmarking')
+        parser.add_option('--port', dest='port',
+                type='int', default=9000,
+                help='port of the first server (default: %default)')
+        parser.add_option('--servers', dest='servers',
+                type='int', default=1,
+                help='number of servers, on consecutive ports (default: %default)')
+        parser.add_option('--latency', dest='latency',
+                type='float', default=0,
+                help='seconds to wait before answering each request (default: %default)')
+        (options, args) = parser.parse_args()
+        return options
+    options = _cli()
+    serve(start_port=options.port, n_servers=options.servers, latency=options.latency)
@@ -6,11 +6,23 @@ Creates a single plaintext file containing English Gigaword.
 
 import glob
 import gzip
-import codecs
+import collections
+import functools
 import os
+import re
+import threading
 import multiprocessing as mp
 from bs4 import BeautifulSoup
 from utils import corenlp
+from utils import batchqueue
+from utils import tokencache
+from utils import outputsink
+from utils import corpusstats
+from utils import metrics
+from utils import profiling
+from utils import gzindex
+from utils import docindex
+from utils import dedup
 import configlogger
 from drgriffis.common import log
 
@@ -24,22 +36,115 @@ datadirs = [
     'xin_eng'
 ]
 
+ENGINES = ('fast', 'soup')
+
 class _SIGNALS:
     HALT = -1
     FILE_COMPLETE = 0
     DOC_COMPLETE = 1
     DOC_SKIPPED = 2
 
-def listAllFiles(gigaword_dir, skip_dirs, skip_files):
+Document = collections.namedtuple('Document', ['id', 'type', 'attributes', 'paragraphs'])
+# uncompressed bytes start to end of a GZip file; last if it ends the file
+FileRange = collections.namedtuple('FileRange', ['path', 'start', 'end', 'last'])
+
+_READ_BLOCK_SIZE = 4 * 1024 * 1024
+_DOC_ATTRIBUTE = re.compile(rb'([A-Za-z_]+)="([^"]*)"')
+_TAG = re.compile(r'<[^>]*>')
+_ENTITY = re.compile(r'&(#[0-9]+|#x[0-9a-fA-F]+|[A-Za-z][A-Za-z0-9]*);')
+_XML_ENTITIES = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+_XML_SPACES = ' \t\n\r\x0c'
+_DOC_MARKER = b'<DOC '
+_DOC_ID = rb'id="([^"]+)"'
+# NYT_ENG_19940701.0001 => 19940701; nyt_eng_199407.gz => 199407
+_DOC_DATE = re.compile(r'_([0-9]+)\.')
+_FILE_DATE = re.compile(r'_([0-9]+)\.gz$')
+
+def parseSkipList(items):
+    '''Splits --skip-files items into a set of file names (ending in .gz)
+    and a set of document IDs and dates (YYYY, YYYYMM or YYYYMMDD) to skip.
+    '''
+    skip_files, skip_docs = set(), set()
+    for item in items:
+        if item.endswith('.gz'): skip_files.add(item)
+        else: skip_docs.add(item)
+    return skip_files, skip_docs
+
+def _skipsDate(date, skip_docs):
+    return any([date[:n] in skip_docs for n in (4, 6, 8) if len(date) >= n])
+
+def isSkippedDocument(doc_id, skip_docs):
+    '''Returns True if document doc_id, or its date, is in skip_docs (see
+    parseSkipList).
+    '''
+    if doc_id is None or len(skip_docs) == 0: return False
+    if doc_id in skip_docs: return True
+    match = _DOC_DATE.search(doc_id)
+    return (not match is None) and _skipsDate(match.group(1), skip_docs)
+
+def listAllFiles(gigaword_dir, skip_dirs, skip_files, skip_docs=frozenset()):
+    '''Lists the GZip files in gigaword_dir, leaving out skip_dirs, file
+    names in skip_files, and monthly files whose every document is skipped
+    by date in skip_docs.
+    '''
     all_files = []
     for datadir in datadirs:
         if datadir in skip_dirs: continue
         files = os.listdir(os.path.join(gigaword_dir, datadir))
         for fname in files:
-            if fname in skip_files: continue
+            # skip anything else kept alongside, e.g. document indexes
+            if not fname.endswith('.gz') or fname in skip_files: continue
+            match = _FILE_DATE.search(fname)
+            if match and len(match.group(1)) <= 6 and _skipsDate(match.group(1), skip_docs): continue
             all_files.append(os.path.join(gigaword_dir, datadir, fname))
     return all_files
 
+def _indexFile(args):
+    (gzn, index_dir) = args
+    return gzindex.loadOrBuild(gzn, _DOC_MARKER, key_pattern=_DOC_ID, index_dir=index_dir)
+
+def splitFiles(gzns, range_size, index_dir=None, workers=1):
+    '''Returns gzns with each file over range_size uncompressed bytes
+    replaced by FileRanges of about range_size bytes, starting at document
+    boundaries.
+
+    Uses each file's document index (see utils.gzindex), stored in
+    index_dir (default: next to the file); indexes are built (with workers
+    processes) for files that have none or have changed since, and reused
+    otherwise.
+    '''
+    if not index_dir is None:
+        os.makedirs(index_dir, exist_ok=True)
+    args = [(gzn, index_dir) for gzn in gzns]
+    if workers > 1:
+        pool = mp.Pool(workers)
+        indexes = pool.map(_indexFile, args)
+        pool.close()
+        pool.join()
+    else:
+        indexes = [_indexFile(arg) for arg in args]
+
+    items = []
+    for (gzn, index) in zip(gzns, indexes):
+        ranges = index.ranges(range_size)
+        if len(ranges) <= 1:
+            items.append(gzn)
+        else:
+            items.extend([
+                FileRange(gzn, start, end, i == len(ranges) - 1)
+                    for (i, (start, end)) in enumerate(ranges)
+            ])
+    return items
+
+def orderBySize(gzfs):
+    '''Returns gzfs ordered from largest to smallest file, so that readers
+    pulling from a shared queue start on the longest files first and finish
+    at about the same time.  FileRanges are ordered by the size of their
+    file, keeping the ranges of each file in order.
+    '''
+    return sorted(gzfs, key=lambda gzf: os.path.getsize(gzf.path if isinstance(gzf, FileRange) else gzf),
+        reverse=True)
+
 def getNextDocument(hook, delay_decode_errors=False):
     '''Returns the next chunk of text between <DOC>...</DOC> tags.
 
@@ -74,59 +179,382 @@ def getNextDocument(hook, delay_decode_errors=False):
 
     return '\n'.join(lns)
 
-def extractFromGZipFiles(gzns, input_q, output_q, split_sentences=False, ignore_decode_errors=False):
+def _iterRawDocuments(hook, block_size=_READ_BLOCK_SIZE):
+    '''Yields (<DOC> line, document body) byte strings for each document in
+    binary stream hook, reading it in large blocks.
+
+    The body is every line between the <DOC> line and the </DOC> line.
+    '''
+    buf, pos, eof = b'', 0, False
+    while True:
+        end = buf.find(b'\n</DOC', pos)
+        line_end = -1 if end < 0 else buf.find(b'\n', end + 1)
+        if line_end < 0:
+            if not eof:
+                block = hook.read(block_size)
+                if len(block) == 0: eof = True
+                buf, pos = buf[pos:] + block, 0
+                continue
+            elif pos >= len(buf):
+                return
+            elif end < 0:
+                raise Exception('Expected end of a document!')
+            else:
+                line_end = len(buf)
+        if buf[pos:pos+4] != b'<DOC': raise Exception('Expected start of a document!')
+        header_end = buf.find(b'\n', pos) + 1
+        yield buf[pos:header_end], buf[header_end:end+1]
+        pos = line_end + 1
+
+def _resolveEntity(match):
+    name = match.group(1)
+    if name[0] != '#':
+        return _XML_ENTITIES.get(name, '')
+    try:
+        return chr(int(name[2:], 16) if name[1] == 'x' else int(name[1:]))
+    except (ValueError, OverflowError):
+        return ''
+
+def _textNode(string):
+    string = _ENTITY.sub(_resolveEntity, string) if '&' in string else string
+    # BeautifulSoup collapses whitespace-only strings to a newline or space
+    if string.strip(_XML_SPACES) == '':
+        return '\n' if '\n' in string else ' '
+    return string
+
+def documentText(doc):
+    '''Returns the text content of a document (as returned by
+    getNextDocument), as BeautifulSoup's get_text() would, without building
+    a parse tree.
+
+    Matches BeautifulSoup on well-formed documents; in malformed ones,
+    unknown entities are dropped and stray ampersands are kept.
+    '''
+    doc = doc.replace('\r\n', '\n').replace('\r', '\n')
+    return ''.join([
+        _textNode(string)
+            for string in _TAG.split(doc)
+                if len(string) > 0
+    ])
+
+def _paragraphs(text):
+    return [
+        p.replace('\n', ' ')
+            for p in text.split('\n\n\n')
+    ]
+
+def iterDocuments(hook, skip_decode_errors=False):
+    '''Yields a Document (id, type, attributes, paragraphs) for each
+    <DOC>...</DOC> in binary stream hook.
+
+    Paragraphs are the same as extracted with BeautifulSoup (see
+    documentText), but split from large blocks of the decompressed file.
+
+    If skip_decode_errors is True, documents that are not valid UTF-8 are
+    yielded with paragraphs=None instead of raising a UnicodeDecodeError.
+    '''
+    for (header, body) in _iterRawDocuments(hook):
+        attributes = dict([
+            (key.decode('ascii').lower(), value.decode('utf-8', 'replace'))
+                for (key, value) in _DOC_ATTRIBUTE.findall(header)
+        ])
+        try:
+            doc = (header + body).decode('utf-8')
+        except UnicodeDecodeError as e:
+            if not skip_decode_errors: raise e
+            paragraphs = None
+        else:
+            # same string as getNextDocument: lines joined with an extra newline
+            doc = doc.replace('\n', '\n\n')[:-1]
+            paragraphs = _paragraphs(documentText(doc))
+        yield Document(
+            id=attributes.get('id', None),
+            type=attributes.get('type', None),
+            attributes=attributes,
+            paragraphs=paragraphs
+        )
+
+def _queueDocument(paragraphs, input_q, split_sentences, doc_id=None, with_ids=False):
+    if split_sentences:
+        texts = [p.strip() for p in paragraphs if len(p) > 0]
+    else:
+        texts = [' '.join(paragraphs)]
+    for text in texts:
+        input_q.put((doc_id, text) if with_ids else text)
+
+def extractFromGZipFiles(gzns, input_q, output_q, split_sentences=False, ignore_decode_errors=False, engine='fast',
+        pipeline_metrics=None, profiles=None, skip_docs=frozenset(), index_dir=None, with_ids=False):
+    '''Extracts document texts from gzip files gzns (paths, or FileRanges
+    from splitFiles) to BatchQueue input_q, and counts progress signals in
+    BatchQueue output_q.  Documents skipped by ID or date in skip_docs (see
+    parseSkipList) are left out.  If with_ids is True, texts are queued as
+    (document ID, text) pairs, for tokenizer threads created with keyed=True.
+
+    engine           :: 'fast' (default) to split documents and extract their
+                        text from large blocks of each file (see
+                        iterDocuments), or 'soup' to read documents line by
+                        line and extract text with BeautifulSoup
+    pipeline_metrics :: utils.metrics.PipelineMetrics; if given, metrics are
+                        recorded as stage "reader" while extracting
+    profiles         :: utils.profiling.ProcessProfiles; if given, extraction
+                        is profiled as stage "reader"
+    '''
+    if not engine in ENGINES:
+        raise ValueError('Unknown extraction engine "%s"' % engine)
+    metrics.startStage(pipeline_metrics, 'reader')
+    profiling.start(profiles, 'reader')
     for gzn in gzns:
-        log.writeln('Extracting from %s...' % gzn)
-        with gzip.open(gzn, 'r') as hook:
+        _extractFromGZipFile(gzn, input_q, output_q, split_sentences, ignore_decode_errors, engine,
+            skip_docs, index_dir, with_ids)
+    input_q.flush()
+    output_q.flush()
+    profiling.stop()
+    metrics.stopStage()
+
+def _openWorkItem(gzn, index_dir):
+    if isinstance(gzn, FileRange):
+        log.writeln('Extracting from %s (bytes %d-%d)...' % (gzn.path, gzn.start, gzn.end))
+        return gzindex.openRange(gzn.path, gzn.start, gzn.end, index_dir=index_dir)
+    log.writeln('Extracting from %s...' % gzn)
+    return gzip.open(gzn, 'r')
+
+def _extractFromGZipFile(gzn, input_q, output_q, split_sentences, ignore_decode_errors, engine,
+        skip_docs=frozenset(), index_dir=None, with_ids=False):
+    with _openWorkItem(gzn, index_dir) as hook:
+        if engine == 'fast':
+            for doc in iterDocuments(hook, skip_decode_errors=ignore_decode_errors):
+                if isSkippedDocument(doc.id, skip_docs):
+                    continue
+                elif doc.paragraphs is None:
+                    output_q.signal(_SIGNALS.DOC_SKIPPED)
+                else:
+                    _queueDocument(doc.paragraphs, input_q, split_sentences, doc.id, with_ids)
+                    output_q.signal(_SIGNALS.DOC_COMPLETE)
+        else:
             while True:
                 try:
                     doc = getNextDocument(hook, delay_decode_errors=ignore_decode_errors)
                     if doc == None: break
+                    doc_id = None
+                    if len(skip_docs) > 0 or with_ids:
+                        match = _DOC_ATTRIBUTE.search(doc[:doc.find('\n')].encode('utf-8'))
+                        if match and match.group(1) == b'id': doc_id = match.group(2).decode('utf-8')
+                        if isSkippedDocument(doc_id, skip_docs):
+                            continue
 
                     soup = BeautifulSoup(doc, 'lxml-xml')
-                    text = soup.get_text()
-                    paragraphs = [
-                        p.replace('\n', ' ')
-                            for p in text.split('\n\n\n')
-                    ]
-                    if split_sentences:
-                        for p in paragraphs:
-                            if len(p) > 0:
-                                input_q.put(p.strip())
-                    else:
-                        input_q.put(' '.join(paragraphs))
-                    output_q.put(_SIGNALS.DOC_COMPLETE)
+                    _queueDocument(_paragraphs(soup.get_text()), input_q, split_sentences, doc_id, with_ids)
+                    output_q.signal(_SIGNALS.DOC_COMPLETE)
 
                 except UnicodeDecodeError as e:
-                    if ignore_decode_errors: output_q.put(_SIGNALS.DOC_SKIPPED)
+                    if ignore_decode_errors: output_q.signal(_SIGNALS.DOC_SKIPPED)
                     else: raise e
-        output_q.put(_SIGNALS.FILE_COMPLETE)
+    if not isinstance(gzn, FileRange) or gzn.last:
+        output_q.signal(_SIGNALS.FILE_COMPLETE)
+
+def _t_extractFromGZipFiles(f_q, input_q, output_q, split_sentences, ignore_decode_errors, engine,
+        pipeline_metrics=None, reader_id=0, profiles=None, skip_docs=frozenset(), index_dir=None, with_ids=False):
+    metrics.startStage(pipeline_metrics, 'reader', reader_id)
+    profiling.start(profiles, 'reader', reader_id)
+    result = f_q.get()
+    while result != _SIGNALS.HALT:
+        _extractFromGZipFile(result, input_q, output_q, split_sentences, ignore_decode_errors, engine,
+            skip_docs, index_dir, with_ids)
+        result = f_q.get()
+    input_q.flush()
+    output_q.flush()
+    profiling.stop()
+    metrics.stopStage()
 
-def _threadedWriter(outf, output_q, n_threads):
+def extractWithReaders(gzns, input_q, output_q, n_readers, split_sentences=False,
+        ignore_decode_errors=False, engine='fast', balance_by_size=False, pipeline_metrics=None,
+        profiles=None, skip_docs=frozenset(), index_dir=None, with_ids=False):
+    '''Extracts document texts from gzip files gzns as extractFromGZipFiles
+    does, with n_readers processes pulling files (or FileRanges) from a
+    shared queue.
+
+    If balance_by_size is True, files are queued from largest to smallest
+    (see orderBySize); otherwise, they are queued in the order given.
+
+    Returns once all readers have finished.
+    '''
+    if not engine in ENGINES:
+        raise ValueError('Unknown extraction engine "%s"' % engine)
+    if balance_by_size:
+        gzns = orderBySize(gzns)
+
+    readers = _startReaders(gzns, input_q, output_q, n_readers, split_sentences, ignore_decode_errors, engine,
+        pipeline_metrics, profiles, skip_docs, index_dir, with_ids)
+    for t in readers:
+        t.join()
+
+def _startReaders(gzns, input_q, output_q, n_readers, split_sentences, ignore_decode_errors, engine,
+        pipeline_metrics=None, profiles=None, skip_docs=frozenset(), index_dir=None, with_ids=False):
+    f_q = mp.Queue()
+    for gzn in gzns:
+        f_q.put(gzn)
+    for _ in range(n_readers):
+        f_q.put(_SIGNALS.HALT)
+
+    readers = [
+        mp.Process(target=_t_extractFromGZipFiles,
+            args=(f_q, input_q, output_q, split_sentences, ignore_decode_errors, engine,
+                pipeline_metrics, i, profiles, skip_docs, index_dir, with_ids))
+            for i in range(n_readers)
+    ]
+    for t in readers:
+        t.start()
+    return readers
+
+def _threadedWriter(sink, output_q, n_threads, sharded=False, pipeline_metrics=None, profiles=None, index=False):
+    '''Writes lines from output_q to a single output file from sink, and
+    tracks progress signals; if sharded, the tokenizers write their own
+    shards, and only progress is tracked here.
+
+    If index is True, output_q items are (document ID, line) pairs, and
+    each line is indexed under its document ID (see utils.docindex).
+    '''
+    metrics.startStage(pipeline_metrics, 'writer')
+    profiling.start(profiles, 'writer')
     halts_seen = 0
     lines_written, files_complete, docs_complete, docs_skipped = 0, 0, 0, 0
 
     log.track(message='  >> Written {1:,} lines (processed {2:,} GZip files -- {3:,} good documents; {4:,} skipped for decode error)', writeInterval=100)
-    with codecs.open(outf, 'w', 'utf-8') as stream:
-        result = output_q.get()
-        while True:
+    stream = None if sharded else sink.open()
+    doc_index = docindex.DocumentIndexWriter(sink.outf) if index else None
+    while halts_seen < n_threads:
+        (results, signals) = output_q.getBatch()
+        files_complete += signals.get(_SIGNALS.FILE_COMPLETE, 0)
+        docs_complete += signals.get(_SIGNALS.DOC_COMPLETE, 0)
+        docs_skipped += signals.get(_SIGNALS.DOC_SKIPPED, 0)
+        if sharded: log.tick(lines_written, files_complete, docs_complete, docs_skipped)
+        for result in results:
             if result == _SIGNALS.HALT:
                 halts_seen += 1
-                if halts_seen == n_threads:
-                    break
-            elif result == _SIGNALS.FILE_COMPLETE:
-                files_complete += 1
-            elif result == _SIGNALS.DOC_COMPLETE:
-                docs_complete += 1
-            elif result == _SIGNALS.DOC_SKIPPED:
-                docs_skipped += 1
             else:
-                stream.write(result)
-                stream.write('\n')
+                line = '%s\n' % (result if doc_index is None else result[1])
+                stream.write(line)
+                if not doc_index is None: doc_index.addText(result[0], line)
                 lines_written += 1
-            log.tick(lines_written, files_complete, docs_complete, docs_skipped)
-            result = output_q.get()
+                log.tick(lines_written, files_complete, docs_complete, docs_skipped)
+    if not stream is None: stream.close()
+    if not doc_index is None: doc_index.close()
     log.flushTracker(lines_written, files_complete, docs_complete, docs_skipped)
+    profiling.stop()
+    metrics.stopStage()
+
+def iterCorpusDocuments(gzns, skip_docs=frozenset(), index_dir=None):
+    '''Yields each document in gzip files gzns (paths, or FileRanges from
+    splitFiles), in order, as a Document (see iterDocuments).  Documents
+    skipped by ID or date in skip_docs (see parseSkipList), or that are not
+    valid UTF-8, are left out.
+    '''
+    for gzn in gzns:
+        with _openWorkItem(gzn, index_dir) as hook:
+            for doc in iterDocuments(hook, skip_decode_errors=True):
+                if doc.paragraphs is None or isSkippedDocument(doc.id, skip_docs):
+                    continue
+                yield doc
+
+def dedupTexts(gzn, skip_docs=frozenset()):
+    '''Yields (DOC id, text) for each document in gzip file gzn that would
+    be extracted, for near-duplicate detection (see utils.dedup).
+    '''
+    with gzip.open(gzn, 'r') as hook:
+        for doc in iterDocuments(hook, skip_decode_errors=True):
+            if doc.paragraphs is None or isSkippedDocument(doc.id, skip_docs):
+                continue
+            yield doc.id, ' '.join(doc.paragraphs)
+
+def _haltTokenizers(readers, input_q, n_threads):
+    for t in readers:
+        t.join()
+    for _ in range(n_threads):
+        input_q.send(_SIGNALS.HALT)
+
+def iterCorpus(gzns, threads=2, tokenizer='corenlp', endpoints=None, split_sentences=False, to_lower=False,
+        remove_punctuation=False, readers=1, engine='fast', balance_by_size=False, skip_docs=frozenset(),
+        index_dir=None, annotation_batch_size=1, requests_in_flight=1, cache=None,
+        batch_size=batchqueue.DEFAULT_BATCH_SIZE, flush_interval=batchqueue.DEFAULT_FLUSH_INTERVAL,
+        queue_capacity=batchqueue.DEFAULT_CAPACITY, with_ids=False):
+    '''Extracts and tokenizes the documents in gzip files gzns (paths, or
+    FileRanges from splitFiles) with the same reader processes and
+    tokenization threads as the plaintext script, and yields each document
+    (or sentence, if split_sentences is True) as a line of space-separated
+    tokens, in the order they are tokenized; or, if with_ids is True, as
+    (document ID, line) pairs.
+
+    tokenizer :: 'corenlp' or 'regex' (see corenlp.createTokenizerThreads)
+    endpoints :: URLs of the CoreNLP servers to tokenize with (e.g., the
+                 endpoints of a running corenlp.ServerPool); if None, a pool
+                 of one server per thread is started while iterating
+    readers   :: number of processes reading gzip files (at least one)
+
+    See extractWithReaders and corenlp.createTokenizerThreads for the other
+    arguments.  Documents that are not valid UTF-8 are skipped.  If the
+    caller stops iterating early, the reader and tokenization processes are
+    terminated.
+    '''
+    if not engine in ENGINES:
+        raise ValueError('Unknown extraction engine "%s"' % engine)
+    if balance_by_size:
+        gzns = orderBySize(gzns)
+    server_pool = None
+    if tokenizer == 'corenlp' and endpoints is None:
+        server_pool = corenlp.ServerPool(n_servers=threads).start()
+        endpoints = server_pool.endpoints
+    input_q, output_q = [
+        batchqueue.BatchQueue(batch_size=batch_size, flush_interval=flush_interval, capacity=queue_capacity,
+            name=name)
+            for name in ('input', 'output')
+    ]
+    tokenize_threads = corenlp.createTokenizerThreads(
+        n_threads=threads,
+        input_q=input_q,
+        output_q=output_q,
+        halt_signal=_SIGNALS.HALT,
+        complete_op=lambda q:q.send(_SIGNALS.HALT),
+        complete_op_args=(output_q,),
+        sentence_split=split_sentences,
+        to_lower=to_lower,
+        remove_punctuation=remove_punctuation,
+        batch_size=annotation_batch_size,
+        requests_in_flight=requests_in_flight,
+        backend=tokenizer,
+        cache=cache,
+        endpoints=endpoints,
+        keyed=with_ids
+    )
+    for t in tokenize_threads:
+        t.start()
+    reader_processes = _startReaders(gzns, input_q, output_q, max(readers, 1), split_sentences, True, engine,
+        skip_docs=skip_docs, index_dir=index_dir, with_ids=with_ids)
+    # lines are consumed here, so wait for the readers in the background
+    halter = threading.Thread(target=_haltTokenizers, args=(reader_processes, input_q, threads))
+    halter.daemon = True
+    halter.start()
+
+    halts_seen = 0
+    try:
+        while halts_seen < threads:
+            (results, _) = output_q.getBatch()
+            for result in results:
+                if result == _SIGNALS.HALT:
+                    halts_seen += 1
+                else:
+                    yield result
+        halter.join()
+        for t in tokenize_threads:
+            t.join()
+    finally:
+        if halts_seen < threads:
+            for t in reader_processes + tokenize_threads:
+                t.terminate()
+                t.join()
+            input_q.abandon()
+            output_q.abandon()
+        if not server_pool is None:
+            server_pool.close()
 
 if __name__ == '__main__':
     def _cli():
@@ -134,18 +562,43 @@ if __name__ == '__main__':
         parser = optparse.OptionParser(usage='Usage: %prog --output=OUTPUT GIGAWORDDIR',
                 description='Extracts Gigaword document texts from GZIPFILES and writes them as plaintext to single OUTPUT file')
         parser.add_option('--output', dest='output',
-                help='name of file to write artcile texts to (REQUIRED)',
+                help='name of file to write artcile texts to, or - for standard output'
+                     ' (logging then goes to standard error) (REQUIRED)',
                 default=None)
         parser.add_option('--skip-dirs', dest='skip_dirs',
                 help='comma-separated list of directories to skip (e.g., nyt_eng,ltw_eng to skip the NY Times and LA Times portions of the corpus)',
                 default='')
         parser.add_option('--skip-files', dest='skip_files',
                 help='comma-separated list of filenames to skip (e.g., apw_eng_200104.gz,apw_eng_200306.gz to skip two months of AP data)'
-                     '; note these are NOT relative paths, just the filenames',
+                     '; note these are NOT relative paths, just the filenames.  Items not'
+                     ' ending in .gz skip single documents by ID (e.g., NYT_ENG_19940701.0001)'
+                     ' or all documents from a date (YYYY, YYYYMM or YYYYMMDD)',
                 default='')
+        parser.add_option('--split-files', dest='split_files',
+                type='float', default=0,
+                help='split GZip files larger than this many MB (uncompressed) into'
+                     ' document-aligned ranges for the readers, using a document index'
+                     ' of each file (built on first use and reused while the file is'
+                     ' unchanged; see utils/gzindex.py); 0 to read whole files (default: %default)')
+        parser.add_option('--index-dir', dest='index_dir',
+                help='directory to keep the document indexes for --split-files in'
+                     ' (default: next to each GZip file)')
         parser.add_option('--split-sentences', dest='split_sentences',
                 action='store_true', default=False,
                 help='use Stanford CoreNLP sentence splitter and write one sentence per line; by default, one full document is written per line')
+        parser.add_option('--engine', dest='engine',
+                type='choice', choices=ENGINES, default='fast',
+                help='document text extraction engine: "fast" (block reads and regex'
+                     ' text extraction) or "soup" (line reads and BeautifulSoup)'
+                     ' (default: %default)')
+        parser.add_option('--readers', dest='readers',
+                type='int', default=1,
+                help='number of processes reading GZip files in parallel;'
+                     ' if 1, files are read in the main process (default: %default)')
+        parser.add_option('--balance-by-size', dest='balance_by_size',
+                action='store_true', default=False,
+                help='queue GZip files for the readers from largest to smallest,'
+                     ' so that large files (e.g., nyt_eng) are not left for last')
         parser.add_option('--lower', dest='to_lower',
                 action='store_true', default=False,
                 help='lowercase all output text')
@@ -155,12 +608,117 @@ if __name__ == '__main__':
         parser.add_option('--threads', dest='threads',
                 type='int', default=2,
                 help='number of threads for tokenization')
+        parser.add_option('--tokenizer', dest='tokenizer',
+                type='choice', choices=corenlp.BACKENDS, default='corenlp',
+                help='tokenization backend: "corenlp" (a pool of CoreNLP servers)'
+                     ' or "regex" (in-process PTB-style approximation, no JVM)'
+                     ' (default: %default)')
+        parser.add_option('--cache', dest='cache',
+                help='SQLite file to cache tokenizer output in, so reruns over the same'
+                     ' documents (e.g., with different --lower/--remove-punctuation'
+                     ' settings) skip tokenization')
+        parser.add_option('--cache-size', dest='cache_size',
+                type='float', default=tokencache.DEFAULT_MAX_BYTES / 1024**3,
+                help='maximum size of the tokenizer cache, in GB; least recently'
+                     ' used entries are evicted past it (default: %default)')
+        parser.add_option('--annotation-batch-size', dest='annotation_batch_size',
+                type='int', default=1,
+                help='number of paragraphs/documents to send to CoreNLP in a single'
+                     ' annotation request (default: %default)')
+        parser.add_option('--requests-in-flight', dest='requests_in_flight',
+                type='int', default=1,
+                help='number of annotation requests each tokenization thread keeps'
+                     ' open at once (default: %default)')
+        parser.add_option('--servers', dest='servers',
+                type='int', default=0,
+                help='number of CoreNLP servers to start for this run, on free ports from'
+                     ' 9000 up; the tokenization threads are spread across them'
+                     ' (default: one per thread)')
+        parser.add_option('--use-running-servers', dest='start_servers',
+                action='store_false', default=True,
+                help='connect to CoreNLP servers already running on localhost:9000,'
+                     ' localhost:9001, ... (one per thread) instead of starting them')
+        parser.add_option('--corenlp-pool', dest='corenlp_pool',
+                help='attach to the shared pool of CoreNLP servers described in FILE'
+                     ' (started with python -m utils.corenlp --serve-pool=FILE) instead'
+                     ' of starting servers')
+        parser.add_option('--shard', dest='sharded',
+                action='store_true', default=False,
+                help='have each tokenization thread write its own shard (OUTPUT.000,'
+                     ' OUTPUT.001, ...), listed in OUTPUT.shards.json, instead of sending'
+                     ' lines to a single writer process')
+        parser.add_option('--merge', dest='merge',
+                action='store_true', default=False,
+                help='with --shard, merge the shards into OUTPUT when done (lines'
+                     ' then follow tokenization-thread order, shard by shard, not'
+                     ' document order)')
+        parser.add_option('--format', dest='output_format',
+                type='choice', choices=outputsink.FORMATS, default='text',
+                help='output format: "text", or "ids" for a token-ID corpus (OUTPUT.vocab,'
+                     ' OUTPUT.ids, ...; see utils/tokenids.py) (default: %default)')
+        parser.add_option('--stats', dest='stats',
+                action='store_true', default=False,
+                help='collect corpus statistics in the tokenization threads, and write'
+                     ' them to OUTPUT.stats.json and OUTPUT.stats.tsv (see utils/corpusstats.py);'
+                     ' with --split-sentences, paragraphs are tokenized separately, so'
+                     ' document counts and lengths are left out')
+        parser.add_option('--compression', dest='compression',
+                type='choice', choices=outputsink.COMPRESSIONS, default='none',
+                help='compression for the output file or shards: "none", "gzip"'
+                     ' or "xz" (adds .gz/.xz to file names) (default: %default)')
+        parser.add_option('--index', dest='index',
+                action='store_true', default=False,
+                help='save the byte offset, length and DOC id of each output line in'
+                     ' OUTPUT.docidx, for random access with utils/docindex.py'
+                     ' (uncompressed, unsharded text output only; with --split-sentences,'
+                     ' each sentence is indexed under its document\'s id)')
+        parser.add_option('--dedup', dest='dedup',
+                action='store_true', default=False,
+                help='before extracting, find near-duplicate documents with MinHash/LSH'
+                     ' (signatures computed by --readers processes) and skip all but the'
+                     ' first copy; removed documents are listed in OUTPUT.dedup.tsv'
+                     ' (see utils/dedup.py)')
+        parser.add_option('--dedup-threshold', dest='dedup_threshold',
+                type='float', default=dedup.DEFAULT_THRESHOLD,
+                help='minimum estimated Jaccard similarity of word 5-grams for --dedup'
+                     ' (default: %default)')
+        parser.add_option('--dedup-shards', dest='dedup_shards',
+                type='int', default=dedup.DEFAULT_SHARDS,
+                help='number of LSH index shards for --dedup; each reader holds one'
+                     ' shard in memory at a time (default: %default)')
+        parser.add_option('--dedup-dir', dest='dedup_dir',
+                help='directory for --dedup working files (default: system temporary directory)')
+        parser.add_option('--batch-size', dest='batch_size',
+                type='int', default=batchqueue.DEFAULT_BATCH_SIZE,
+                help='number of items to send between processes at a time (default: %default)')
+        parser.add_option('--flush-interval', dest='flush_interval',
+                type='float', default=batchqueue.DEFAULT_FLUSH_INTERVAL,
+                help='maximum number of seconds to hold a partial batch (default: %default)')
+        parser.add_option('--queue-capacity', dest='queue_capacity',
+                type='int', default=batchqueue.DEFAULT_CAPACITY,
+                help='maximum number of batches waiting in each queue (default: %default)')
+        parser.add_option('--metrics', dest='metrics',
+                help='JSON-lines file to record per-stage pipeline metrics (items, bytes,'
+                     ' time blocked on queues, queue depths) in, summarized at the end'
+                     ' of the run (see utils/metrics.py)')
+        parser.add_option('--metrics-interval', dest='metrics_interval',
+                type='float', default=metrics.DEFAULT_INTERVAL,
+                help='seconds between metrics records from each process (default: %default)')
+        parser.add_option('--profile', dest='profile',
+                help='profile each reader, tokenizer and writer process with cProfile,'
+                     ' and merge the profiles of each stage into PROFILE.STAGE.prof,'
+                     ' with the top functions of each stage listed in PROFILE.txt'
+                     ' (see utils/profiling.py)')
         parser.add_option('-l', '--logfile', dest='logfile',
                 help='file to log configuration and stdout output to')
         (options, args) = parser.parse_args()
         if len(args) == 0 or options.output == None:
             parser.print_help()
             exit()
+        if options.output == outputsink.STDOUT and (options.sharded or options.stats or options.index or options.dedup):
+            parser.error('--shard, --stats, --index and --dedup need an output file')
+        if options.index and (options.sharded or options.compression != 'none' or options.output_format != 'text'):
+            parser.error('--index needs uncompressed, unsharded text output')
 
         if len(options.skip_dirs) > 0:
             options.skip_dirs = set(options.skip_dirs.split(','))
@@ -168,60 +726,178 @@ if __name__ == '__main__':
             options.skip_dirs = set()
 
         if len(options.skip_files) > 0:
-            options.skip_files = set(options.skip_files.split(','))
+            options.skip_files, options.skip_docs = parseSkipList(options.skip_files.split(','))
         else:
-            options.skip_files = set()
+            options.skip_files, options.skip_docs = set(), set()
 
         return args, options
 
     (gigaword_dir,), options = _cli()
+    if options.output == outputsink.STDOUT:
+        outputsink.claimStdout()
     log.start(logfile=options.logfile)
     configlogger.writeConfig(log, [
         ('Gigaword directory', gigaword_dir),
         ('Subdirectories to skip', '--none--' if len(options.skip_dirs) == 0 else '[%s]' % ', '.join(options.skip_dirs)),
         ('Specific files to skip', '--none--' if len(options.skip_files) == 0 else '[%s]' % ', '.join(options.skip_files)),
+        ('Documents/dates to skip', '--none--' if len(options.skip_docs) == 0 else '[%s]' % ', '.join(sorted(options.skip_docs))),
+        ('Extraction engine', options.engine),
+        ('Reader settings', [
+            ('Number of reader processes', options.readers),
+            ('Balancing files by size', options.balance_by_size),
+            ('Splitting files over (MB)', options.split_files if options.split_files > 0 else '--no--'),
+            ('Document index directory', '--next to files--' if options.index_dir is None else options.index_dir),
+        ]),
+        ('Near-duplicate removal', [
+            ('Removing near-duplicates', options.dedup),
+            ('Similarity threshold', options.dedup_threshold),
+            ('Index shards', options.dedup_shards),
+            ('Working directory', '--system temporary directory--' if options.dedup_dir is None else options.dedup_dir),
+        ]),
+        ('Output settings', [
+            ('Sharded', options.sharded),
+            ('Merging shards', options.merge),
+            ('Format', options.output_format),
+            ('Compression', options.compression),
+            ('Collecting statistics', options.stats),
+            ('Indexing documents', options.index),
+        ]),
         ('Output format settings', [
+            ('Tokenization backend', options.tokenizer),
+            ('Tokenizer cache', '--none--' if options.cache is None else '%s (max %.1f GB)' % (options.cache, options.cache_size)),
             ('Number of tokenization threads', options.threads),
+            ('Items per annotation request', options.annotation_batch_size),
+            ('Annotation requests in flight per thread', options.requests_in_flight),
+            ('CoreNLP servers', 'shared pool %s' % options.corenlp_pool if options.corenlp_pool
+                else ('%d started' % (options.servers or options.threads)) if options.start_servers
+                else 'running on ports 9000+'),
             ('Splitting sentences', options.split_sentences),
             ('Lowercasing', options.to_lower),
             ('Removing punctuation', options.remove_punctuation),
-        ])
+        ]),
+        ('Queue settings', [
+            ('Batch size', options.batch_size),
+            ('Flush interval (s)', options.flush_interval),
+            ('Capacity (batches)', options.queue_capacity),
+        ]),
+        ('Metrics file', '--none--' if options.metrics is None else '%s (every %.1fs)' % (options.metrics, options.metrics_interval)),
+        ('Profile prefix', '--none--' if options.profile is None else options.profile),
     ], title='Gigaword plaintext corpus extraction')
     
-    gzfs = listAllFiles(gigaword_dir, options.skip_dirs, options.skip_files)
+    gzfs = listAllFiles(gigaword_dir, options.skip_dirs, options.skip_files, options.skip_docs)
     log.writeln('Found %d gzip files.' % len(gzfs))
+    if options.dedup:
+        t_sub = log.startTimer('Finding near-duplicate documents...')
+        deduplicator = dedup.Deduplicator(threshold=options.dedup_threshold, shards=options.dedup_shards,
+            workers=options.readers, work_dir=options.dedup_dir)
+        duplicates = deduplicator.findDuplicates(gzfs,
+            functools.partial(dedupTexts, skip_docs=frozenset(options.skip_docs)))
+        dedup.writeReport(duplicates, options.output)
+        options.skip_docs = set(options.skip_docs) | set([duplicate.id for duplicate in duplicates])
+        log.stopTimer(t_sub, message='Skipping %d near-duplicates (see %s) ({0:.2f}s)' % (
+            len(duplicates), dedup.reportPath(options.output)))
+    if options.split_files > 0:
+        t_sub = log.startTimer('Loading document indexes...')
+        gzfs = splitFiles(gzfs, int(options.split_files * 1024**2), index_dir=options.index_dir,
+            workers=options.readers)
+        log.stopTimer(t_sub, message='Split into %d files/ranges ({0:.2f}s)' % len(gzfs))
 
     t_main = log.startTimer('Document texts will be written to %s.' % options.output)
 
-    input_q, output_q = mp.Queue(), mp.Queue()
+    input_q, output_q = [
+        batchqueue.BatchQueue(batch_size=options.batch_size, flush_interval=options.flush_interval,
+            capacity=options.queue_capacity, name=name)
+            for name in ('input', 'output')
+    ]
+    pipeline_metrics = None
+    if options.metrics:
+        pipeline_metrics = metrics.PipelineMetrics(options.metrics, interval=options.metrics_interval)
+        pipeline_metrics.clear()
+    profiles = None
+    if options.profile:
+        profiles = profiling.ProcessProfiles(options.profile)
+        profiles.clear()
+    server_pool = None
+    if options.tokenizer == 'corenlp':
+        if options.corenlp_pool:
+            server_pool = corenlp.ServerPool.load(options.corenlp_pool)
+        elif options.start_servers:
+            server_pool = corenlp.ServerPool(n_servers=options.servers or options.threads).start()
+        else:
+            server_pool = corenlp.ServerPool.attach(['http://localhost:%d' % (9000 + i) for i in range(options.threads)])
+    sink = outputsink.OutputSink(options.output, compression=options.compression,
+        format=options.output_format)
     tokenize_threads = corenlp.createTokenizerThreads(
         n_threads=options.threads,
         input_q=input_q,
         output_q=output_q,
         halt_signal=_SIGNALS.HALT,
-        complete_op=lambda q:q.put(_SIGNALS.HALT),
+        complete_op=lambda q:q.send(_SIGNALS.HALT),
         complete_op_args=(output_q,),
         start_port=9000,
         sentence_split=options.split_sentences,
         to_lower=options.to_lower,
-        remove_punctuation=options.remove_punctuation
+        remove_punctuation=options.remove_punctuation,
+        batch_size=options.annotation_batch_size,
+        requests_in_flight=options.requests_in_flight,
+        backend=options.tokenizer,
+        cache=None if options.cache is None else tokencache.TokenizationCache(
+            options.cache, max_bytes=int(options.cache_size * 1024**3)),
+        output_sink=sink if options.sharded else None,
+        stats_outf=options.output if options.stats else None,
+        pipeline_metrics=pipeline_metrics,
+        profiles=profiles,
+        endpoints=None if server_pool is None else server_pool.endpoints,
+        keyed=options.index
     )
     write_thread = mp.Process(
         target=_threadedWriter,
-        args=(options.output, output_q, options.threads)
+        args=(sink, output_q, options.threads, options.sharded, pipeline_metrics, profiles, options.index)
     )
 
+    if options.stats:
+        corpusstats.clearPartials(options.output)
+    if options.sharded:
+        sink.clearCounts()
     for t in tokenize_threads:
         t.start()
     write_thread.start()
 
-    extractFromGZipFiles(gzfs, input_q, output_q, split_sentences=options.split_sentences, ignore_decode_errors=True)
+    if options.readers > 1:
+        extractWithReaders(gzfs, input_q, output_q, options.readers,
+            split_sentences=options.split_sentences, ignore_decode_errors=True,
+            engine=options.engine, balance_by_size=options.balance_by_size,
+            pipeline_metrics=pipeline_metrics, profiles=profiles, skip_docs=options.skip_docs,
+            index_dir=options.index_dir, with_ids=options.index)
+    else:
+        if options.balance_by_size:
+            gzfs = orderBySize(gzfs)
+        extractFromGZipFiles(gzfs, input_q, output_q, split_sentences=options.split_sentences,
+            ignore_decode_errors=True, engine=options.engine, pipeline_metrics=pipeline_metrics,
+            profiles=profiles, skip_docs=options.skip_docs, index_dir=options.index_dir,
+            with_ids=options.index)
     for t in tokenize_threads:
-        input_q.put(_SIGNALS.HALT)
+        input_q.send(_SIGNALS.HALT)
 
     for t in tokenize_threads:
         t.join()
     write_thread.join()
+    if not server_pool is None:
+        server_pool.close()
+
+    if options.sharded:
+        manifest = sink.writeManifest()
+        log.writeln('Wrote %d lines to %d shards (see %s)' % (manifest['lines'],
+            len(manifest['shards']), outputsink.manifestPath(options.output)))
+        if options.merge:
+            log.writeln('Merged shards into %s' % sink.merge())
+    if options.stats:
+        corpusstats.mergePartials(options.output)
+        log.writeln('Wrote corpus statistics to %s' % corpusstats.reportPath(options.output))
+    if options.metrics:
+        metrics.logSummary(options.metrics)
+    if options.profile:
+        profiling.merge(profiles)
 
     log.stopTimer(t_main, message='Processing complete in {0:.2f}s.')
     log.stop()
@@ -5,37 +5,314 @@ Script to extract single plaintext corpus from .tar.gz PubMed PMC Open Access Su
 '''
 
 import glob
-import codecs
+import collections
 import tarfile
+import multiprocessing as mp
 from denis.common import preprocessing
 from denis.common.logging import log
+from utils import outputsink
+from utils import corpusstats
+from utils import profiling
+from utils import docindex
+from utils import dedup
 
-def extractArticleTexts(tarf, outf, mode='r:gz'):
-    log.writeln('--- Processing %s ---' % tarf)
-    f = tarfile.open(tarf, mode=mode)
+DEFAULT_BATCH_SIZE = 100
+_MAX_PENDING_BATCHES = 16
+
+class _SIGNALS:
+    HALT = -1
+
+def tokenizeArticle(data):
+    '''Tokenizes the raw bytes of one article file, and returns its text as a
+    single string (without trailing newline).
 
-    t_sub = log.startTimer('Reading member files...', newline=False)
-    members = f.getmembers()
-    log.stopTimer(t_sub, message='%d members ({0:.2f}s)' % len(members))
+    All lines that start with "====" are skipped (not skipping any front
+    matter, including the title line, as this sometimes includes the
+    abstract).
+    '''
+    tokenize = preprocessing.tokenize
+    # split into lines as iterating over the file would, keeping line endings;
+    # the last piece has no newline, and is only a line if it isn't empty
+    lines = ['%s\n' % line for line in data.decode('utf-8').split('\n')]
+    last_line = lines.pop()[:-1]
+    if last_line != '': lines.append(last_line)
+    return ''.join([
+        ' '.join(tokenize(line))
+            for line in lines
+                if line.strip()[:4] != '===='
+    ])
 
-    log.track(message='  >> Extracted {0} articles...', writeInterval=1)
-    for m in members:
-        if m.isfile():
-            # write each file on a separate line
+def tokenizeArticles(articles):
+    '''Tokenizes a batch of articles (list of raw bytes), and returns the
+    list of their texts (see tokenizeArticle).
+    '''
+    return [tokenizeArticle(data) for data in articles]
+
+def _articleBatches(f, batch_size, skip_names=frozenset()):
+    # yields (member names, raw bytes) of batches of articles
+    names, batch = [], []
+    for m in f:
+        if m.isfile() and not m.name in skip_names:
             hook = f.extractfile(m)
-            # pull all lines that don't start with "===="
-            # (not skipping any front matter, including the title line, as this sometimes
-            # includes the abstract)
-            for line in hook:
-                decoded = line.decode('utf-8')
-                if decoded.strip()[:4] == '====': continue
-                tokens = preprocessing.tokenize(decoded)
-                outf.write(' '.join(tokens))
-            outf.write('\n')
+            names.append(m.name)
+            batch.append(hook.read())
             hook.close()
-            log.tick()
+            if len(batch) == batch_size:
+                yield names, batch
+                names, batch = [], []
+        # TarFile keeps every member it has seen; drop them as we go
+        f.members = []
+    if len(batch) > 0: yield names, batch
+
+def _skippedNames(tarf, skip_articles):
+    # file names of the articles in tarf that are in skip_articles
+    return frozenset([name for (skip_tarf, name) in skip_articles if skip_tarf == tarf])
+
+def _iterTextBatches(tarf, mode='r|gz', batch_size=DEFAULT_BATCH_SIZE, tokenize_pool=None,
+        skip_names=frozenset()):
+    # yields (member names, article texts) of batches, in tarball order
+    f = tarfile.open(tarf, mode=mode)
+    if tokenize_pool is None:
+        for (names, batch) in _articleBatches(f, batch_size, skip_names):
+            yield names, tokenizeArticles(batch)
+    else:
+        # keep a bounded number of batches in flight, and return them in order
+        pending = collections.deque()
+        for (names, batch) in _articleBatches(f, batch_size, skip_names):
+            pending.append((names, tokenize_pool.apply_async(tokenizeArticles, (batch,))))
+            if len(pending) >= _MAX_PENDING_BATCHES:
+                (names, texts) = pending.popleft()
+                yield names, texts.get()
+        while len(pending) > 0:
+            (names, texts) = pending.popleft()
+            yield names, texts.get()
     f.close()
-    log.writeln()
+
+def extractArticleTexts(tarf, outf, mode='r|gz', batch_size=DEFAULT_BATCH_SIZE, tokenize_pool=None, stats=None,
+        index=None, skip_articles=frozenset()):
+    '''Writes the text of each article in tarball tarf to open stream outf,
+    one article per line.
+
+    By default, the tarball is read in a single streaming pass (members are
+    extracted as they are reached, without listing them first).  Articles
+    are tokenized and written in batches of batch_size; if tokenize_pool is
+    a multiprocessing.Pool, batches are tokenized in its worker processes.
+    Each article is counted in stats (a utils.corpusstats.CorpusStats), and
+    indexed under its file name in index (a utils.docindex.DocumentIndexWriter),
+    if given.  Articles whose (tarball, file name) is in skip_articles are
+    left out.
+
+    Returns the number of articles extracted.
+    '''
+    log.writeln('--- Processing %s ---' % tarf)
+    n_articles = 0
+    log.track(message='  >> Extracted {1:,} articles...', writeInterval=1)
+    for (names, texts) in _iterTextBatches(tarf, mode=mode, batch_size=batch_size, tokenize_pool=tokenize_pool,
+            skip_names=_skippedNames(tarf, skip_articles)):
+        lines = ['%s\n' % text for text in texts]
+        outf.write(''.join(lines))
+        if not index is None:
+            for (name, line) in zip(names, lines):
+                index.addText(name, line)
+        if not stats is None:
+            for text in texts:
+                stats.addLine(text.split())
+                stats.endDocument()
+        n_articles += len(texts)
+        log.tick(n_articles)
+    log.flushTracker(n_articles)
+    return n_articles
+
+def _t_extractToQueue(tarf_q, text_q, batch_size, skip_articles):
+    tarf = tarf_q.get()
+    while tarf != _SIGNALS.HALT:
+        for (names, texts) in _iterTextBatches(tarf, batch_size=batch_size,
+                skip_names=_skippedNames(tarf, skip_articles)):
+            text_q.put((names, texts))
+        tarf = tarf_q.get()
+    text_q.put(_SIGNALS.HALT)
+
+def iterArticleTexts(tarfs, workers=1, tokenize_workers=1, batch_size=DEFAULT_BATCH_SIZE, with_names=False,
+        skip_articles=frozenset()):
+    '''Yields the text of each article in tarballs tarfs (see
+    tokenizeArticle), or (file name, text) pairs if with_names is True.
+    Articles whose (tarball, file name) is in skip_articles are left out.
+
+    With workers > 1, that many processes each read and tokenize one tarball
+    at a time, and articles are yielded as their batches are ready (so
+    tarballs are interleaved).  Otherwise, tarballs are read here, in order,
+    and batches of batch_size articles are tokenized in a pool of
+    tokenize_workers processes.
+
+    If the caller stops iterating early, the worker processes are
+    terminated.
+    '''
+    if workers <= 1:
+        tokenize_pool = mp.Pool(tokenize_workers) if tokenize_workers > 1 else None
+        try:
+            for tarf in tarfs:
+                for (names, texts) in _iterTextBatches(tarf, batch_size=batch_size, tokenize_pool=tokenize_pool,
+                        skip_names=_skippedNames(tarf, skip_articles)):
+                    for item in (zip(names, texts) if with_names else texts):
+                        yield item
+        finally:
+            if not tokenize_pool is None:
+                tokenize_pool.terminate()
+                tokenize_pool.join()
+        return
+
+    tarf_q, text_q = mp.Queue(), mp.Queue(maxsize=workers*_MAX_PENDING_BATCHES)
+    for tarf in tarfs:
+        tarf_q.put(tarf)
+    processes = [
+        mp.Process(target=_t_extractToQueue, args=(tarf_q, text_q, batch_size, skip_articles))
+            for _ in range(workers)
+    ]
+    for _ in processes:
+        tarf_q.put(_SIGNALS.HALT)
+    for p in processes:
+        p.start()
+
+    halts_seen = 0
+    try:
+        while halts_seen < workers:
+            result = text_q.get()
+            if result == _SIGNALS.HALT:
+                halts_seen += 1
+                continue
+            (names, texts) = result
+            for item in (zip(names, texts) if with_names else texts):
+                yield item
+    finally:
+        if halts_seen < workers:
+            for p in processes:
+                p.terminate()
+            tarf_q.cancel_join_thread()
+        for p in processes:
+            p.join()
+
+def dedupTexts(tarf):
+    '''Yields (file name, text) for each article in tarball tarf, for
+    near-duplicate detection (see utils.dedup).
+    '''
+    with tarfile.open(tarf, mode='r|gz') as f:
+        for (names, batch) in _articleBatches(f, DEFAULT_BATCH_SIZE):
+            for (name, data) in zip(names, batch):
+                yield name, data.decode('utf-8', 'replace')
+
+def _extractToShard(args):
+    (tarf, sink, shard_id, batch_size, collect_stats, skip_articles, index) = args
+    stats = corpusstats.CorpusStats() if collect_stats else None
+    doc_index = docindex.DocumentIndexWriter(sink.shardPath(shard_id)) if index else None
+    with sink.shard(shard_id) as outf:
+        n_articles = extractArticleTexts(tarf, outf, batch_size=batch_size, stats=stats, index=doc_index,
+            skip_articles=skip_articles)
+    if not doc_index is None: doc_index.close()
+    return tarf, n_articles, stats
+
+def extractAllTarFiles(tarfs, outfn, workers=1, sharded=False, tokenize_workers=1, batch_size=DEFAULT_BATCH_SIZE,
+        compression='none', output_format='text', stats=False, profiles=None, index=False, deduplicator=None):
+    '''Extracts article texts from all tarballs in tarfs, processing up to
+    workers tarballs at once in a process pool.
+
+    If sharded is True, the articles from each tarball are written to their
+    own shard (outfn.000, outfn.001, ...), listed in outfn.shards.json (see
+    utils.outputsink); otherwise, shards are merged into outfn in the order
+    of tarfs once all are complete.  Output is compressed with gzip or xz if
+    compression says so, or written as a token-ID corpus (see
+    utils.tokenids) if output_format is 'ids'.
+
+    When tarballs are processed one at a time (workers=1, not sharded),
+    batches of batch_size articles are tokenized in a pool of
+    tokenize_workers processes instead.
+
+    If outfn is utils.outputsink.STDOUT, articles are written to standard
+    output; with workers > 1, in the order they are extracted.
+
+    If index is True, the byte offset, length and file name of each article
+    are saved in outfn.docidx, for random access with utils.docindex
+    (requires uncompressed, unsharded text output to a file).  With
+    workers > 1, each shard is indexed as it is written, and the shard
+    indexes are merged along with the shards.
+
+    If stats is True, corpus statistics are collected as articles are written
+    (by the worker processing each tarball), and merged into outfn.stats.json
+    and outfn.stats.tsv (see utils.corpusstats).
+
+    If profiles (a utils.profiling.ProcessProfiles) is given, the processes
+    extracting and tokenizing articles are profiled (as stages "extractor"
+    and "tokenizer"), and the profiles of each stage merged once all are
+    done.
+
+    If deduplicator (a utils.dedup.Deduplicator) is given, near-duplicate
+    articles are found before extracting, and all but the first copy (in the
+    order of tarfs) are skipped; removed articles are listed in
+    outfn.dedup.tsv.
+    '''
+    if index and (sharded or compression != 'none' or output_format != 'text' or outfn == outputsink.STDOUT):
+        raise ValueError('Indexed output must be a single uncompressed text file')
+    if not deduplicator is None and outfn == outputsink.STDOUT:
+        raise ValueError('Deduplication report needs an output file')
+    skip_articles = frozenset()
+    if not deduplicator is None:
+        duplicates = deduplicator.findDuplicates(tarfs, dedupTexts)
+        dedup.writeReport(duplicates, outfn)
+        skip_articles = frozenset([(duplicate.source, duplicate.id) for duplicate in duplicates])
+        log.writeln('Skipping %d near-duplicate articles (see %s)' % (len(duplicates), dedup.reportPath(outfn)))
+    if not profiles is None:
+        profiles.clear()
+    sink = outputsink.OutputSink(outfn, compression=compression, format=output_format)
+    all_stats = corpusstats.CorpusStats() if stats else None
+    if workers <= 1 and not sharded:
+        tokenize_pool = None
+        if tokenize_workers > 1:
+            tokenize_pool = mp.Pool(tokenize_workers, initializer=profiling.startPoolWorker,
+                initargs=(profiles, 'tokenizer'))
+        profiling.start(profiles, 'extractor')
+        doc_index = docindex.DocumentIndexWriter(outfn) if index else None
+        with sink.open() as outf:
+            for tarf in tarfs:
+                extractArticleTexts(tarf, outf, batch_size=batch_size, tokenize_pool=tokenize_pool,
+                    stats=all_stats, index=doc_index, skip_articles=skip_articles)
+        if not doc_index is None: doc_index.close()
+        profiling.stop()
+        if not tokenize_pool is None:
+            tokenize_pool.close()
+            tokenize_pool.join()
+    elif outfn == outputsink.STDOUT and not sharded:
+        # no shards to merge into standard output; write articles as the
+        # workers finish them
+        with sink.open() as outf:
+            for text in iterArticleTexts(tarfs, workers=workers, batch_size=batch_size,
+                    skip_articles=skip_articles):
+                outf.write('%s\n' % text)
+                if not all_stats is None:
+                    all_stats.addLine(text.split())
+                    all_stats.endDocument()
+    else:
+        sink.clearCounts()
+        pool = mp.Pool(workers, initializer=profiling.startPoolWorker, initargs=(profiles, 'extractor'))
+        results = pool.imap(_extractToShard, [
+            (tarf, sink, i, batch_size, stats, skip_articles, index)
+                for (i, tarf) in enumerate(tarfs)
+        ])
+        for (tarf, n_articles, tarf_stats) in results:
+            log.writeln('Completed %s (%d articles)' % (tarf, n_articles))
+            if not tarf_stats is None: all_stats.update(tarf_stats)
+        pool.close()
+        pool.join()
+
+        sink.writeManifest()
+        if index:
+            docindex.mergeIndexes([sink.shardPath(i) for i in range(len(tarfs))], outfn)
+        if not sharded:
+            sink.merge()
+
+    if stats:
+        all_stats.writeReport(outfn)
+        log.writeln('Wrote corpus statistics to %s' % corpusstats.reportPath(outfn))
+    if not profiles is None:
+        profiling.merge(profiles)
 
 if __name__ == '__main__':
     def _cli():
@@ -43,22 +320,86 @@ if __name__ == '__main__':
         parser = optparse.OptionParser(usage='Usage: %prog --output=OUTPUT TARFILES',
                 description='Extracts PMC article texts from TARFILES and writes them to single OUTPUT file')
         parser.add_option('--output', dest='output',
-                help='name of file to write artcile texts to (REQUIRED)',
+                help='name of file to write artcile texts to, or - for standard output'
+                     ' (logging then goes to standard error) (REQUIRED)',
                 default=None)
+        parser.add_option('--workers', dest='workers',
+                type='int', default=1,
+                help='number of TARFILES to process in parallel (default: %default)')
+        parser.add_option('--tokenize-workers', dest='tokenize_workers',
+                type='int', default=1,
+                help='when processing TARFILES one at a time, number of processes to'
+                     ' tokenize article batches with (default: %default)')
+        parser.add_option('--batch-size', dest='batch_size',
+                type='int', default=DEFAULT_BATCH_SIZE,
+                help='number of articles to tokenize and write at a time (default: %default)')
+        parser.add_option('--shard', dest='sharded',
+                action='store_true', default=False,
+                help='write the articles from each of TARFILES to its own shard'
+                     ' (OUTPUT.000, OUTPUT.001, ...; listed in OUTPUT.shards.json)'
+                     ' instead of merging them into OUTPUT')
+        parser.add_option('--format', dest='output_format',
+                type='choice', choices=outputsink.FORMATS, default='text',
+                help='output format: "text", or "ids" for a token-ID corpus (OUTPUT.vocab,'
+                     ' OUTPUT.ids, ...; see utils/tokenids.py) (default: %default)')
+        parser.add_option('--stats', dest='stats',
+                action='store_true', default=False,
+                help='collect corpus statistics as articles are written, and write them'
+                     ' to OUTPUT.stats.json and OUTPUT.stats.tsv (see utils/corpusstats.py)')
+        parser.add_option('--compression', dest='compression',
+                type='choice', choices=outputsink.COMPRESSIONS, default='none',
+                help='compression for the output file or shards: "none", "gzip" or "xz"'
+                     ' (adds .gz/.xz to file names) (default: %default)')
+        parser.add_option('--index', dest='index',
+                action='store_true', default=False,
+                help='save the byte offset, length and file name of each article in'
+                     ' OUTPUT.docidx, for random access with utils/docindex.py'
+                     ' (uncompressed, unsharded text output only)')
+        parser.add_option('--dedup', dest='dedup',
+                action='store_true', default=False,
+                help='before extracting, find near-duplicate articles with MinHash/LSH'
+                     ' (signatures computed by --workers processes) and skip all but the'
+                     ' first copy; removed articles are listed in OUTPUT.dedup.tsv'
+                     ' (see utils/dedup.py)')
+        parser.add_option('--dedup-threshold', dest='dedup_threshold',
+                type='float', default=dedup.DEFAULT_THRESHOLD,
+                help='minimum estimated Jaccard similarity of word 5-grams for --dedup'
+                     ' (default: %default)')
+        parser.add_option('--dedup-shards', dest='dedup_shards',
+                type='int', default=dedup.DEFAULT_SHARDS,
+                help='number of LSH index shards for --dedup; each worker holds one'
+                     ' shard in memory at a time (default: %default)')
+        parser.add_option('--dedup-dir', dest='dedup_dir',
+                help='directory for --dedup working files (default: system temporary directory)')
+        parser.add_option('--profile', dest='profile',
+                help='profile each process extracting or tokenizing articles with'
+                     ' cProfile, and merge the profiles of each stage into'
+                     ' PROFILE.STAGE.prof, with the top functions of each stage listed'
+                     ' in PROFILE.txt (see utils/profiling.py)')
         (options, args) = parser.parse_args()
         if len(args) == 0 or options.output == None:
             parser.print_help()
             exit()
+        if options.output == outputsink.STDOUT and (options.sharded or options.stats or options.index or options.dedup):
+            parser.error('--shard, --stats, --index and --dedup need an output file')
+        if options.index and (options.sharded or options.compression != 'none' or options.output_format != 'text'):
+            parser.error('--index needs uncompressed, unsharded text output')
         if len(args) == 1: tarfs = glob.glob(args[0])
         else: tarfs = args
-        return tarfs, options.output
-    tarfs, outfn = _cli()
+        return tarfs, options
+    tarfs, options = _cli()
+    outfn = options.output
+    if outfn == outputsink.STDOUT:
+        outputsink.claimStdout()
 
     t_main = log.startTimer('Article texts will be written to %s.' % outfn)
 
-    outf = codecs.open(outfn, 'w', 'utf-8')
-    for tarf in tarfs:
-        extractArticleTexts(tarf, outf)
-    outf.close()
+    extractAllTarFiles(tarfs, outfn, workers=options.workers, sharded=options.sharded,
+        tokenize_workers=options.tokenize_workers, batch_size=options.batch_size,
+        compression=options.compression, output_format=options.output_format,
+        stats=options.stats, index=options.index,
+        deduplicator=None if not options.dedup else dedup.Deduplicator(threshold=options.dedup_threshold,
+            shards=options.dedup_shards, workers=options.workers, work_dir=options.dedup_dir),
+        profiles=None if options.profile is None else profiling.ProcessProfiles(options.profile))
 
     log.stopTimer(t_main, message='Processing complete in {0:.2f}s.')
@@ -3,22 +3,173 @@ Methods/script for parsing PubMed Baseline .xml.gz files
 and extracting titles/abstracts from each article.
 '''
 import multiprocessing as mp
+import threading
+import collections
 import queue
 import gzip
-import codecs
 import os
 import glob
 import time
 import sys
+import json
+import hashlib
 from bs4 import BeautifulSoup
+from lxml import etree
 from drgriffis.common import log
+from utils import batchqueue
+from utils import outputsink
+from utils import corpusstats
+from utils import metrics
+from utils import profiling
+from utils import docindex
+
+ENGINES = ('lxml', 'soup')
+
+# top-level citation elements, which are cleared once parsed
+_RECORD_TAGS = ('PubmedArticle', 'MedlineCitation', 'PubmedBookArticle')
 
 class _SIGNALS:
     HALT = -1
     COMPLETED_FILE = 0
     FAILURE = 2
+    DELETED = 3
+    WRITTEN = 4
+
+DEFAULT_PATTERN = 'medline*.xml.gz'
+
+DELETED = 'DELETED'
+
+def _collapseWhitespace(string):
+    # BeautifulSoup collapses whitespace-only strings to a single newline or
+    # space; do the same here, to keep output identical across engines
+    if string.strip(' \t\n\r\x0c') == '':
+        return '\n' if '\n' in string else ' '
+    return string
+
+def _elementText(elem):
+    return ''.join([_collapseWhitespace(s) for s in elem.itertext()])
+
+def _titleAndAbstract(article):
+    title = article.find('.//ArticleTitle')
+    if title is None: return None
+    abstract = article.find('.//Abstract')
+    if not abstract is None:
+        abstract = abstract.find('.//AbstractText')
+        if not abstract is None:
+            abstract = _elementText(abstract).replace('\n', ' ')
+    return (_elementText(title), abstract)
+
+def iterTitlesAndAbstracts(stream, with_pmids=False):
+    '''Incrementally parses an open PubMed XML stream, and yields a
+    (title, abstract) tuple for each <Article> in it (abstract is None if
+    the article has none), or None for articles with no title.  If
+    with_pmids is True, tuples are (title, abstract, PMID) instead.
+
+    Each citation is discarded as soon as it is parsed.
+    '''
+    for (_, elem) in etree.iterparse(stream, events=('end',), tag=('Article',) + _RECORD_TAGS):
+        if elem.tag == 'Article':
+            record = _titleAndAbstract(elem)
+            if with_pmids and not record is None:
+                record = record + (_citationPMID(elem),)
+            yield record
+        else:
+            _discardElement(elem)
+
+def _citationPMID(article):
+    citation = article.getparent()
+    if citation is None: return None
+    pmid = citation.findtext('PMID')
+    return None if pmid is None else pmid.strip()
 
-def _t_getArticles(f_q, article_q, n_halts):
+def iterCitationUpdates(stream):
+    '''Incrementally parses an open PubMed XML stream (baseline or update
+    file), and yields a (PMID, record) tuple for each citation in it.
+
+    record is a (title, abstract) tuple as in iterTitlesAndAbstracts, None
+    for articles with no title, or DELETED for each PMID listed in a
+    <DeleteCitation> element.
+    '''
+    for (_, elem) in etree.iterparse(stream, events=('end',), tag=_RECORD_TAGS + ('DeleteCitation',)):
+        if elem.tag == 'MedlineCitation':
+            article = elem.find('Article')
+            record = None if article is None else _titleAndAbstract(article)
+            yield (elem.findtext('PMID').strip(), record)
+        elif elem.tag == 'DeleteCitation':
+            for pmid in elem.iterfind('PMID'):
+                yield (pmid.text.strip(), DELETED)
+        _discardElement(elem)
+
+def _discardElement(elem):
+    elem.clear()
+    parent = elem.getparent()
+    if not parent is None:
+        while not elem.getprevious() is None:
+            del parent[0]
+
+def _writeRecord(stream, record, index=None):
+    # records from the extracting processes carry their PMID as well
+    (title, abstract) = record[:2]
+    text = '%s\n%s\n' % (title, abstract) if abstract else '%s\n' % title
+    stream.write(text)
+    # token-ID output keeps each record as a document
+    if hasattr(stream, 'endDocument'): stream.endDocument()
+    if not index is None: index.addText(record[2], text)
+
+def _openShard(sink, shard_id):
+    return None if sink is None else sink.shard(shard_id)
+
+def _openStats(stats_outf):
+    return None if stats_outf is None else corpusstats.CorpusStats()
+
+def _saveStats(stats, stats_outf, worker_id):
+    if not stats is None: stats.save(corpusstats.partialPath(stats_outf, worker_id))
+
+def _outputRecord(record, corpus_q, shard, stats=None):
+    '''Sends record to the writer, or writes it to shard directly (and only
+    counts it in corpus_q) if sharding.  Counts the record in stats, if
+    given.
+    '''
+    if not stats is None:
+        # titles can hold newlines; count lines as written
+        for field in record[:2]:
+            if field:
+                for line in field.split('\n'): stats.addLine(line.split())
+        stats.endDocument()
+    if shard is None:
+        corpus_q.put(record)
+    else:
+        _writeRecord(shard, record)
+        corpus_q.signal(_SIGNALS.WRITTEN)
+
+def _closeShard(shard, corpus_q):
+    if not shard is None: shard.close()
+    corpus_q.flush()
+
+def _t_streamTitlesAndAbstracts(f_q, corpus_q, sink=None, shard_id=0, stats_outf=None, pipeline_metrics=None,
+        profiles=None):
+    metrics.startStage(pipeline_metrics, 'reader', shard_id)
+    profiling.start(profiles, 'reader', shard_id)
+    shard = _openShard(sink, shard_id)
+    stats = _openStats(stats_outf)
+    result = f_q.get()
+    while result != _SIGNALS.HALT:
+        with gzip.open(result, 'rb') as stream:
+            for record in iterTitlesAndAbstracts(stream, with_pmids=True):
+                if record is None:
+                    corpus_q.signal(_SIGNALS.FAILURE)
+                else:
+                    _outputRecord(record, corpus_q, shard, stats)
+        corpus_q.signal(_SIGNALS.COMPLETED_FILE)
+        result = f_q.get()
+    _saveStats(stats, stats_outf, shard_id)
+    _closeShard(shard, corpus_q)
+    profiling.stop()
+    metrics.stopStage()
+
+def _t_getArticles(f_q, article_q, pipeline_metrics=None, reader_id=0, profiles=None):
+    metrics.startStage(pipeline_metrics, 'reader', reader_id)
+    profiling.start(profiles, 'reader', reader_id)
     result = f_q.get()
     while result != _SIGNALS.HALT:
         with gzip.open(result, 'r') as stream:
@@ -26,93 +177,464 @@ def _t_getArticles(f_q, article_q, n_halts):
         soup = BeautifulSoup(contents, 'lxml-xml')
         articles = soup.find_all('Article')
         for article in articles:
-            article_q.put(str(article))
-        article_q.put(_SIGNALS.COMPLETED_FILE)
-        while article_q.qsize() > 5000:
-            time.sleep(1)
+            citation = article.find_parent('MedlineCitation')
+            pmid = None if citation is None or citation.PMID is None else citation.PMID.text.strip()
+            article_q.put((str(article), pmid))
+        article_q.signal(_SIGNALS.COMPLETED_FILE)
         result = f_q.get()
-    for _ in range(n_halts):
-        article_q.put(_SIGNALS.HALT)
+    article_q.flush()
+    profiling.stop()
+    metrics.stopStage()
 
-def _t_getTitleAndAbstract(article_q, corpus_q):
-    result = article_q.get()
-    while result != _SIGNALS.HALT:
-        if result == _SIGNALS.COMPLETED_FILE:
-            corpus_q.put(result)
-        else:
-            article = BeautifulSoup(result, 'lxml-xml')
+def _t_getTitleAndAbstract(article_q, corpus_q, sink=None, shard_id=0, stats_outf=None, pipeline_metrics=None,
+        profiles=None):
+    metrics.startStage(pipeline_metrics, 'extractor', shard_id)
+    profiling.start(profiles, 'extractor', shard_id)
+    shard = _openShard(sink, shard_id)
+    stats = _openStats(stats_outf)
+    halted = False
+    while not halted:
+        (results, signals) = article_q.getBatch()
+        for (signal, count) in signals.items():
+            corpus_q.signal(signal, count)
+        for result in results:
+            if result == _SIGNALS.HALT:
+                halted = True
+                break
+            (article, pmid) = result
+            article = BeautifulSoup(article, 'lxml-xml')
             title = article.find('ArticleTitle').text
             abstract = article.find('Abstract')
             if abstract:
                 abstract = abstract.find('AbstractText')
                 if abstract:
                     abstract = abstract.text.replace('\n', ' ')
-            corpus_q.put((title, abstract))
-        result = article_q.get()
+            _outputRecord((title, abstract, pmid), corpus_q, shard, stats)
+    _saveStats(stats, stats_outf, shard_id)
+    _closeShard(shard, corpus_q)
+    profiling.stop()
+    metrics.stopStage()
 
-def _t_writeCorpus(corpus_q, num_files, outf):
+def _t_writeCorpus(corpus_q, num_files, sink, sharded=False, pipeline_metrics=None, profiles=None, index=False):
+    metrics.startStage(pipeline_metrics, 'writer')
+    profiling.start(profiles, 'writer')
     completed_files, success, failure = 0, 0, 0
     log.track(message='  >> Article progress -- Success: {1}  Errors: {2}  GZs Completed: {3}/%d' % num_files, writeInterval=10)
-    with codecs.open(outf, 'w', 'utf-8') as stream:
-        result = corpus_q.get()
-        while result != _SIGNALS.HALT:
-            if result == _SIGNALS.COMPLETED_FILE:
-                completed_files += 1
-            elif result == _SIGNALS.FAILURE:
-                failure += 1
-            else:
-                (title, abstract) = result
-                stream.write('%s\n' % title)
-                if abstract:
-                    stream.write('%s\n' % abstract)
-                success += 1
+    # when sharding, records are written by the producers and only counted here
+    stream = None if sharded else sink.open()
+    doc_index = docindex.DocumentIndexWriter(sink.outf) if index else None
+    halted = False
+    while not halted:
+        (results, signals) = corpus_q.getBatch()
+        completed_files += signals.get(_SIGNALS.COMPLETED_FILE, 0)
+        failure += signals.get(_SIGNALS.FAILURE, 0)
+        if signals.get(_SIGNALS.WRITTEN, 0) > 0:
+            success += signals[_SIGNALS.WRITTEN]
+            log.tick(success, failure, completed_files)
+        for result in results:
+            if result == _SIGNALS.HALT:
+                halted = True
+                break
+            _writeRecord(stream, result, doc_index)
+            success += 1
             log.tick(success, failure, completed_files)
-            result = corpus_q.get()
+    if not stream is None: stream.close()
+    if not doc_index is None: doc_index.close()
     log.flushTracker()
+    profiling.stop()
+    metrics.stopStage()
 
     log.writeln('\nDone processing!')
     log.writeln('Final statistics:')
     log.writeln('  XML files: %d/%d' % (completed_files, num_files))
     log.writeln('  Successful abstracts: %d' % success)
     log.writeln('  Error abstracts: %d' % failure)
-    log.writeln('\nOutput written to %s' % outf)
+    log.writeln('\nOutput written to %s' % (
+        outputsink.manifestPath(sink.outf) if sharded
+        else outputsink.compressedPath(sink.outf, sink.compression)))
 
-def generateCorpus(dirpath, outf, gz_threads=2, extract_threads=4):
-    success, errors = 0, 0
-    gzs = glob.glob(os.path.join(dirpath, 'medline*.xml.gz'))
+_Extractors = collections.namedtuple('_Extractors', ['article_q', 'gz_processes', 'extract_processes'])
 
-    log.writeln('Extracting records from %d .gz files' % len(gzs))
-
-    f_q, article_q, corpus_q = mp.Queue(), mp.Queue(), mp.Queue()
-    gz_processes = []
-    for i in range(gz_threads):
-        n_halts = extract_threads if i == 0 else 0
-        gz_processes.append(mp.Process(target=_t_getArticles, args=(f_q, article_q, n_halts)))
-    extract_processes = [
-        mp.Process(target=_t_getTitleAndAbstract, args=(article_q, corpus_q))
-            for _ in range(extract_threads)
-    ]
-    write_process = mp.Process(target=_t_writeCorpus, args=(corpus_q, len(gzs), outf))
+def _startExtractors(gzs, corpus_q, gz_threads, extract_threads, engine, batch_size, flush_interval, queue_capacity,
+        shard_sink=None, stats_outf=None, pipeline_metrics=None, profiles=None):
+    '''Starts the processes extracting (title, abstract) records from gzs
+    to corpus_q (see generateCorpus), and returns them as _Extractors.
+    '''
+    f_q = mp.Queue()
+    article_q = batchqueue.BatchQueue(batch_size=batch_size, flush_interval=flush_interval, capacity=queue_capacity,
+        name='articles')
+    if engine == 'lxml':
+        gz_processes = [
+            mp.Process(target=_t_streamTitlesAndAbstracts, args=(f_q, corpus_q, shard_sink, i, stats_outf, pipeline_metrics,
+                profiles))
+                for i in range(gz_threads)
+        ]
+        extract_processes = []
+    else:
+        gz_processes = [
+            mp.Process(target=_t_getArticles, args=(f_q, article_q, pipeline_metrics, i, profiles))
+                for i in range(gz_threads)
+        ]
+        extract_processes = [
+            mp.Process(target=_t_getTitleAndAbstract, args=(article_q, corpus_q, shard_sink, i, stats_outf, pipeline_metrics,
+                profiles))
+                for i in range(extract_threads)
+        ]
 
     for gzf in gzs:
         f_q.put(gzf)
+    for _ in gz_processes:
+        f_q.put(_SIGNALS.HALT)
 
     for t in gz_processes:
         t.start()
     for t in extract_processes:
         t.start()
+    return _Extractors(article_q, gz_processes, extract_processes)
+
+def _haltExtractors(extractors, corpus_q):
+    '''Waits for the extracting processes to finish, then sends HALT to
+    the consumer of corpus_q.
+    '''
+    # halt the extractors only once every reader is done
+    for t in extractors.gz_processes:
+        t.join()
+    for _ in extractors.extract_processes:
+        extractors.article_q.send(_SIGNALS.HALT)
+    for t in extractors.extract_processes:
+        t.join()
+    corpus_q.send(_SIGNALS.HALT)
+
+def generateCorpus(dirpath, outf, gz_threads=2, extract_threads=4, engine='lxml',
+        batch_size=batchqueue.DEFAULT_BATCH_SIZE, flush_interval=batchqueue.DEFAULT_FLUSH_INTERVAL,
+        queue_capacity=batchqueue.DEFAULT_CAPACITY, pattern=DEFAULT_PATTERN,
+        sharded=False, merge=False, compression='none', output_format='text', stats=False,
+        pipeline_metrics=None, profiles=None, index=False):
+    '''Extracts titles and abstracts from the .xml.gz files in dirpath
+    matching pattern, and writes them to outf.
+
+    engine :: 'lxml' (default) to stream each file with an incremental
+              parser in the gz_threads reader processes, which send
+              (title, abstract) tuples straight to the writer; or 'soup' to
+              parse each file with BeautifulSoup and extract titles and
+              abstracts in extract_threads separate processes
+
+    batch_size, flush_interval and queue_capacity configure the
+    inter-process queues (see utils.batchqueue.BatchQueue)
+
+    If sharded is True, the processes extracting titles and abstracts each
+    write their own shard of outf, listed in outf.shards.json (see
+    utils.outputsink), and merged into outf if merge is True.  Output is
+    compressed with gzip or xz if compression says so, or written as a
+    token-ID corpus (one document per record) if output_format is 'ids'.
+
+    If stats is True, the processes extracting titles and abstracts collect
+    corpus statistics (one document per record), merged into outf.stats.json
+    and outf.stats.tsv (see utils.corpusstats).
+
+    If index is True, the byte offset, length and PMID of each record are
+    saved in outf.docidx, for random access with utils.docindex (requires
+    uncompressed, unsharded text output to a file).
+
+    If pipeline_metrics (a utils.metrics.PipelineMetrics) is given, each
+    process records metrics for its stage ("reader", "extractor" or
+    "writer"), summarized once all are done.  If profiles (a
+    utils.profiling.ProcessProfiles) is given, each process is profiled,
+    and the profiles of each stage are merged once all are done.
+    '''
+    if not engine in ENGINES:
+        raise ValueError('Unknown extraction engine "%s"' % engine)
+    if index and (sharded or compression != 'none' or output_format != 'text' or outf == outputsink.STDOUT):
+        raise ValueError('Indexed output must be a single uncompressed text file')
+    sink = outputsink.OutputSink(outf, compression=compression, format=output_format)
+    shard_sink = sink if sharded else None
+    stats_outf = outf if stats else None
+    if stats:
+        corpusstats.clearPartials(outf)
+    if sharded:
+        sink.clearCounts()
+    gzs = glob.glob(os.path.join(dirpath, pattern))
+
+    log.writeln('Extracting records from %d .gz files' % len(gzs))
+
+    corpus_q = batchqueue.BatchQueue(batch_size=batch_size, flush_interval=flush_interval, capacity=queue_capacity,
+        name='corpus')
+    if not pipeline_metrics is None:
+        pipeline_metrics.clear()
+    if not profiles is None:
+        profiles.clear()
+    extractors = _startExtractors(gzs, corpus_q, gz_threads, extract_threads, engine, batch_size, flush_interval,
+        queue_capacity, shard_sink, stats_outf, pipeline_metrics, profiles)
+    write_process = mp.Process(target=_t_writeCorpus, args=(corpus_q, len(gzs), sink, sharded, pipeline_metrics,
+        profiles, index))
     write_process.start()
 
+    _haltExtractors(extractors, corpus_q)
+    write_process.join()
+
+    if sharded:
+        sink.writeManifest()
+        if merge:
+            log.writeln('Merged shards into %s' % sink.merge())
+    if stats:
+        corpusstats.mergePartials(outf)
+        log.writeln('Wrote corpus statistics to %s' % corpusstats.reportPath(outf))
+    if not pipeline_metrics is None:
+        metrics.logSummary(pipeline_metrics.path)
+    if not profiles is None:
+        profiling.merge(profiles)
+
+def iterCorpus(dirpath, gz_threads=2, extract_threads=4, engine='lxml',
+        batch_size=batchqueue.DEFAULT_BATCH_SIZE, flush_interval=batchqueue.DEFAULT_FLUSH_INTERVAL,
+        queue_capacity=batchqueue.DEFAULT_CAPACITY, pattern=DEFAULT_PATTERN):
+    '''Extracts titles and abstracts from the .xml.gz files in dirpath
+    matching pattern with the same processes as generateCorpus, and yields
+    them as (title, abstract) tuples (abstract is None if the article has
+    none), in the order they are extracted.
+
+    Articles with no title are skipped.  If the caller stops iterating
+    early, the extracting processes are terminated.
+    '''
+    if not engine in ENGINES:
+        raise ValueError('Unknown extraction engine "%s"' % engine)
+    gzs = glob.glob(os.path.join(dirpath, pattern))
+    corpus_q = batchqueue.BatchQueue(batch_size=batch_size, flush_interval=flush_interval, capacity=queue_capacity,
+        name='corpus')
+    extractors = _startExtractors(gzs, corpus_q, gz_threads, extract_threads, engine, batch_size, flush_interval,
+        queue_capacity)
+    # records are consumed here, so wait for the extractors in the background
+    halter = threading.Thread(target=_haltExtractors, args=(extractors, corpus_q))
+    halter.daemon = True
+    halter.start()
+
+    halted = False
+    try:
+        while not halted:
+            (results, _) = corpus_q.getBatch()
+            for result in results:
+                if result == _SIGNALS.HALT:
+                    halted = True
+                    break
+                yield result[:2]
+        halter.join()
+    finally:
+        if not halted:
+            for t in extractors.gz_processes + extractors.extract_processes:
+                t.terminate()
+                t.join()
+            extractors.article_q.abandon()
+            corpus_q.abandon()
+
+## Incremental processing #############################################
+
+def _manifestPath(outf):
+    return '%s.manifest.json' % outf
+
+def _indexPath(outf):
+    return '%s.pmids' % outf
+
+def _readManifest(outf):
+    if os.path.isfile(_manifestPath(outf)) and os.path.isfile(outf):
+        with open(_manifestPath(outf), 'r') as stream:
+            return json.load(stream)
+    return {'files': {}, 'records': 0}
+
+def _fileChecksum(path):
+    # NLM distributes an MD5(name)= hex sidecar next to each file; only
+    # hash the file ourselves if it's missing
+    if os.path.isfile('%s.md5' % path):
+        with open('%s.md5' % path, 'r') as stream:
+            return stream.read().strip().split('=')[-1].strip()
+    md5 = hashlib.md5()
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(1024*1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def _isProcessed(manifest, path):
+    entry = manifest['files'].get(os.path.basename(path), None)
+    if entry is None or entry['size'] != os.path.getsize(path):
+        return False
+    if os.path.isfile('%s.md5' % path):
+        return entry['md5'] == _fileChecksum(path)
+    return True
+
+def _t_streamCitationUpdates(f_q, corpus_q, profiles=None, reader_id=0):
+    profiling.start(profiles, 'reader', reader_id)
+    result = f_q.get()
+    while result != _SIGNALS.HALT:
+        (file_ix, gzf) = result
+        with gzip.open(gzf, 'rb') as stream:
+            for (pmid, record) in iterCitationUpdates(stream):
+                if record is DELETED:
+                    corpus_q.signal(_SIGNALS.DELETED)
+                    corpus_q.put((file_ix, pmid, None))
+                elif record is None:
+                    # still supersedes any earlier version of the citation
+                    corpus_q.signal(_SIGNALS.FAILURE)
+                    corpus_q.put((file_ix, pmid, None))
+                else:
+                    corpus_q.put((file_ix, pmid, record))
+        corpus_q.signal(_SIGNALS.COMPLETED_FILE)
+        result = f_q.get()
+    corpus_q.flush()
+    profiling.stop()
+
+def _formatRecord(title, abstract):
+    if abstract:
+        return ('%s\n%s\n' % (title, abstract)).encode('utf-8')
+    return ('%s\n' % title).encode('utf-8')
+
+def _t_writeDelta(corpus_q, num_files, outf, indexf, profiles=None):
+    profiling.start(profiles, 'writer')
+    completed_files, success, failure, deleted = 0, 0, 0, 0
+    log.track(message='  >> Citation progress -- Success: {1}  Errors: {2}  Deleted: {3}  GZs Completed: {4}/%d' % num_files, writeInterval=10)
+    offset = 0
+    with open(outf, 'wb') as stream, open(indexf, 'w') as index_stream:
+        halted = False
+        while not halted:
+            (results, signals) = corpus_q.getBatch()
+            completed_files += signals.get(_SIGNALS.COMPLETED_FILE, 0)
+            failure += signals.get(_SIGNALS.FAILURE, 0)
+            deleted += signals.get(_SIGNALS.DELETED, 0)
+            for result in results:
+                if result == _SIGNALS.HALT:
+                    halted = True
+                    break
+                (file_ix, pmid, record) = result
+                # records with no output are indexed with length -1
+                if record is None:
+                    index_stream.write('%s\t%d\t%d\t%d\n' % (pmid, file_ix, offset, -1))
+                else:
+                    data = _formatRecord(*record)
+                    stream.write(data)
+                    index_stream.write('%s\t%d\t%d\t%d\n' % (pmid, file_ix, offset, len(data)))
+                    offset += len(data)
+                    success += 1
+                log.tick(success, failure, deleted, completed_files)
+    log.flushTracker(success, failure, deleted, completed_files)
+    profiling.stop()
+
+def _applyDelta(outf, delta_outf, delta_indexf):
+    '''Rewrites outf (and its PMID index) without any citations that appear
+    in the delta, then appends the latest version of each delta citation.
+
+    Returns the number of records in the new outf.
+    '''
+    # latest delta entry for each PMID, by file order then write order
+    latest = {}
+    with open(delta_indexf, 'r') as stream:
+        for (i, line) in enumerate(stream):
+            (pmid, file_ix, offset, length) = line.split('\t')
+            latest[pmid] = max(latest.get(pmid, (-1, -1)), (int(file_ix), i))
+
+    tmp_outf, tmp_indexf = '%s.tmp' % outf, '%s.tmp' % _indexPath(outf)
+    n_kept, n_added = 0, 0
+    with open(tmp_outf, 'wb') as out_stream, open(tmp_indexf, 'w') as index_stream:
+        new_offset = 0
+
+        # copy over existing records that weren't revised or deleted
+        if os.path.isfile(_indexPath(outf)):
+            with open(outf, 'rb') as old_stream, open(_indexPath(outf), 'r') as old_index:
+                for line in old_index:
+                    (pmid, offset, length) = line.split('\t')
+                    offset, length = int(offset), int(length)
+                    if pmid in latest: continue
+                    if old_stream.tell() != offset: old_stream.seek(offset)
+                    out_stream.write(old_stream.read(length))
+                    index_stream.write('%s\t%d\t%d\n' % (pmid, new_offset, length))
+                    new_offset += length
+                    n_kept += 1
+
+        # and append the new versions
+        with open(delta_outf, 'rb') as delta_stream, open(delta_indexf, 'r') as delta_index:
+            for (i, line) in enumerate(delta_index):
+                (pmid, file_ix, offset, length) = line.split('\t')
+                offset, length = int(offset), int(length)
+                if length < 0 or latest[pmid] != (int(file_ix), i): continue
+                if delta_stream.tell() != offset: delta_stream.seek(offset)
+                out_stream.write(delta_stream.read(length))
+                index_stream.write('%s\t%d\t%d\n' % (pmid, new_offset, length))
+                new_offset += length
+                n_added += 1
+
+    os.replace(tmp_outf, outf)
+    os.replace(tmp_indexf, _indexPath(outf))
+    log.writeln('Kept %d existing records; added %d new or revised records' % (n_kept, n_added))
+    return n_kept + n_added
+
+def updateCorpus(dirpaths, outf, gz_threads=2, batch_size=batchqueue.DEFAULT_BATCH_SIZE,
+        flush_interval=batchqueue.DEFAULT_FLUSH_INTERVAL, queue_capacity=batchqueue.DEFAULT_CAPACITY,
+        pattern=DEFAULT_PATTERN, profiles=None):
+    '''Incrementally brings outf up to date with the .xml.gz files matching
+    pattern in dirpaths (e.g., the baseline and updatefiles directories).
+
+    Alongside outf, keeps a manifest of processed files (outf.manifest.json;
+    name, size and MD5 checksum) and an index of the PMID, byte offset and
+    length of each output record (outf.pmids).  Only files not already in
+    the manifest are parsed; citations in them replace any earlier version
+    in outf, and citations listed in <DeleteCitation> are removed.
+
+    Files are applied in filename order, so later update files win.
+
+    If profiles (a utils.profiling.ProcessProfiles) is given, the reader and
+    writer processes are profiled.
+    '''
+    manifest = _readManifest(outf)
+    gzs = []
+    for dirpath in dirpaths:
+        gzs.extend(glob.glob(os.path.join(dirpath, pattern)))
+    gzs.sort(key=os.path.basename)
+    new_gzs = [gzf for gzf in gzs if not _isProcessed(manifest, gzf)]
+
+    log.writeln('%d/%d .gz files already processed' % (len(gzs) - len(new_gzs), len(gzs)))
+    if len(new_gzs) == 0:
+        log.writeln('Corpus at %s is up to date.' % outf)
+        return
+    log.writeln('Extracting records from %d new .gz files' % len(new_gzs))
+
+    delta_outf, delta_indexf = '%s.delta' % outf, '%s.delta.pmids' % outf
+    if not profiles is None:
+        profiles.clear()
+    f_q = mp.Queue()
+    corpus_q = batchqueue.BatchQueue(batch_size=batch_size, flush_interval=flush_interval, capacity=queue_capacity)
+    gz_processes = [
+        mp.Process(target=_t_streamCitationUpdates, args=(f_q, corpus_q, profiles, i))
+            for i in range(gz_threads)
+    ]
+    write_process = mp.Process(target=_t_writeDelta, args=(corpus_q, len(new_gzs), delta_outf, delta_indexf, profiles))
+
+    for (file_ix, gzf) in enumerate(new_gzs):
+        f_q.put((file_ix, gzf))
     for _ in gz_processes:
         f_q.put(_SIGNALS.HALT)
 
+    for t in gz_processes:
+        t.start()
+    write_process.start()
     for t in gz_processes:
         t.join()
-    for t in extract_processes:
-        t.join()
-
-    corpus_q.put(_SIGNALS.HALT)
+    corpus_q.send(_SIGNALS.HALT)
     write_process.join()
+    if not profiles is None:
+        profiling.merge(profiles)
+
+    t_sub = log.startTimer('Applying new records to %s...' % outf)
+    manifest['records'] = _applyDelta(outf, delta_outf, delta_indexf)
+    log.stopTimer(t_sub, message='Done ({0:.2f}s)')
+    os.remove(delta_outf)
+    os.remove(delta_indexf)
+
+    for gzf in new_gzs:
+        manifest['files'][os.path.basename(gzf)] = {
+            'size': os.path.getsize(gzf),
+            'md5': _fileChecksum(gzf)
+        }
+    with open('%s.tmp' % _manifestPath(outf), 'w') as stream:
+        json.dump(manifest, stream, indent=1, sort_keys=True)
+    os.replace('%s.tmp' % _manifestPath(outf), _manifestPath(outf))
+    log.writeln('\nOutput written to %s (%d records)' % (outf, manifest['records']))
+
 
 if __name__ == '__main__':
     def _cli():
@@ -120,7 +642,13 @@ if __name__ == '__main__':
         parser = optparse.OptionParser(usage='Usage: %prog GZ_DIR FILEPATH',
                 description='Extractes titles and abstracts from the PubMed'
                             ' Baseline .xml.gz files in GZ_DIR and writes them'
-                            ' to FILEPATH.')
+                            ' to FILEPATH (- for standard output; logging then'
+                            ' goes to standard error).')
+        parser.add_option('--engine', dest='engine',
+                type='choice', choices=ENGINES, default='lxml',
+                help='XML parsing engine to use: "lxml" (streaming parser; titles and'
+                     ' abstracts are extracted by the read threads) or "soup"'
+                     ' (BeautifulSoup; slow) (default: %default)')
         parser.add_option('--read-threads', dest='read_threads',
                 type='int', default=1,
                 help='number of threads to use for loading .xml.gz files and extracting'
@@ -128,7 +656,67 @@ if __name__ == '__main__':
         parser.add_option('--extract-threads', dest='extract_threads',
                 type='int', default=3,
                 help='number of threads to use for extracting titles and abstracts from'
-                     ' individual articles (default: %default)')
+                     ' individual articles; only used with --engine=soup (default: %default)')
+        parser.add_option('--batch-size', dest='batch_size',
+                type='int', default=batchqueue.DEFAULT_BATCH_SIZE,
+                help='number of items to send between processes at a time (default: %default)')
+        parser.add_option('--flush-interval', dest='flush_interval',
+                type='float', default=batchqueue.DEFAULT_FLUSH_INTERVAL,
+                help='maximum number of seconds to hold a partial batch (default: %default)')
+        parser.add_option('--queue-capacity', dest='queue_capacity',
+                type='int', default=batchqueue.DEFAULT_CAPACITY,
+                help='maximum number of batches waiting in each queue (default: %default)')
+        parser.add_option('--shard', dest='sharded',
+                action='store_true', default=False,
+                help='have each extracting process write its own shard (FILEPATH.000,'
+                     ' FILEPATH.001, ...), listed in FILEPATH.shards.json, instead of'
+                     ' sending records to a single writer process')
+        parser.add_option('--merge', dest='merge',
+                action='store_true', default=False,
+                help='with --shard, merge the shards into FILEPATH when done')
+        parser.add_option('--format', dest='output_format',
+                type='choice', choices=outputsink.FORMATS, default='text',
+                help='output format: "text", or "ids" for a token-ID corpus (FILEPATH.vocab,'
+                     ' FILEPATH.ids, ...; see utils/tokenids.py) (default: %default)')
+        parser.add_option('--stats', dest='stats',
+                action='store_true', default=False,
+                help='collect corpus statistics in the extracting processes, and write'
+                     ' them to FILEPATH.stats.json and FILEPATH.stats.tsv (see'
+                     ' utils/corpusstats.py; not used with --incremental)')
+        parser.add_option('--compression', dest='compression',
+                type='choice', choices=outputsink.COMPRESSIONS, default='none',
+                help='compression for the output file or shards: "none", "gzip" or "xz"'
+                     ' (adds .gz/.xz to file names; not used with --incremental)'
+                     ' (default: %default)')
+        parser.add_option('--index', dest='index',
+                action='store_true', default=False,
+                help='save the byte offset, length and PMID of each record in FILEPATH.docidx,'
+                     ' for random access with utils/docindex.py (uncompressed, unsharded'
+                     ' text output only; not used with --incremental)')
+        parser.add_option('--pattern', dest='pattern',
+                default=DEFAULT_PATTERN,
+                help='glob pattern for .xml.gz files to read (default: %default)')
+        parser.add_option('--incremental', dest='incremental',
+                action='store_true', default=False,
+                help='only process files not yet recorded in the manifest next to FILEPATH,'
+                     ' replacing revised citations and dropping deleted ones (always uses'
+                     ' the lxml engine)')
+        parser.add_option('--updates', dest='updates_dir',
+                default=None,
+                help='with --incremental, directory of PubMed update files to apply'
+                     ' after the files in GZ_DIR')
+        parser.add_option('--metrics', dest='metrics',
+                help='JSON-lines file to record per-stage pipeline metrics (items, bytes,'
+                     ' time blocked on queues, queue depths) in, summarized at the end'
+                     ' of the run (see utils/metrics.py; not used with --incremental)')
+        parser.add_option('--metrics-interval', dest='metrics_interval',
+                type='float', default=metrics.DEFAULT_INTERVAL,
+                help='seconds between metrics records from each process (default: %default)')
+        parser.add_option('--profile', dest='profile',
+                help='profile each reader, extractor and writer process with cProfile,'
+                     ' and merge the profiles of each stage into PROFILE.STAGE.prof,'
+                     ' with the top functions of each stage listed in PROFILE.txt'
+                     ' (see utils/profiling.py)')
         parser.add_option('-l', '--logfile', dest='logfile',
                 help='name of file to write log contents to (empty for stdout)',
                 default=None)
@@ -136,12 +724,48 @@ if __name__ == '__main__':
         if len(args) != 2:
             parser.print_help()
             exit()
+        if args[1] == outputsink.STDOUT and (options.incremental or options.sharded or options.stats
+                or options.index):
+            parser.error('--incremental, --shard, --stats and --index need an output file')
+        if options.index and (options.sharded or options.compression != 'none' or options.output_format != 'text'):
+            parser.error('--index needs uncompressed, unsharded text output')
         return args, options
 
     (gz_dir, outf), options = _cli()
-    generateCorpus(
-        gz_dir, 
-        outf,
-        gz_threads=options.read_threads,
-        extract_threads=options.extract_threads
-    )
+    if outf == outputsink.STDOUT:
+        outputsink.claimStdout()
+    profiles = None if options.profile is None else profiling.ProcessProfiles(options.profile)
+    if options.incremental:
+        dirpaths = [gz_dir]
+        if options.updates_dir: dirpaths.append(options.updates_dir)
+        updateCorpus(
+            dirpaths,
+            outf,
+            gz_threads=options.read_threads,
+            batch_size=options.batch_size,
+            flush_interval=options.flush_interval,
+            queue_capacity=options.queue_capacity,
+            pattern=options.pattern,
+            profiles=profiles
+        )
+    else:
+        generateCorpus(
+            gz_dir, 
+            outf,
+            gz_threads=options.read_threads,
+            extract_threads=options.extract_threads,
+            engine=options.engine,
+            batch_size=options.batch_size,
+            flush_interval=options.flush_interval,
+            queue_capacity=options.queue_capacity,
+            pattern=options.pattern,
+            sharded=options.sharded,
+            merge=options.merge,
+            compression=options.compression,
+            output_format=options.output_format,
+            stats=options.stats,
+            index=options.index,
+            pipeline_metrics=None if options.metrics is None else metrics.PipelineMetrics(
+                options.metrics, interval=options.metrics_interval),
+            profiles=profiles
+        )
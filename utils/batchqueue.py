@@ -0,0 +1,137 @@
+'''
+Batching wrapper around multiprocessing.Queue, to cut per-item pickling and
+pipe overhead in multi-process pipelines.
+
+Items put on a BatchQueue are buffered in the sending process and sent as one
+list once batch_size items are waiting or flush_interval seconds have passed
+since the last send.  Progress signals (e.g., "document complete") are counted
+inside each batch instead of being sent as separate messages.  The underlying
+queue holds at most capacity batches, so senders block when consumers fall
+behind.
+
+Each process has its own send buffer, so every sending process must call
+flush() when it is done sending.
+
+If the process is recording pipeline metrics (see utils.metrics), items and
+time blocked on sends and receives are counted under the queue's name.
+'''
+
+import collections
+import multiprocessing as mp
+import time
+from . import metrics
+
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_CAPACITY = 64
+
+class BatchQueue:
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+            capacity=DEFAULT_CAPACITY, name='queue'):
+        '''
+        batch_size     :: maximum number of items to buffer before sending
+        flush_interval :: maximum number of seconds to hold buffered items
+                          (checked on each put/signal call)
+        capacity       :: maximum number of batches waiting in the queue
+        name           :: name to record metrics for this queue under
+        '''
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.name = name
+        self._queue = mp.Queue(maxsize=capacity)
+        self._resetBuffers()
+
+    def _resetBuffers(self):
+        self._items, self._signals = [], {}
+        self._last_flush = time.time()
+        self._received = collections.deque()
+        self.received_signals = collections.Counter()
+
+    # buffers are per-process; don't copy them into child processes
+    def __getstate__(self):
+        return (self.batch_size, self.flush_interval, self.name, self._queue)
+    def __setstate__(self, state):
+        (self.batch_size, self.flush_interval, self.name, self._queue) = state
+        self._resetBuffers()
+
+    def _send(self, batch):
+        recorder = metrics.active()
+        if recorder is None:
+            self._queue.put(batch)
+        else:
+            start = time.time()
+            self._queue.put(batch)
+            recorder.recordPut(self, len(batch[0]), metrics.itemBytes(batch[0]), time.time() - start)
+
+    def _receive(self):
+        recorder = metrics.active()
+        if recorder is None:
+            return self._queue.get()
+        start = time.time()
+        batch = self._queue.get()
+        recorder.recordGet(self, len(batch[0]), metrics.itemBytes(batch[0]), time.time() - start)
+        return batch
+
+    def depth(self):
+        '''Returns the approximate number of batches waiting, or None where
+        the platform can't tell.
+        '''
+        try:
+            return self._queue.qsize()
+        except NotImplementedError:
+            return None
+
+    def put(self, item):
+        self._items.append(item)
+        self._flushIfDue()
+
+    def signal(self, signal, count=1):
+        '''Counts count occurrences of signal in the current batch.'''
+        self._signals[signal] = self._signals.get(signal, 0) + count
+        self._flushIfDue()
+
+    def _flushIfDue(self):
+        if (len(self._items) >= self.batch_size
+                or (time.time() - self._last_flush) >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        '''Sends any buffered items and signals, blocking if the queue is full.'''
+        if len(self._items) > 0 or len(self._signals) > 0:
+            self._send((self._items, self._signals))
+            self._items, self._signals = [], {}
+        self._last_flush = time.time()
+
+    def send(self, item):
+        '''Flushes the current batch, then sends item in a batch of its own.
+
+        Use for control items (e.g., halt signals) that must reach exactly one
+        consumer.
+        '''
+        self.flush()
+        self._send(([item], {}))
+
+    def abandon(self):
+        '''Lets this process exit without waiting for batches it has sent to
+        be read, e.g. once the consuming processes have been terminated.
+        '''
+        self._queue.cancel_join_thread()
+
+    def getBatch(self):
+        '''Blocks until a batch is available, and returns it as a tuple of
+        (list of items, dict of signal counts).
+        '''
+        return self._receive()
+
+    def get(self):
+        '''Returns the next single item, blocking if none is available.
+
+        Signal counts from batches read this way are added to
+        self.received_signals.
+        '''
+        while len(self._received) == 0:
+            (items, signals) = self._receive()
+            self._received.extend(items)
+            self.received_signals.update(signals)
+        return self._received.popleft()
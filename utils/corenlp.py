@@ -1,7 +1,21 @@
 '''
 Wrappers for using Stanford CoreNLP to sentence split and tokenize.
 
-Requires python-stanford-corenlp Python package.
+Tokenization runs through a backend: 'corenlp' (default) uses a CoreNLP
+server per tokenization thread, and 'regex' uses the pure-Python
+approximation in utils.ptbtokenizer, with no JVM.  Running this module as
+    python -m utils.corenlp --sample=FILE
+reports how closely the two agree on the lines of FILE.
+
+CoreNLP servers can be shared through a ServerPool, which starts servers
+once on free ports (or attaches to running ones), warms them up, and
+restarts any that die; tokenization threads given the pool's endpoints
+spread across its servers and fail over between them.  A pool shared by
+several jobs is run with
+    python -m utils.corenlp --serve-pool=FILE --servers=N
+and attached to from FILE (see ServerPool.load).
+
+The corenlp backend requires python-stanford-corenlp Python package.
   Github: https://github.com/stanfordnlp/python-stanford-corenlp (Requires some dependencies)
   Via pip: pip install stanford-corenlp
   Via pip from Github: pip install -U https://github.com/stanfordnlp/python-stanford-corenlp/archive/master.zip
@@ -10,72 +24,572 @@ Expects environment variable CORENLP_HOME to be defined.
 Requires Java SE 8 (minimum).
 '''
 
+import bisect
+import collections
+import fcntl
+import http.client
+import json
+import os
+import shlex
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.request
 import multiprocessing as mp
-import corenlp
+import difflib
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import corenlp
+    import requests
+except ImportError:
+    corenlp = None
 from drgriffis.common import preprocessing
 from drgriffis.common import log
 from . import punctuation
+from . import ptbtokenizer
+from . import corpusstats
+from . import metrics
+from . import profiling
+
+BACKENDS = ('corenlp', 'regex')
+
+# CoreNLP breaks sentences on two newlines by default, so batched inputs
+# never share a sentence
+_BATCH_SEPARATOR = '\n\n'
+DEFAULT_MAX_BATCH_CHARS = 50000
+
+DEFAULT_SERVER_COMMAND = ("java -Xmx{memory} -cp '{corenlp_home}/*' edu.stanford.nlp.pipeline.StanfordCoreNLPServer"
+    " -port {port} -timeout 15000 -threads 5 -maxCharLength 100000")
+DEFAULT_HEALTH_INTERVAL = 5.0
+DEFAULT_STARTUP_TIMEOUT = 120.0
+_WARM_UP_TEXT = 'This request loads the tokenizer.  It is sent before any real text.'
+# consecutive failed health checks before a live server process is restarted
+_MAX_FAILED_CHECKS = 3
+# consecutive server processes exiting while starting before a pool gives up
+_MAX_EARLY_EXITS = 3
+_MAX_PORT = 65535
+# seconds to avoid a server after a failed request
+_FAILOVER_DELAY = 5.0
+
+def _utf16Length(text):
+    # CoreNLP character offsets count Java (UTF-16) chars
+    return len(text.encode('utf-16-le')) // 2
+
+def _sentenceWords(sentence):
+    return [token.word for token in sentence.token]
+
+def annotateBatch(client, texts):
+    '''Tokenizes and sentence splits a list of texts with a single
+    annotation request, and returns a list (one per text) of lists of
+    sentences (lists of token strings).
+
+    Texts are joined with a blank line between each, and tokens are mapped
+    back to their text by character offset.
+    '''
+    if len(texts) == 1:
+        return [[_sentenceWords(sentence) for sentence in client.annotate(texts[0]).sentence]]
+
+    starts, offset = [], 0
+    for text in texts:
+        starts.append(offset)
+        offset += _utf16Length(text) + len(_BATCH_SEPARATOR)
+    annotated = client.annotate(_BATCH_SEPARATOR.join(texts))
+
+    results = [[] for _ in texts]
+    for sentence in annotated.sentence:
+        current_ix = None
+        for token in sentence.token:
+            ix = bisect.bisect_right(starts, token.beginChar) - 1
+            if ix != current_ix:
+                current_ix, words = ix, []
+                results[ix].append(words)
+            words.append(token.word)
+    return results
+
+class CoreNLPBackend:
+    '''Tokenizes with a CoreNLP server on host:port, started when the backend
+    is entered (unless start_server is False) and stopped when it exits.
+    '''
+
+    def __init__(self, port=9000, host='localhost', start_server=True):
+        if corenlp is None:
+            raise ImportError('The corenlp backend requires the python-stanford-corenlp package')
+        self._client = corenlp.client.CoreNLPClient(
+            start_server=start_server,
+            endpoint='http://%s:%d' % (host, port),
+            annotators=['tokenize','ssplit'],
+            stdout=open('/dev/null', 'w'),
+            stderr=open('/dev/null', 'w')
+        )
+
+    def __enter__(self):
+        self._client.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self._client.__exit__(*args)
+
+    def annotateBatch(self, texts):
+        return annotateBatch(self._client, texts)
+
+if not corenlp is None:
+    class _PoolClient(corenlp.client.CoreNLPClient):
+        # the pool checks server health, so skip the ping before every request
+        def ensure_alive(self):
+            pass
+
+def _isHealthy(endpoint, timeout=5):
+    try:
+        with urllib.request.urlopen('%s/ping' % endpoint, timeout=timeout) as response:
+            return response.status == 200
+    except (OSError, ValueError, http.client.HTTPException):
+        return False
+
+def _portIsFree(host, port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        # as servers do, so that recently closed connections don't count
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((host, port))
+            return True
+        except OSError:
+            return False
+
+def _claimPort(port):
+    '''Returns an open lock file claiming port for this process's pool, or
+    None if another pool holds it.  The claim lasts until the file is closed
+    or the process exits.
+    '''
+    stream = open(os.path.join(tempfile.gettempdir(), 'corenlp-pool-port-%d.lock' % port), 'w')
+    try:
+        fcntl.flock(stream, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        stream.close()
+        return None
+    return stream
+
+class _Server:
+
+    def __init__(self, endpoint, port=None, port_claim=None):
+        self.endpoint = endpoint
+        self.port = port
+        self.port_claim = port_claim
+        self.process = None
+        self.failed_checks = 0
+        self.restarts = 0
+
+class ServerPool:
+    '''A pool of CoreNLP servers, shared by the tokenization threads of one or
+    more jobs.
+
+    A pool either starts its own servers (start(); stopped by close()) or
+    attaches to running ones (attach() or load()).  Started servers get the
+    first free ports from start_port up, are sent a warm-up request before
+    the pool is used, and are checked every health_interval seconds by a
+    monitor thread, which restarts any whose process has died or which fail
+    several checks in a row.
+
+    Each port is claimed with a lock file (in the temporary directory) for
+    as long as the pool runs, so pools starting at the same time on one
+    machine never pick the same port; a server whose process exits while
+    starting (e.g., because another program bound its port first) is
+    replaced by one on the next free port.
+
+    command is the shell command to start a server with, formatted with
+    port, memory and corenlp_home (the CORENLP_HOME environment variable);
+    by default, a StanfordCoreNLPServer.  A stand-in server (see
+    benchmarks.standin) can be used for testing.
+    '''
+
+    def __init__(self, n_servers=1, start_port=9000, host='localhost', command=DEFAULT_SERVER_COMMAND,
+            memory='4G', health_interval=DEFAULT_HEALTH_INTERVAL, startup_timeout=DEFAULT_STARTUP_TIMEOUT):
+        self.n_servers = n_servers
+        self.start_port = start_port
+        self.host = host
+        self.command = command
+        self.memory = memory
+        self.health_interval = health_interval
+        self.startup_timeout = startup_timeout
+        self._servers = []
+        self._owned = False
+        self._stop = threading.Event()
+        self._monitor = None
+
+    @property
+    def endpoints(self):
+        return [server.endpoint for server in self._servers]
+
+    @staticmethod
+    def attach(endpoints):
+        '''Returns a pool of the already running servers at endpoints
+        (URLs, e.g. http://localhost:9000), which it will not restart or stop.
+        '''
+        pool = ServerPool(n_servers=len(endpoints))
+        for endpoint in endpoints:
+            pool._servers.append(_Server(endpoint.rstrip('/')))
+        return pool
+
+    @staticmethod
+    def load(path):
+        '''Attaches to the servers of the pool saved at path (see save).'''
+        with open(path, 'r') as stream:
+            return ServerPool.attach(json.load(stream)['endpoints'])
+
+    def save(self, path):
+        '''Writes the pool's endpoints to path, for other jobs to load.'''
+        with open('%s.tmp' % path, 'w') as stream:
+            json.dump({'endpoints': self.endpoints, 'pid': os.getpid()}, stream, indent=1)
+        os.replace('%s.tmp' % path, path)
+
+    def _launch(self, server):
+        command = self.command.format(port=server.port, memory=self.memory,
+            corenlp_home=os.getenv('CORENLP_HOME', ''))
+        server.process = subprocess.Popen(shlex.split(command),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        server.failed_checks = 0
+
+    def _waitUntilReady(self, server):
+        '''Returns True once server's process is running and its port
+        answers (and has been warmed up), or False if its process exits (e.g.,
+        because something else bound the port first) or startup_timeout
+        passes first.
+        '''
+        start = time.time()
+        while time.time() - start < self.startup_timeout:
+            if server.process.poll() is not None:
+                return False
+            if _isHealthy(server.endpoint):
+                with createBackend('corenlp', start_server=False, endpoints=[server.endpoint]) as tokenizer:
+                    tokenizer.annotateBatch([_WARM_UP_TEXT])
+                # whatever answered, the server isn't ours if its process died
+                return server.process.poll() is None
+            time.sleep(0.25)
+        return False
+
+    def _freePort(self, port):
+        '''Returns the first port from port up that is free and claimed
+        for this pool, and its claim.
+        '''
+        taken = set([server.port for server in self._servers])
+        while True:
+            if port > _MAX_PORT:
+                raise RuntimeError('No free port for a CoreNLP server from %d to %d' % (self.start_port, _MAX_PORT))
+            if not port in taken and _portIsFree(self.host, port):
+                claim = _claimPort(port)
+                if not claim is None:
+                    # the port may have been bound since it was checked
+                    if _portIsFree(self.host, port): return port, claim
+                    claim.close()
+            port += 1
 
-def _threadedTokenizer(input_q, output_q, port, sentence_split, to_lower, remove_punctuation, extra_ops, halt_signal, complete_op, complete_op_args):
+    def start(self):
+        '''Starts n_servers servers and the health monitor, and returns once
+        all servers are warmed up.
+        '''
+        if self.command == DEFAULT_SERVER_COMMAND and os.getenv('CORENLP_HOME') is None:
+            raise ValueError('Please define $CORENLP_HOME where your CoreNLP Java checkout is')
+        self._owned = True
+        port, early_exits = self.start_port, 0
+        try:
+            while len(self._servers) < self.n_servers:
+                (free_port, claim) = self._freePort(port)
+                server = _Server('http://%s:%d' % (self.host, free_port), free_port, claim)
+                self._launch(server)
+                if self._waitUntilReady(server):
+                    self._servers.append(server)
+                    early_exits = 0
+                    log.writeln('Started CoreNLP server at %s' % server.endpoint)
+                else:
+                    claim.close()
+                    if server.process.poll() is None:
+                        server.process.kill()
+                        server.process.wait()
+                        raise RuntimeError('CoreNLP server at %s did not start within %ds'
+                            % (server.endpoint, self.startup_timeout))
+                    # another program may have taken the port first, but if
+                    # server after server exits, the command itself is failing
+                    early_exits += 1
+                    if early_exits >= _MAX_EARLY_EXITS:
+                        raise RuntimeError('%d CoreNLP servers in a row exited while starting (last on port %d,'
+                            ' exit code %d); check the server command: %s' % (early_exits, server.port,
+                            server.process.returncode, self.command))
+                port = server.port + 1
+        except BaseException:
+            # stop any servers already started
+            self.close()
+            raise
+        self._monitor = threading.Thread(target=self._monitorServers, daemon=True)
+        self._monitor.start()
+        return self
+
+    def _monitorServers(self):
+        while not self._stop.wait(self.health_interval):
+            for server in self._servers:
+                if self._stop.is_set(): return
+                if server.process.poll() is None and _isHealthy(server.endpoint):
+                    server.failed_checks = 0
+                    continue
+                server.failed_checks += 1
+                if server.process.poll() is None and server.failed_checks < _MAX_FAILED_CHECKS:
+                    continue
+                log.writeln('CoreNLP server at %s is down; restarting' % server.endpoint)
+                if server.process.poll() is None:
+                    server.process.kill()
+                    server.process.wait()
+                self._launch(server)
+                server.restarts += 1
+                if not self._waitUntilReady(server):
+                    log.writeln('Restarting CoreNLP server at %s failed; will retry' % server.endpoint)
+
+    def status(self):
+        '''Returns a list of (endpoint, healthy, number of restarts).'''
+        return [(server.endpoint, _isHealthy(server.endpoint), server.restarts) for server in self._servers]
+
+    def close(self):
+        '''Stops the health monitor, and any servers the pool started.'''
+        self._stop.set()
+        if not self._monitor is None:
+            self._monitor.join()
+        if self._owned:
+            for server in self._servers:
+                if server.process.poll() is None:
+                    server.process.kill()
+                    server.process.wait()
+                server.port_claim.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class PooledBackend:
+    '''Tokenizes with the CoreNLP servers at endpoints (e.g., those of a
+    ServerPool), sending requests to endpoints[preferred % len(endpoints)]
+    and failing over to the others while it is unavailable.  Gives up on a
+    request once no server has answered for timeout seconds.
+    '''
+
+    def __init__(self, endpoints, preferred=0, timeout=DEFAULT_STARTUP_TIMEOUT):
+        if corenlp is None:
+            raise ImportError('The corenlp backend requires the python-stanford-corenlp package')
+        preferred = preferred % len(endpoints)
+        self._endpoints = endpoints[preferred:] + endpoints[:preferred]
+        self._clients = dict([
+            (endpoint, _PoolClient(
+                start_server=False,
+                endpoint=endpoint,
+                annotators=['tokenize','ssplit'],
+            ))
+                for endpoint in self._endpoints
+        ])
+        self._down_until = {}
+        self._timeout = timeout
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def annotateBatch(self, texts):
+        start = time.time()
+        while True:
+            now = time.time()
+            available = [e for e in self._endpoints if self._down_until.get(e, 0) <= now]
+            for endpoint in available:
+                try:
+                    return annotateBatch(self._clients[endpoint], texts)
+                except corenlp.client.TimeoutException:
+                    # the text is too long for any server
+                    raise
+                except (requests.exceptions.RequestException, corenlp.client.AnnotationException) as e:
+                    self._down_until[endpoint] = time.time() + _FAILOVER_DELAY
+                    log.writeln('[WARNING] Request to CoreNLP server at %s failed (%s); trying another' % (endpoint, e))
+            if time.time() - start >= self._timeout:
+                raise RuntimeError('No CoreNLP server answered for %ds' % self._timeout)
+            time.sleep(min(0.5, max(0, min(self._down_until.values()) - time.time())))
+
+class RegexBackend:
+    '''Tokenizes in-process with utils.ptbtokenizer.'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def annotateBatch(self, texts):
+        return [ptbtokenizer.tokenizeSentences(text) for text in texts]
+
+class CachedBackend:
+    '''Wraps another backend with a utils.tokencache.TokenizationCache, only
+    sending texts that aren't already cached to the wrapped backend.
+    '''
+
+    def __init__(self, backend, cache, name):
+        self._backend = backend
+        self._cache = cache
+        self._name = name
+
+    def __enter__(self):
+        self._backend.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        log.writeln('Tokenizer cache: %d hits, %d misses' % (self._cache.hits, self._cache.misses))
+        self._cache.close()
+        return self._backend.__exit__(*args)
+
+    def annotateBatch(self, texts):
+        keys = [self._cache.key(text, namespace=self._name) for text in texts]
+        cached = self._cache.getMany(keys)
+        missing = [i for i in range(len(texts)) if not keys[i] in cached]
+        if len(missing) > 0:
+            annotated = self._backend.annotateBatch([texts[i] for i in missing])
+            new_entries = []
+            for (i, sentences) in zip(missing, annotated):
+                cached[keys[i]] = sentences
+                new_entries.append((keys[i], sentences))
+            self._cache.putMany(new_entries)
+        return [cached[key] for key in keys]
+
+def createBackend(backend, port=9000, host='localhost', start_server=True, cache=None, endpoints=None,
+        server_ix=0):
+    '''Returns a (not yet entered) tokenization backend by name (see BACKENDS),
+    wrapped in a CachedBackend if cache (a TokenizationCache) is given.
+
+    If endpoints (a list of CoreNLP server URLs, e.g. ServerPool.endpoints)
+    is given, the corenlp backend is a PooledBackend preferring
+    endpoints[server_ix], and port, host and start_server are unused.
+    '''
+    if backend == 'corenlp' and not endpoints is None:
+        tokenizer = PooledBackend(endpoints, preferred=server_ix)
+    elif backend == 'corenlp':
+        tokenizer = CoreNLPBackend(port=port, host=host, start_server=start_server)
+    elif backend == 'regex':
+        tokenizer = RegexBackend()
+    else:
+        raise ValueError('Unknown tokenization backend "%s"' % backend)
+    if not cache is None:
+        tokenizer = CachedBackend(tokenizer, cache, backend)
+    return tokenizer
+
+def _readBatch(input_q, halt_signal, batch_size, max_batch_chars, keys=None):
+    '''Returns (batch of up to batch_size texts, True if halt_signal was read).
+
+    If keys is a list, input_q items are (key, text) pairs, and the key of
+    each text in the batch is appended to it.
+    '''
+    batch, n_chars = [], 0
+    while len(batch) < batch_size and n_chars < max_batch_chars:
+        result = input_q.get()
+        if result == halt_signal:
+            return batch, True
+        if not keys is None:
+            (key, result) = result
+            keys.append(key)
+        batch.append(preprocessing.digitsToZero(result))
+        n_chars += len(batch[-1])
+    return batch, False
+
+def _writeSentences(output_q, line_sentences, sentence_split, to_lower, remove_punctuation, extra_ops, stats=None,
+        key=None):
+    # if we're not splitting sentences, squash them all to one line here
+    if not sentence_split:
+        line_tokens = []
+        for sentence in line_sentences:
+            line_tokens.extend(sentence)
+        line_sentences = [line_tokens]
+
+    for sentence in line_sentences:
+        # execute any added operations here
+        if extra_ops:
+            for op in extra_ops:
+                sentence = op(sentence)
+
+        n_tokens = len(sentence)
+        if remove_punctuation:
+            sentence = punctuation.filterTokens(sentence)
+        if to_lower:
+            sentence =  [t.lower() for t in sentence]
+
+        if key is None:
+            output_q.put(' '.join(sentence))
+        else:
+            output_q.put((key, ' '.join(sentence)))
+        if not stats is None:
+            stats.addLine(sentence, removed=n_tokens-len(sentence))
+    if not stats is None and not sentence_split:
+        stats.endDocument()
+
+def _threadedTokenizer(input_q, output_q, port, sentence_split, to_lower, remove_punctuation, extra_ops, halt_signal, complete_op, complete_op_args,
+        batch_size=1, max_batch_chars=DEFAULT_MAX_BATCH_CHARS, requests_in_flight=1, start_server=True, host='localhost',
+        backend='corenlp', cache=None, output_sink=None, shard_id=0, stats_outf=None, pipeline_metrics=None, profiles=None,
+        endpoints=None, keyed=False):
     #log.writeln('[THREAD INIT] sentence_split: %s' % str(sentence_split))
     #log.writeln('[THREAD INIT] to_lower: %s' % str(to_lower))
     #log.writeln('[THREAD INIT] remove_punctuation: %s' % str(remove_punctuation))
+    metrics.startStage(pipeline_metrics, 'tokenizer', shard_id)
+    profiling.start(profiles, 'tokenizer', shard_id)
+    # write lines to this thread's own shard if sharding, else to output_q
+    lines = output_q if output_sink is None else output_sink.shard(shard_id)
+    # with sentence_split, input_q items need not be whole documents (e.g.,
+    # Gigaword paragraphs), so no document counts are kept
+    stats = None if stats_outf is None else corpusstats.CorpusStats(track_documents=not sentence_split)
+    def _writeBatch(batch_sentences, batch_keys):
+        # shards are plain text, so keys only go through output_q
+        if batch_keys is None or not output_sink is None:
+            batch_keys = [None for _ in batch_sentences]
+        for (line_sentences, key) in zip(batch_sentences, batch_keys):
+            _writeSentences(lines, line_sentences, sentence_split, to_lower, remove_punctuation, extra_ops, stats,
+                key)
+
     try:
-        i = 0
-        with corenlp.client.CoreNLPClient(
-                    start_server=True,
-                    endpoint='http://localhost:%d' % port,
-                    annotators=['tokenize','ssplit'],
-                    stdout=open('/dev/null', 'w'),
-                    stderr=open('/dev/null', 'w')
-                ) as client:
-            result = input_q.get()
-            while result != halt_signal:
-                normed_line = preprocessing.digitsToZero(result)
-                line_sentences = client.annotate(normed_line)
-
-                # extract strings from the data objects
-                line_sentences = [
-                    [token.word for token in sentence.token]
-                        for sentence in line_sentences.sentence
-                ]
-
-                # if we're not splitting sentences, squash them all to one line here
-                if not sentence_split:
-                    line_tokens = []
-                    for sentence in line_sentences:
-                        line_tokens.extend(sentence)
-                    line_sentences = [line_tokens]
-
-                for sentence in line_sentences:
-                    # execute any added operations here
-                    if extra_ops:
-                        for op in extra_ops:
-                            sentence = op(sentence)
-
-                    if remove_punctuation:
-                        sentence = punctuation.filterTokens(sentence)
-                    if to_lower:
-                        sentence =  [t.lower() for t in sentence]
-
-                    output_q.put(' '.join(sentence))
-
-                result = input_q.get()
-                i += 1
+        with createBackend(backend, port=port, host=host, start_server=start_server, cache=cache,
+                endpoints=endpoints, server_ix=shard_id) as tokenizer, \
+                ThreadPoolExecutor(max_workers=requests_in_flight) as executor:
+            # keep up to requests_in_flight requests open, and write their
+            # results in input order
+            pending = collections.deque()
+            halted = False
+            while not halted:
+                keys = [] if keyed else None
+                batch, halted = _readBatch(input_q, halt_signal, batch_size, max_batch_chars, keys)
+                if len(batch) > 0:
+                    pending.append((executor.submit(tokenizer.annotateBatch, batch), keys))
+                while len(pending) >= requests_in_flight or (halted and len(pending) > 0):
+                    (annotated, keys) = pending.popleft()
+                    _writeBatch(annotated.result(), keys)
     finally:
+        if not output_sink is None: lines.close()
+        if not stats is None: stats.save(corpusstats.partialPath(stats_outf, shard_id))
+        # send anything still buffered in a batching output queue
+        if hasattr(output_q, 'flush'): output_q.flush()
+        profiling.stop()
         complete_op(*complete_op_args)
+        metrics.stopStage()
 
 def createTokenizerThreads(n_threads, input_q, output_q, halt_signal, complete_op, complete_op_args,
-        start_port=9000, sentence_split=False, to_lower=False, remove_punctuation=False, extra_ops=None):
+        start_port=9000, sentence_split=False, to_lower=False, remove_punctuation=False, extra_ops=None,
+        batch_size=1, max_batch_chars=DEFAULT_MAX_BATCH_CHARS, requests_in_flight=1,
+        start_server=True, host='localhost', backend='corenlp', cache=None, output_sink=None,
+        stats_outf=None, pipeline_metrics=None, profiles=None, endpoints=None, keyed=False):
     '''Creates tokenization threads with multiprocessing module, and returns as list (unstarted).
 
     Required arguments
-      n_threads        :: number of tokenization threads to create (each
-                          creates its own instance of CoreNLP server)
-      input_q          :: multiprocessing.Queue object for input chunks of
-                          text. Each item in the queue will be fed to CoreNLP
-                          through ssplit and tokenizer ops.
-      output_q         :: multiprocessing.Queue object for output lines
+      n_threads        :: number of tokenization threads to create (with the
+                          corenlp backend and no endpoints, each creates its
+                          own instance of CoreNLP server)
+      input_q          :: multiprocessing.Queue (or utils.batchqueue.BatchQueue)
+                          object for input chunks of text. Each item in the
+                          queue will be fed to CoreNLP through ssplit and
+                          tokenizer ops.
+      output_q         :: multiprocessing.Queue (or BatchQueue) object for
+                          output lines; a BatchQueue is flushed before
+                          complete_op is called
       halt_signal      :: stop processing when this comes through the input_q
       complete_op      :: function to execute on completion of each tokenization
                           thread
@@ -91,6 +605,51 @@ def createTokenizerThreads(n_threads, input_q, output_q, halt_signal, complete_o
       extra_ops          :: list of lambda functions to execute on each list of
                             tokens (called BEFORE lowercasing and punctuation
                             is removed)
+      batch_size         :: number of input_q items to tokenize in a single
+                            annotation request (see annotateBatch); output is
+                            still written one item (or sentence) at a time
+      max_batch_chars    :: stop adding items to a batch once it holds this
+                            many characters, to stay well under the server's
+                            maximum request length
+      requests_in_flight :: number of annotation requests each thread keeps
+                            open at once (the server handles them in parallel)
+      start_server       :: if False, connect to a server already running on
+                            host at each thread's port (e.g., a stand-in
+                            server for testing) instead of starting one
+      host               :: host name of the CoreNLP servers
+      backend            :: 'corenlp' to tokenize with CoreNLP servers, or
+                            'regex' to tokenize in each thread with
+                            utils.ptbtokenizer (start_port, host, start_server
+                            and requests_in_flight are then unused)
+      cache              :: utils.tokencache.TokenizationCache to reuse
+                            tokenize/ssplit output from (and add new output
+                            to); lowercasing, punctuation removal and
+                            extra_ops are applied after the cache, so reruns
+                            with different settings can share it
+      output_sink        :: utils.outputsink.OutputSink; if given, thread i
+                            writes its output lines straight to shard i
+                            instead of output_q (output_q is still flushed
+                            and passed to complete_op as usual)
+      stats_outf         :: if given, each thread collects statistics on its
+                            output lines (each input_q item counting as one
+                            document, except with sentence_split, where
+                            documents are not counted), saved as partials
+                            for utils.corpusstats.mergePartials(stats_outf)
+      pipeline_metrics   :: utils.metrics.PipelineMetrics; if given, each
+                            thread records metrics as stage "tokenizer"
+      profiles           :: utils.profiling.ProcessProfiles; if given, each
+                            thread is profiled as stage "tokenizer"
+      endpoints          :: list of CoreNLP server URLs (e.g., the endpoints
+                            of a ServerPool) to share among the threads with
+                            the corenlp backend; thread i sends its requests
+                            to endpoints[i % len(endpoints)], failing over
+                            to the others while that server is down
+                            (start_port, host and start_server are then
+                            unused)
+      keyed              :: if True, input_q items are (key, text) pairs, and
+                            each output line is sent to output_q as a
+                            (key, line) pair (e.g., to track source document
+                            IDs; not used with output_sink)
     '''
     threads = [
         mp.Process(
@@ -105,9 +664,154 @@ def createTokenizerThreads(n_threads, input_q, output_q, halt_signal, complete_o
                 extra_ops,
                 halt_signal,
                 complete_op,
-                complete_op_args
+                complete_op_args,
+                batch_size,
+                max_batch_chars,
+                requests_in_flight,
+                start_server,
+                host,
+                backend,
+                cache,
+                output_sink,
+                i,
+                stats_outf,
+                pipeline_metrics,
+                profiles,
+                endpoints,
+                keyed
             )
         )
             for i in range(n_threads)
     ]
     return threads
+
+def compareBackends(texts, port=9000, host='localhost', start_server=True, top_n=20):
+    '''Tokenizes texts with both the corenlp and regex backends, and returns
+    a dict of agreement statistics, with the top_n most frequent token
+    disagreements as (count, regex tokens, CoreNLP tokens).
+    '''
+    texts = [preprocessing.digitsToZero(text) for text in texts]
+    with createBackend('corenlp', port=port, host=host, start_server=start_server) as tokenizer:
+        reference = tokenizer.annotateBatch(texts)
+    with createBackend('regex') as tokenizer:
+        approximate = tokenizer.annotateBatch(texts)
+
+    stats = collections.Counter()
+    disagreements = collections.Counter()
+    for (ref_sentences, approx_sentences) in zip(reference, approximate):
+        ref_tokens = [t for sentence in ref_sentences for t in sentence]
+        approx_tokens = [t for sentence in approx_sentences for t in sentence]
+        stats['texts'] += 1
+        stats['corenlp_tokens'] += len(ref_tokens)
+        stats['regex_tokens'] += len(approx_tokens)
+        stats['corenlp_sentences'] += len(ref_sentences)
+        stats['regex_sentences'] += len(approx_sentences)
+        if ref_tokens == approx_tokens:
+            stats['same_tokens'] += 1
+            stats['matched_tokens'] += len(ref_tokens)
+            if ref_sentences == approx_sentences: stats['same_sentences'] += 1
+            continue
+        matcher = difflib.SequenceMatcher(None, approx_tokens, ref_tokens, autojunk=False)
+        for (tag, i1, i2, j1, j2) in matcher.get_opcodes():
+            if tag == 'equal':
+                stats['matched_tokens'] += (i2 - i1)
+            else:
+                disagreements[(' '.join(approx_tokens[i1:i2]), ' '.join(ref_tokens[j1:j2]))] += 1
+
+    precision = stats['matched_tokens'] / max(stats['regex_tokens'], 1)
+    recall = stats['matched_tokens'] / max(stats['corenlp_tokens'], 1)
+    return {
+        'counts': stats,
+        'token_precision': precision,
+        'token_recall': recall,
+        'token_f1': (2 * precision * recall / (precision + recall)) if precision + recall > 0 else 0,
+        'disagreements': [
+            (count, approx, ref)
+                for ((approx, ref), count) in disagreements.most_common(top_n)
+        ],
+    }
+
+if __name__ == '__main__':
+    def _cli():
+        import optparse
+        parser = optparse.OptionParser(usage='Usage: %prog --sample=FILE | --serve-pool=FILE',
+                description='Reports agreement between the regex tokenizer and CoreNLP on the lines of FILE'
+                            ' given with --sample, or runs a shared pool of CoreNLP servers'
+                            ' described in the FILE given with --serve-pool')
+        parser.add_option('--sample', dest='sample',
+                help='text file to tokenize, one paragraph or document per line (REQUIRED)')
+        parser.add_option('--max-lines', dest='max_lines',
+                type='int', default=10000,
+                help='maximum number of lines of FILE to compare (default: %default)')
+        parser.add_option('--port', dest='port',
+                type='int', default=9000,
+                help='port of the CoreNLP server (default: %default)')
+        parser.add_option('--use-running-server', dest='start_server',
+                action='store_false', default=True,
+                help='connect to a CoreNLP server already running on --port instead of starting one')
+        parser.add_option('--top', dest='top_n',
+                type='int', default=20,
+                help='number of most frequent disagreements to report (default: %default)')
+        parser.add_option('--serve-pool', dest='serve_pool',
+                help='start a pool of CoreNLP servers on free ports from --port up, write'
+                     ' their endpoints to FILE for jobs to attach to (e.g., with'
+                     ' gigaword/plaintext.py --corenlp-pool=FILE), and keep them running'
+                     ' (restarting any that fail) until interrupted')
+        parser.add_option('--servers', dest='servers',
+                type='int', default=1,
+                help='with --serve-pool, number of servers to start (default: %default)')
+        parser.add_option('--server-command', dest='server_command',
+                default=DEFAULT_SERVER_COMMAND,
+                help='with --serve-pool, command to start each server with, formatted'
+                     ' with {port}, {memory} and {corenlp_home} (default: %default)')
+        parser.add_option('--memory', dest='memory',
+                default='4G',
+                help='with --serve-pool, Java heap size for each server (default: %default)')
+        parser.add_option('--health-interval', dest='health_interval',
+                type='float', default=DEFAULT_HEALTH_INTERVAL,
+                help='with --serve-pool, seconds between server health checks (default: %default)')
+        (options, args) = parser.parse_args()
+        if options.sample == None and options.serve_pool == None:
+            parser.print_help()
+            exit()
+        return options
+    options = _cli()
+
+    if options.serve_pool:
+        import signal
+        import sys
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        pool = ServerPool(n_servers=options.servers, start_port=options.port, command=options.server_command,
+            memory=options.memory, health_interval=options.health_interval)
+        try:
+            pool.start()
+            pool.save(options.serve_pool)
+            log.writeln('Serving %d CoreNLP servers (see %s); interrupt to stop' % (options.servers, options.serve_pool))
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pool.close()
+            if os.path.isfile(options.serve_pool): os.remove(options.serve_pool)
+        exit()
+
+    texts = []
+    with open(options.sample, 'r', encoding='utf-8') as stream:
+        for line in stream:
+            if len(texts) >= options.max_lines: break
+            line = line.strip()
+            if len(line) > 0: texts.append(line)
+
+    report = compareBackends(texts, port=options.port, start_server=options.start_server, top_n=options.top_n)
+    counts = report['counts']
+    log.writeln('Compared %d lines of %s' % (counts['texts'], options.sample))
+    log.writeln('  Tokens: %d (CoreNLP) / %d (regex)' % (counts['corenlp_tokens'], counts['regex_tokens']))
+    log.writeln('  Sentences: %d (CoreNLP) / %d (regex)' % (counts['corenlp_sentences'], counts['regex_sentences']))
+    log.writeln('  Token precision %.4f, recall %.4f, F1 %.4f' % (
+        report['token_precision'], report['token_recall'], report['token_f1']))
+    log.writeln('  Lines with identical tokens: %.2f%%' % (100 * counts['same_tokens'] / max(counts['texts'], 1)))
+    log.writeln('  Lines with identical tokens and sentences: %.2f%%' % (100 * counts['same_sentences'] / max(counts['texts'], 1)))
+    log.writeln('Most frequent disagreements (count: regex => CoreNLP):')
+    for (count, approx, ref) in report['disagreements']:
+        log.writeln('  %6d: [%s] => [%s]' % (count, approx, ref))
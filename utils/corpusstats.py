@@ -0,0 +1,138 @@
+'''
+Corpus statistics collected while extracting, so that token and type counts
+don't need a separate pass over the output.
+
+Each worker keeps its own CorpusStats, adding every line (list of tokens) it
+writes and marking the end of each document, and saves it as a partial file
+(OUT.stats.000, OUT.stats.001, ...) when done.  mergePartials then combines
+the partials into one report next to the output:
+  OUT.stats.json    document, line, token and type counts; punctuation
+                    tokens removed (by utils.punctuation.filterTokens) and
+                    remaining; and a histogram of document lengths in tokens
+                    (left out if the workers can't see document boundaries)
+  OUT.stats.tsv     one "token<TAB>count" line per token type, most frequent
+                    first
+'''
+
+import collections
+import glob
+import json
+import pickle
+import os
+from . import punctuation
+
+def partialPath(outf, worker_id):
+    return '%s.stats.%03d' % (outf, worker_id)
+
+def reportPath(outf):
+    return '%s.stats.json' % outf
+
+def typesPath(outf):
+    return '%s.stats.tsv' % outf
+
+def _lengthBin(n_tokens):
+    # power-of-two bins: 0, 1, 2-3, 4-7, 8-15, ...
+    if n_tokens == 0: return 0
+    return 1 << (n_tokens.bit_length() - 1)
+
+class CorpusStats:
+
+    def __init__(self, track_documents=True):
+        self.track_documents = track_documents
+        self.documents = 0
+        self.lines = 0
+        self.tokens = 0
+        self.removed_tokens = 0
+        self.types = collections.Counter()
+        self.document_lengths = collections.Counter()
+        self._document_tokens = 0
+
+    def addLine(self, tokens, removed=0):
+        '''Counts one output line of tokens; removed is the number of
+        punctuation tokens filtered out of it.
+        '''
+        self.lines += 1
+        self.tokens += len(tokens)
+        self.removed_tokens += removed
+        self.types.update(tokens)
+        self._document_tokens += len(tokens)
+
+    def endDocument(self):
+        '''Marks the lines added since the last call as one document.'''
+        self.documents += 1
+        self.document_lengths[_lengthBin(self._document_tokens)] += 1
+        self._document_tokens = 0
+
+    def update(self, other):
+        '''Adds the counts from CorpusStats other to this one.'''
+        self.track_documents = self.track_documents and other.track_documents
+        self.documents += other.documents
+        self.lines += other.lines
+        self.tokens += other.tokens
+        self.removed_tokens += other.removed_tokens
+        self.types.update(other.types)
+        self.document_lengths.update(other.document_lengths)
+
+    def save(self, path):
+        with open(path, 'wb') as stream:
+            pickle.dump(self, stream, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as stream:
+            return pickle.load(stream)
+
+    def report(self):
+        '''Returns the summary statistics as a dict.'''
+        punctuation_tokens = sum([
+            count for (token, count) in self.types.items()
+                if token.lower() in punctuation.PUNCTUATION
+        ])
+        tokens_before_removal = self.tokens + self.removed_tokens
+        report = {'documents': self.documents} if self.track_documents else {}
+        report.update({
+            'lines': self.lines,
+            'tokens': self.tokens,
+            'types': len(self.types),
+            'removed_punctuation_tokens': self.removed_tokens,
+            'removed_punctuation_fraction': self.removed_tokens / max(tokens_before_removal, 1),
+            'remaining_punctuation_tokens': punctuation_tokens,
+            'remaining_punctuation_fraction': punctuation_tokens / max(self.tokens, 1),
+        })
+        if self.track_documents:
+            report['mean_document_length'] = self.tokens / max(self.documents, 1)
+            report['document_length_histogram'] = [
+                {'min': low, 'max': max(low * 2 - 1, low), 'documents': self.document_lengths[low]}
+                    for low in sorted(self.document_lengths.keys())
+            ]
+        return report
+
+    def writeReport(self, outf):
+        '''Writes outf.stats.json and outf.stats.tsv.'''
+        with open(reportPath(outf), 'w') as stream:
+            json.dump(self.report(), stream, indent=2)
+        with open(typesPath(outf), 'w', encoding='utf-8') as stream:
+            for (token, count) in sorted(self.types.items(), key=lambda item: (-item[1], item[0])):
+                stream.write('%s\t%d\n' % (token, count))
+
+def _partialPaths(outf):
+    return glob.glob('%s.stats.[0-9]*' % glob.escape(outf))
+
+def clearPartials(outf):
+    '''Deletes any partial statistics left for outf by an earlier run.'''
+    for path in _partialPaths(outf):
+        os.remove(path)
+
+def mergePartials(outf, stats=None):
+    '''Merges all partial statistics saved for outf (plus CorpusStats stats,
+    if given), deletes the partials, writes the report for outf, and returns
+    the merged CorpusStats.
+    '''
+    merged = CorpusStats()
+    if not stats is None:
+        merged.update(stats)
+    for path in _partialPaths(outf):
+        merged.update(CorpusStats.load(path))
+        os.remove(path)
+    merged.writeReport(outf)
+    return merged
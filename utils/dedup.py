@@ -0,0 +1,307 @@
+'''
+Near-duplicate document detection with MinHash signatures and a sharded LSH
+index, run as a pass before extraction so that repeated documents (e.g., the
+same wire story in several Gigaword sources) are only extracted once.
+
+Deduplicator.findDuplicates works in a temporary directory, in two passes:
+ 1. Signatures: worker processes read the documents of each source (numbered
+    in the order given) and compute a MinHash signature of each document's
+    word shingles.  Signatures are saved as fixed-width records
+    (sigs.SOURCE) and document IDs one per line (ids.SOURCE); the hash of
+    each LSH band of each signature is appended, with the document's number,
+    to one of shards bucket files chosen by the hash (buckets.SHARD.PID).
+ 2. Candidates: each shard's buckets are loaded by one worker at a time, so
+    memory is bounded by the size of a shard rather than of the corpus.
+    Each document sharing a bucket with earlier documents is compared with
+    (up to max_checks of) them, by the Jaccard similarity estimated from
+    their signatures.
+
+A document is a duplicate if it is at least threshold similar to any
+earlier document, and is reported as a duplicate of the earliest one.
+Earlier means in an earlier source, or earlier in the same source, so the
+result doesn't depend on the number of workers.  Documents with no words
+are never duplicates.
+
+The report (OUT.dedup.tsv) has one line per removed document:
+    ID<TAB>source<TAB>duplicate of ID<TAB>its source<TAB>similarity
+'''
+
+import collections
+import glob
+import hashlib
+import multiprocessing as mp
+import os
+import random
+import shutil
+import struct
+import tempfile
+import zlib
+from drgriffis.common import log
+
+DEFAULT_THRESHOLD = 0.8
+DEFAULT_NUM_PERM = 64
+DEFAULT_BANDS = 16
+DEFAULT_SHARDS = 16
+DEFAULT_SHINGLE_SIZE = 5
+DEFAULT_MAX_CHECKS = 20
+
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_POSITION_BITS = 32
+_POSITION_MASK = (1 << _POSITION_BITS) - 1
+_BUCKET = struct.Struct('<QQ')
+
+Duplicate = collections.namedtuple('Duplicate', ['id', 'source', 'duplicate_of', 'duplicate_of_source', 'similarity'])
+
+def reportPath(outf):
+    return '%s.dedup.tsv' % outf
+
+def shingleHashes(text, shingle_size=DEFAULT_SHINGLE_SIZE):
+    '''Returns the set of 32-bit hashes of the lowercased word shingles
+    (runs of shingle_size words) of text.
+    '''
+    words = text.lower().split()
+    if len(words) == 0: return set()
+    if len(words) <= shingle_size:
+        return {zlib.crc32(' '.join(words).encode('utf-8'))}
+    return set([
+        zlib.crc32(' '.join(words[i:i+shingle_size]).encode('utf-8'))
+            for i in range(len(words) - shingle_size + 1)
+    ])
+
+class MinHasher:
+    '''Computes MinHash signatures of sets of 32-bit hashes, under
+    num_perm random permutations (a*h + b) mod p drawn from seed.
+    '''
+
+    def __init__(self, num_perm=DEFAULT_NUM_PERM, seed=1):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        # 32-bit coefficients keep products small enough to multiply quickly
+        self.permutations = [(rng.randint(1, _MAX_HASH), rng.randint(0, _MAX_HASH)) for _ in range(num_perm)]
+        self.struct = struct.Struct('<%dI' % num_perm)
+
+    def signature(self, hashes):
+        return [
+            min([(a * h + b) % _PRIME for h in hashes]) & _MAX_HASH
+                for (a, b) in self.permutations
+        ]
+
+def similarity(sig_a, sig_b):
+    '''Returns the Jaccard similarity estimated from MinHash signatures
+    sig_a and sig_b.
+    '''
+    return sum([1 for (x, y) in zip(sig_a, sig_b) if x == y]) / len(sig_a)
+
+def bandHashes(signature, bands):
+    '''Returns the 64-bit LSH bucket hash of each of the bands of signature.'''
+    rows = len(signature) // bands
+    hashes = []
+    for band in range(bands):
+        key = struct.pack('<I%dI' % rows, band, *signature[band*rows:(band+1)*rows])
+        hashes.append(int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little'))
+    return hashes
+
+def _docKey(source_ix, position):
+    return (source_ix << _POSITION_BITS) | position
+
+def _sigsPath(work_dir, source_ix):
+    return os.path.join(work_dir, 'sigs.%d' % source_ix)
+
+def _idsPath(work_dir, source_ix):
+    return os.path.join(work_dir, 'ids.%d' % source_ix)
+
+def _bucketsPath(work_dir, shard, pid):
+    return os.path.join(work_dir, 'buckets.%03d.%d' % (shard, pid))
+
+class _SignatureReader:
+    '''Reads signatures by document key from the sigs.SOURCE files of a
+    working directory, keeping up to max_open files open.
+    '''
+
+    def __init__(self, work_dir, sig_struct, max_open=64):
+        self.work_dir = work_dir
+        self.struct = sig_struct
+        self.max_open = max_open
+        self._streams = collections.OrderedDict()
+
+    def signature(self, key):
+        source_ix = key >> _POSITION_BITS
+        stream = self._streams.pop(source_ix, None)
+        if stream is None:
+            if len(self._streams) >= self.max_open:
+                self._streams.popitem(last=False)[1].close()
+            stream = open(_sigsPath(self.work_dir, source_ix), 'rb')
+        self._streams[source_ix] = stream
+        stream.seek((key & _POSITION_MASK) * self.struct.size)
+        return self.struct.unpack(stream.read(self.struct.size))
+
+    def close(self):
+        for stream in self._streams.values():
+            stream.close()
+        self._streams.clear()
+
+def _signSource(args):
+    (settings, work_dir, source_ix, source, iter_texts) = args
+    hasher = MinHasher(settings.num_perm, settings.seed)
+    empty = hasher.struct.pack(*[0 for _ in range(settings.num_perm)])
+    buckets = [[] for _ in range(settings.shards)]
+    n_docs = 0
+    with open(_sigsPath(work_dir, source_ix), 'wb') as sig_stream, \
+         open(_idsPath(work_dir, source_ix), 'w', encoding='utf-8', newline='\n') as id_stream:
+        for (doc_id, text) in iter_texts(source):
+            id_stream.write('%s\n' % str(doc_id).replace('\n', ' '))
+            hashes = shingleHashes(text, settings.shingle_size)
+            if len(hashes) == 0:
+                sig_stream.write(empty)
+            else:
+                signature = hasher.signature(hashes)
+                sig_stream.write(hasher.struct.pack(*signature))
+                key = _docKey(source_ix, n_docs)
+                for band_hash in bandHashes(signature, settings.bands):
+                    buckets[band_hash % settings.shards].append(_BUCKET.pack(band_hash, key))
+            n_docs += 1
+    pid = os.getpid()
+    for (shard, records) in enumerate(buckets):
+        if len(records) > 0:
+            with open(_bucketsPath(work_dir, shard, pid), 'ab') as stream:
+                stream.write(b''.join(records))
+    return n_docs
+
+def _findCandidates(args):
+    (settings, work_dir, shard) = args
+    # most buckets hold one document; only colliding ones get a list
+    buckets = {}
+    for path in glob.glob(os.path.join(glob.escape(work_dir), 'buckets.%03d.*' % shard)):
+        with open(path, 'rb') as stream:
+            for (band_hash, key) in _BUCKET.iter_unpack(stream.read()):
+                keys = buckets.get(band_hash)
+                if keys is None: buckets[band_hash] = key
+                elif type(keys) is list: keys.append(key)
+                else: buckets[band_hash] = [keys, key]
+
+    reader = _SignatureReader(work_dir, MinHasher(settings.num_perm, settings.seed).struct)
+    matches = {}
+    for keys in buckets.values():
+        if type(keys) is not list: continue
+        keys.sort()
+        signatures = {}
+        for i in range(1, len(keys)):
+            key = keys[i]
+            # already matched at least as early as anything in this bucket
+            if key in matches and matches[key][0] <= keys[0]: continue
+            if not key in signatures: signatures[key] = reader.signature(key)
+            for earlier in keys[:min(i, settings.max_checks)]:
+                if not earlier in signatures: signatures[earlier] = reader.signature(earlier)
+                sim = similarity(signatures[key], signatures[earlier])
+                if sim >= settings.threshold:
+                    if (not key in matches) or earlier < matches[key][0]:
+                        matches[key] = (earlier, sim)
+                    break
+    reader.close()
+    return matches
+
+class Deduplicator:
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, num_perm=DEFAULT_NUM_PERM, bands=DEFAULT_BANDS,
+            shards=DEFAULT_SHARDS, shingle_size=DEFAULT_SHINGLE_SIZE, max_checks=DEFAULT_MAX_CHECKS,
+            workers=1, work_dir=None, seed=1):
+        '''
+        threshold    :: minimum estimated Jaccard similarity of duplicates
+        num_perm     :: number of MinHash permutations per signature
+        bands        :: number of LSH bands (must divide num_perm); more
+                        bands find less similar candidates
+        shards       :: number of LSH index shards; each is held in memory
+                        by one worker at a time
+        shingle_size :: number of words per shingle
+        max_checks   :: maximum number of earlier documents in a bucket to
+                        compare each document with
+        workers      :: number of worker processes
+        work_dir     :: directory to make the (temporary) working directory
+                        in (default: the system temporary directory)
+        seed         :: random seed for the MinHash permutations
+        '''
+        if num_perm % bands != 0:
+            raise ValueError('Number of permutations (%d) must be a multiple of the number of bands (%d)' % (num_perm, bands))
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shards = shards
+        self.shingle_size = shingle_size
+        self.max_checks = max_checks
+        self.workers = workers
+        self.work_dir = work_dir
+        self.seed = seed
+
+    def findDuplicates(self, sources, iter_texts):
+        '''Returns a list of Duplicates among the documents of sources, in
+        document order.
+
+        iter_texts(source) must yield (document ID, text) for each document
+        of source, and be picklable (e.g., a module-level function, or a
+        functools.partial of one).
+        '''
+        if not self.work_dir is None:
+            os.makedirs(self.work_dir, exist_ok=True)
+        work_dir = tempfile.mkdtemp(prefix='dedup.', dir=self.work_dir)
+        try:
+            sign_args = [(self, work_dir, i, source, iter_texts) for (i, source) in enumerate(sources)]
+            shard_args = [(self, work_dir, shard) for shard in range(self.shards)]
+            if self.workers > 1:
+                pool = mp.Pool(self.workers)
+                imap = pool.imap_unordered
+            else:
+                pool = None
+                imap = map
+
+            log.track(message='  >> Signed {0:,}/{1:,} files ({2:,} documents)', writeInterval=1)
+            n_docs = 0
+            for n_source_docs in imap(_signSource, sign_args):
+                n_docs += n_source_docs
+                log.tick(len(sign_args), n_docs)
+            log.flushTracker(len(sign_args), n_docs)
+
+            log.track(message='  >> Searched {0:,}/{1:,} index shards', writeInterval=1)
+            matches = {}
+            for shard_matches in imap(_findCandidates, shard_args):
+                for (key, (earlier, sim)) in shard_matches.items():
+                    if (not key in matches) or earlier < matches[key][0]:
+                        matches[key] = (earlier, sim)
+                log.tick(len(shard_args))
+            log.flushTracker(len(shard_args))
+            if not pool is None:
+                pool.close()
+                pool.join()
+
+            ids = self._readIds(work_dir, matches)
+            duplicates = [
+                Duplicate(ids[key], sources[key >> _POSITION_BITS],
+                    ids[earlier], sources[earlier >> _POSITION_BITS], sim)
+                    for (key, (earlier, sim)) in sorted(matches.items())
+            ]
+            log.writeln('Found {0:,} near-duplicates among {1:,} documents'.format(len(duplicates), n_docs))
+            return duplicates
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _readIds(self, work_dir, matches):
+        positions = collections.defaultdict(set)
+        for (key, (earlier, _)) in matches.items():
+            positions[key >> _POSITION_BITS].add(key & _POSITION_MASK)
+            positions[earlier >> _POSITION_BITS].add(earlier & _POSITION_MASK)
+        ids = {}
+        for (source_ix, source_positions) in positions.items():
+            with open(_idsPath(work_dir, source_ix), 'r', encoding='utf-8', newline='\n') as stream:
+                for (position, line) in enumerate(stream):
+                    if position in source_positions:
+                        ids[_docKey(source_ix, position)] = line[:-1]
+        return ids
+
+def writeReport(duplicates, outf):
+    '''Writes the list of removed documents to outf.dedup.tsv.'''
+    with open(reportPath(outf), 'w', encoding='utf-8') as stream:
+        for duplicate in duplicates:
+            stream.write('%s\t%s\t%s\t%s\t%.3f\n' % (
+                duplicate.id, duplicate.source, duplicate.duplicate_of,
+                duplicate.duplicate_of_source, duplicate.similarity
+            ))
@@ -0,0 +1,251 @@
+'''
+Random access to the documents of a plaintext corpus through a sidecar
+index, so that documents can be fetched, sampled or split among workers
+without scanning the corpus for line boundaries.
+
+As the corpus OUT is written, a DocumentIndexWriter is given the source ID
+(PMID, PMC file name, Gigaword DOC id, Wikipedia page id) and length in
+bytes of each document, in file order, and on close saves OUT.docidx
+(all little-endian):
+  header   magic, number of documents, width of the source ID field, and
+           the size of OUT when indexed
+  records  one per document, in file order: byte offset and length
+           (uint64 each), then the source ID in UTF-8, NUL-padded to the
+           ID width
+  by ID    document numbers (uint64), ordered by source ID
+
+DocumentIndex memory-maps OUT and its index: document i is read from
+record i in constant time, and documents with a given source ID are found
+by binary search over the by-ID table.
+
+To fetch documents from the command line:
+    python -m utils.docindex OUT [--doc=N] [--id=ID] [--sample=K]
+'''
+
+import mmap
+import os
+import random
+import struct
+
+_MAGIC = b'DOCIDX01'
+_HEADER = struct.Struct('<8sQIxxxxQ')
+_SPAN = struct.Struct('<QQ')
+_DOCNO = struct.Struct('<Q')
+
+def indexPath(corpus_path):
+    return '%s.docidx' % corpus_path
+
+def _recordStruct(id_width):
+    return struct.Struct('<QQ%ds' % id_width)
+
+class DocumentIndexWriter:
+    '''Records the span and source ID of each document as a corpus is
+    written, and saves the index on close.
+
+    Spans and IDs are spooled to temporary files next to the index while
+    writing; only the IDs are held in memory, to sort them, on close.
+    '''
+
+    def __init__(self, corpus_path):
+        self.corpus_path = corpus_path
+        self.path = indexPath(corpus_path)
+        self.n_docs = 0
+        self.offset = 0
+        self._spans = open('%s.spans.tmp' % self.path, 'wb')
+        self._ids = open('%s.ids.tmp' % self.path, 'w', encoding='utf-8', newline='\n')
+
+    def add(self, source_id, n_bytes):
+        '''Records the next n_bytes of the corpus as one document.'''
+        self._spans.write(_SPAN.pack(self.offset, n_bytes))
+        self._ids.write('%s\n' % ('' if source_id is None else str(source_id).replace('\n', ' ')))
+        self.offset += n_bytes
+        self.n_docs += 1
+
+    def addText(self, source_id, text):
+        '''Records text, as written to the corpus in UTF-8, as one document.'''
+        self.add(source_id, len(text.encode('utf-8')))
+
+    def skip(self, n_bytes):
+        '''Steps over n_bytes of the corpus that aren't part of any document.'''
+        self.offset += n_bytes
+
+    def close(self):
+        self._spans.close()
+        self._ids.close()
+        with open(self._ids.name, 'r', encoding='utf-8', newline='\n') as stream:
+            ids = [line[:-1].encode('utf-8') for line in stream]
+        id_width = max([len(source_id) for source_id in ids] + [0])
+        record = _recordStruct(id_width)
+        with open('%s.tmp' % self.path, 'wb') as stream, open(self._spans.name, 'rb') as spans:
+            stream.write(_HEADER.pack(_MAGIC, self.n_docs, id_width, self.offset))
+            for source_id in ids:
+                (offset, length) = _SPAN.unpack(spans.read(_SPAN.size))
+                stream.write(record.pack(offset, length, source_id))
+            for docno in sorted(range(len(ids)), key=ids.__getitem__):
+                stream.write(_DOCNO.pack(docno))
+        os.replace('%s.tmp' % self.path, self.path)
+        os.remove(self._spans.name)
+        os.remove(self._ids.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _mapFile(path):
+    with open(path, 'rb') as stream:
+        # empty files can't be mapped
+        if os.fstat(stream.fileno()).st_size == 0: return b''
+        return mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+class DocumentIndex:
+    '''Read-only random access to the documents of an indexed corpus.
+
+    index[i] returns document i as written (including its final newline);
+    len(index) is the number of documents.
+    '''
+
+    def __init__(self, corpus_path):
+        self.corpus_path = corpus_path
+        self._index = _mapFile(indexPath(corpus_path))
+        if len(self._index) < _HEADER.size or self._index[:len(_MAGIC)] != _MAGIC:
+            raise ValueError('%s is not a document index' % indexPath(corpus_path))
+        (_, self.n_docs, self.id_width, corpus_size) = _HEADER.unpack_from(self._index, 0)
+        if os.path.getsize(corpus_path) != corpus_size:
+            raise ValueError('%s has changed since it was indexed' % corpus_path)
+        self._corpus = _mapFile(corpus_path)
+        self._record = _recordStruct(self.id_width)
+        self._by_id = _HEADER.size + self.n_docs * self._record.size
+
+    def __len__(self):
+        return self.n_docs
+
+    def _docno(self, docno):
+        if docno < 0: docno += self.n_docs
+        if docno < 0 or docno >= self.n_docs:
+            raise IndexError('Document %d out of range' % docno)
+        return docno
+
+    def _unpack(self, docno):
+        return self._record.unpack_from(self._index, _HEADER.size + docno * self._record.size)
+
+    def span(self, docno):
+        '''Returns the (byte offset, length) of document docno.'''
+        (offset, length, _) = self._unpack(self._docno(docno))
+        return offset, length
+
+    def sourceId(self, docno):
+        (_, _, source_id) = self._unpack(self._docno(docno))
+        return source_id.rstrip(b'\0').decode('utf-8')
+
+    def documentBytes(self, docno):
+        (offset, length) = self.span(docno)
+        return self._corpus[offset:offset+length]
+
+    def document(self, docno):
+        return self.documentBytes(docno).decode('utf-8')
+
+    def __getitem__(self, docno):
+        return self.document(docno)
+
+    def find(self, source_id):
+        '''Returns the numbers of the documents with source_id, in file order.'''
+        key = str(source_id).encode('utf-8')
+        # first entry of the by-ID table whose ID is not less than key
+        low, high = 0, self.n_docs
+        while low < high:
+            mid = (low + high) // 2
+            if self._idAt(mid) < key: low = mid + 1
+            else: high = mid
+        docnos = []
+        while low < self.n_docs and self._idAt(low) == key:
+            docnos.append(self._byIdDocno(low))
+            low += 1
+        return sorted(docnos)
+
+    def _byIdDocno(self, i):
+        return _DOCNO.unpack_from(self._index, self._by_id + i * _DOCNO.size)[0]
+
+    def _idAt(self, i):
+        (_, _, source_id) = self._unpack(self._byIdDocno(i))
+        return source_id.rstrip(b'\0')
+
+    def lookup(self, source_id):
+        '''Returns the documents with source_id, in file order.'''
+        return [self.document(docno) for docno in self.find(source_id)]
+
+    def sample(self, k, seed=None):
+        '''Returns a list of k (document number, document) pairs drawn
+        uniformly without replacement.
+        '''
+        docnos = random.Random(seed).sample(range(self.n_docs), k)
+        return [(docno, self.document(docno)) for docno in docnos]
+
+    def close(self):
+        for mapped in (self._corpus, self._index):
+            if isinstance(mapped, mmap.mmap): mapped.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def mergeIndexes(corpus_paths, merged_path, remove=True):
+    '''Writes the index of merged_path, the concatenation (in order) of the
+    indexed corpora corpus_paths, by shifting the spans in their indexes;
+    their indexes are removed if remove is True.
+
+    Call before the corpora in corpus_paths are removed.
+    '''
+    with DocumentIndexWriter(merged_path) as writer:
+        for corpus_path in corpus_paths:
+            with DocumentIndex(corpus_path) as index:
+                position = 0
+                for docno in range(len(index)):
+                    (offset, length) = index.span(docno)
+                    writer.skip(offset - position)
+                    writer.add(index.sourceId(docno), length)
+                    position = offset + length
+                writer.skip(os.path.getsize(corpus_path) - position)
+    if remove:
+        for corpus_path in corpus_paths:
+            os.remove(indexPath(corpus_path))
+
+if __name__ == '__main__':
+    def _cli():
+        import optparse
+        parser = optparse.OptionParser(usage='Usage: %prog CORPUS',
+                description='Prints documents from CORPUS by number, source ID or random sample,'
+                            ' using its index CORPUS.docidx')
+        parser.add_option('--doc', dest='docnos',
+                action='append', type='int', default=[],
+                help='number of a document to print (may be repeated)')
+        parser.add_option('--id', dest='source_ids',
+                action='append', default=[],
+                help='source ID of documents to print (may be repeated)')
+        parser.add_option('--sample', dest='sample',
+                type='int', default=0,
+                help='number of documents to sample at random')
+        parser.add_option('--seed', dest='seed',
+                type='int', default=None,
+                help='random seed for --sample')
+        (options, args) = parser.parse_args()
+        if len(args) != 1:
+            parser.print_help()
+            exit()
+        return args, options
+    (corpus_path,), options = _cli()
+    import sys
+    with DocumentIndex(corpus_path) as index:
+        docnos = list(options.docnos)
+        for source_id in options.source_ids:
+            docnos.extend(index.find(source_id))
+        if options.sample > 0:
+            docnos.extend(random.Random(options.seed).sample(range(len(index)), options.sample))
+        if len(docnos) == 0:
+            sys.stderr.write('%d documents in %s\n' % (len(index), corpus_path))
+        for docno in docnos:
+            sys.stdout.write('#%d\t%s\n' % (docno, index.sourceId(docno)))
+            sys.stdout.write(index.document(docno))
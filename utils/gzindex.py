@@ -0,0 +1,198 @@
+'''
+Record-aligned random access into large gzip files, so that one file can be
+split among several workers.
+
+buildIndex reads a gzip file once and records the uncompressed offset of
+every line starting with a record marker (e.g., b'<DOC ' in Gigaword), along
+with a key for each record (e.g., its document ID).  If the indexed_gzip
+package is installed, it also records decompressor checkpoints, so that
+reads can start mid-file without decompressing everything before them;
+without it, openRange decompresses from the start of the file and discards
+the bytes before the range.
+
+The index is saved as sidecar files, next to the gzip file or in a separate
+index directory:
+  FILE.gz.idx.json   size and modification time of FILE.gz, its
+                     uncompressed size, and the offset and key of each record
+  FILE.gz.gzidx      indexed_gzip checkpoints (if built with indexed_gzip)
+loadOrBuild reuses a saved index as long as FILE.gz is unchanged.
+
+Requires the indexed_gzip package for checkpoints (optional).
+  Via pip: pip install indexed_gzip
+'''
+
+import gzip
+import json
+import os
+import re
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+# uncompressed bytes between decompressor checkpoints
+DEFAULT_SPACING = 4 * 1024 * 1024
+_READ_BLOCK_SIZE = 4 * 1024 * 1024
+
+def indexPath(path, index_dir=None):
+    if index_dir is None: return '%s.idx.json' % path
+    return os.path.join(index_dir, '%s.idx.json' % os.path.basename(path))
+
+def checkpointsPath(path, index_dir=None):
+    if index_dir is None: return '%s.gzidx' % path
+    return os.path.join(index_dir, '%s.gzidx' % os.path.basename(path))
+
+class GzipIndex:
+
+    def __init__(self, path, index_dir=None):
+        self.path = path
+        self.index_dir = index_dir
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.uncompressed_size = 0
+        self.offsets = []
+        self.keys = []
+        self.checkpoints = False
+
+    def save(self):
+        data = {
+            'size': self.size,
+            'mtime': self.mtime,
+            'uncompressed_size': self.uncompressed_size,
+            'checkpoints': self.checkpoints,
+            'records': [[offset, key] for (offset, key) in zip(self.offsets, self.keys)],
+        }
+        outf = indexPath(self.path, self.index_dir)
+        with open('%s.tmp' % outf, 'w') as stream:
+            json.dump(data, stream)
+        os.replace('%s.tmp' % outf, outf)
+
+    @staticmethod
+    def load(path, index_dir=None):
+        '''Returns the saved index of gzip file path, or None if there is
+        none or path has changed since it was built.
+        '''
+        if not os.path.isfile(indexPath(path, index_dir)): return None
+        with open(indexPath(path, index_dir), 'r') as stream:
+            data = json.load(stream)
+        index = GzipIndex(path, index_dir=index_dir)
+        if index.size != data['size'] or index.mtime != data['mtime']:
+            return None
+        index.uncompressed_size = data['uncompressed_size']
+        index.checkpoints = data['checkpoints'] and os.path.isfile(checkpointsPath(path, index_dir))
+        index.offsets = [offset for (offset, _) in data['records']]
+        index.keys = [key for (_, key) in data['records']]
+        return index
+
+    def ranges(self, target_size):
+        '''Returns a list of (start, end) uncompressed byte ranges covering
+        all records, each starting at a record and holding about
+        target_size bytes (or a single range, if the file is smaller).
+        '''
+        if len(self.offsets) == 0: return []
+        ranges, start = [], self.offsets[0]
+        for offset in self.offsets[1:]:
+            if offset - start >= target_size:
+                ranges.append((start, offset))
+                start = offset
+        ranges.append((start, self.uncompressed_size))
+        return ranges
+
+def _open(path, spacing=DEFAULT_SPACING):
+    if indexed_gzip is None:
+        return gzip.open(path, 'rb')
+    return indexed_gzip.IndexedGzipFile(path, spacing=spacing)
+
+def buildIndex(path, marker, key_pattern=None, index_dir=None, spacing=DEFAULT_SPACING):
+    '''Indexes the records of gzip file path (see module documentation),
+    saves the index, and returns it as a GzipIndex.
+
+    marker      :: bytes at the start of each line beginning a record
+    key_pattern :: bytes regular expression searched for in the first line
+                   of each record; the key is its first group (as a str),
+                   or None if it doesn't match
+    '''
+    if not key_pattern is None: key_pattern = re.compile(key_pattern)
+    index = GzipIndex(path, index_dir=index_dir)
+    search = b'\n' + marker
+    with _open(path, spacing=spacing) as stream:
+        # lines (records) are only searched once complete
+        pending, base = b'', 0
+        while True:
+            block = stream.read(_READ_BLOCK_SIZE)
+            data = pending + block
+            cut = data.rfind(b'\n') + 1 if len(block) > 0 else len(data)
+            lines, pending = data[:cut], data[cut:]
+            starts = [0] if lines.startswith(marker) else []
+            pos = lines.find(search)
+            while pos >= 0:
+                starts.append(pos + 1)
+                pos = lines.find(search, pos + 1)
+            for start in starts:
+                line_end = lines.find(b'\n', start)
+                if line_end < 0: line_end = len(lines)
+                match = None if key_pattern is None else key_pattern.search(lines, start, line_end)
+                index.offsets.append(base + start)
+                index.keys.append(None if match is None else match.group(1).decode('utf-8', 'replace'))
+            base += len(lines)
+            if len(block) == 0: break
+        index.uncompressed_size = base
+        if not indexed_gzip is None:
+            stream.build_full_index()
+            stream.export_index(checkpointsPath(path, index_dir))
+            index.checkpoints = True
+    index.save()
+    return index
+
+def loadOrBuild(path, marker, key_pattern=None, index_dir=None, spacing=DEFAULT_SPACING):
+    '''Returns the saved index of path if it is current, or builds it.'''
+    index = GzipIndex.load(path, index_dir=index_dir)
+    if index is None:
+        index = buildIndex(path, marker, key_pattern=key_pattern, index_dir=index_dir, spacing=spacing)
+    return index
+
+class _RangeReader:
+    '''Binary stream over bytes start to end of a decompressed file.'''
+
+    def __init__(self, stream, remaining):
+        self._stream = stream
+        self._remaining = remaining
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining: size = self._remaining
+        data = self._stream.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def readline(self):
+        line = self._stream.readline(self._remaining)
+        self._remaining -= len(line)
+        return line
+
+    def close(self):
+        self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def openRange(path, start, end, index_dir=None):
+    '''Returns a binary stream over uncompressed bytes start to end of gzip
+    file path, starting from the nearest checkpoint if the file's index has
+    them (and indexed_gzip is installed).
+    '''
+    if indexed_gzip is None or not os.path.isfile(checkpointsPath(path, index_dir)):
+        stream = gzip.open(path, 'rb')
+        skip = start
+        while skip > 0:
+            skipped = len(stream.read(min(skip, _READ_BLOCK_SIZE)))
+            if skipped == 0: break
+            skip -= skipped
+    else:
+        stream = indexed_gzip.IndexedGzipFile(path)
+        stream.import_index(checkpointsPath(path, index_dir))
+        stream.seek(start)
+    return _RangeReader(stream, end - start)
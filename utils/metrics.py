@@ -0,0 +1,200 @@
+'''
+Per-stage metrics for the multi-process pipelines, to find which stage
+(readers, tokenizers, writer, ...) is holding a run up.
+
+Each worker process starts recording with startStage(metrics, stage,
+worker_id) and stops with stopStage().  While a stage is recording, every
+utils.batchqueue.BatchQueue the process uses counts the items and bytes
+(of str items) it receives and sends, and the time it spends blocked on get
+and put.  Every interval seconds (checked as batches are sent and received),
+and once more when the stage stops, the process appends its running totals
+and the current depth of each queue (in batches) to the metrics file as a
+JSON line:
+  {"time": ..., "stage": "tokenizer", "worker": 0, "pid": ..., "elapsed": ...,
+   "final": false, "queues": {"input": {"items_in": ..., "items_out": ...,
+   "bytes_in": ..., "bytes_out": ..., "get_wait": ..., "put_wait": ...,
+   "depth": ...}, ...}}
+
+summarize() reads the file back and estimates how busy each stage was;
+logSummary() logs it as a short table, naming the likely bottleneck.
+'''
+
+import collections
+import json
+import os
+import time
+from drgriffis.common import log
+
+DEFAULT_INTERVAL = 5.0
+
+_COUNTERS = ('items_in', 'items_out', 'bytes_in', 'bytes_out', 'get_wait', 'put_wait')
+
+class PipelineMetrics:
+    '''Where and how often to record metrics; passed to each worker.'''
+
+    def __init__(self, path, interval=DEFAULT_INTERVAL):
+        self.path = path
+        self.interval = interval
+
+    def clear(self):
+        '''Empties the metrics file, before starting a run.'''
+        open(self.path, 'w').close()
+
+def itemBytes(items):
+    '''Returns the total length of the str items in items (and of str
+    fields of tuple items), as a cheap measure of data volume.
+    '''
+    total = 0
+    for item in items:
+        if isinstance(item, str):
+            total += len(item)
+        elif isinstance(item, tuple):
+            for field in item:
+                if isinstance(field, str): total += len(field)
+    return total
+
+class StageRecorder:
+
+    def __init__(self, metrics, stage, worker_id):
+        self.metrics = metrics
+        self.stage = stage
+        self.worker_id = worker_id
+        self.start = time.time()
+        self._last_emit = self.start
+        self._counters = collections.OrderedDict()
+        self._queues = {}
+
+    def _queueCounters(self, queue):
+        if not queue.name in self._counters:
+            self._counters[queue.name] = dict([(counter, 0) for counter in _COUNTERS])
+            self._queues[queue.name] = queue
+        return self._counters[queue.name]
+
+    def recordGet(self, queue, n_items, n_bytes, waited):
+        counters = self._queueCounters(queue)
+        counters['items_in'] += n_items
+        counters['bytes_in'] += n_bytes
+        counters['get_wait'] += waited
+        self._emitIfDue()
+
+    def recordPut(self, queue, n_items, n_bytes, waited):
+        counters = self._queueCounters(queue)
+        counters['items_out'] += n_items
+        counters['bytes_out'] += n_bytes
+        counters['put_wait'] += waited
+        self._emitIfDue()
+
+    def _emitIfDue(self):
+        if time.time() - self._last_emit >= self.metrics.interval:
+            self.emit()
+
+    def emit(self, final=False):
+        now = time.time()
+        queues = {}
+        for (name, counters) in self._counters.items():
+            queues[name] = dict(counters)
+            queues[name]['depth'] = self._queues[name].depth()
+        record = {
+            'time': now,
+            'stage': self.stage,
+            'worker': self.worker_id,
+            'pid': os.getpid(),
+            'elapsed': now - self.start,
+            'final': final,
+            'queues': queues,
+        }
+        # one write per line, so lines from different processes don't interleave
+        with open(self.metrics.path, 'a') as stream:
+            stream.write('%s\n' % json.dumps(record))
+        self._last_emit = now
+
+_active = None
+
+def active():
+    '''Returns the StageRecorder for this process, or None if not recording.'''
+    return _active
+
+def startStage(metrics, stage, worker_id=0):
+    '''Starts recording metrics for this process as worker worker_id of
+    stage (does nothing if metrics is None).
+    '''
+    global _active
+    if metrics is None: return
+    _active = StageRecorder(metrics, stage, worker_id)
+
+def stopStage():
+    '''Records final metrics for this process's stage, and stops recording.'''
+    global _active
+    if _active is None: return
+    _active.emit(final=True)
+    _active = None
+
+def summarize(path):
+    '''Reads metrics file path, and returns a dict with
+      stages :: list of per-stage dicts (workers, elapsed, items_in,
+                items_out, bytes_in, bytes_out, and the fractions of worker
+                time busy, blocked on get and blocked on put), in order of
+                first appearance
+      queues :: dict of {max_depth, mean_depth} per queue name
+      bottleneck :: name of the busiest stage
+    '''
+    latest, depths, order = {}, collections.defaultdict(list), []
+    with open(path, 'r') as stream:
+        for line in stream:
+            record = json.loads(line)
+            key = (record['stage'], record['worker'])
+            if not record['stage'] in order: order.append(record['stage'])
+            latest[key] = record
+            for (name, counters) in record['queues'].items():
+                if not counters['depth'] is None: depths[name].append(counters['depth'])
+
+    stages = []
+    for stage in order:
+        records = [record for ((s, _), record) in latest.items() if s == stage]
+        totals = dict([(counter, 0) for counter in _COUNTERS])
+        for record in records:
+            for counters in record['queues'].values():
+                for counter in _COUNTERS:
+                    totals[counter] += counters[counter]
+        worker_time = max(sum([record['elapsed'] for record in records]), 1e-9)
+        summary = {
+            'stage': stage,
+            'workers': len(records),
+            'elapsed': max([record['elapsed'] for record in records]),
+            'get_fraction': totals['get_wait'] / worker_time,
+            'put_fraction': totals['put_wait'] / worker_time,
+        }
+        summary['busy_fraction'] = max(0, 1 - summary['get_fraction'] - summary['put_fraction'])
+        for counter in ('items_in', 'items_out', 'bytes_in', 'bytes_out'):
+            summary[counter] = totals[counter]
+        stages.append(summary)
+
+    return {
+        'stages': stages,
+        'queues': dict([
+            (name, {'max_depth': max(values), 'mean_depth': sum(values) / len(values)})
+                for (name, values) in depths.items()
+        ]),
+        'bottleneck': None if len(stages) == 0 else max(stages, key=lambda s: s['busy_fraction'])['stage'],
+    }
+
+def logSummary(path):
+    '''Logs a short summary of metrics file path (see summarize), and
+    returns the summary.
+    '''
+    summary = summarize(path)
+    log.writeln('Pipeline metrics (see %s):' % path)
+    log.writeln('  %-12s %7s %12s %12s %7s %9s %9s' % (
+        'stage', 'workers', 'items in', 'items out', 'busy', 'get wait', 'put wait'))
+    for stage in summary['stages']:
+        log.writeln('  %-12s %7d %12s %12s %6.1f%% %8.1f%% %8.1f%%' % (
+            stage['stage'], stage['workers'], '{0:,}'.format(stage['items_in']),
+            '{0:,}'.format(stage['items_out']), 100 * stage['busy_fraction'],
+            100 * stage['get_fraction'], 100 * stage['put_fraction']))
+    for (name, depth) in sorted(summary['queues'].items()):
+        log.writeln('  Queue "%s": max depth %d batches, mean %.1f' % (name, depth['max_depth'], depth['mean_depth']))
+    if not summary['bottleneck'] is None:
+        busiest = [s for s in summary['stages'] if s['stage'] == summary['bottleneck']][0]
+        log.writeln('  Likely bottleneck: %s (busy %.1f%% of worker time)' % (
+            summary['bottleneck'], 100 * busiest['busy_fraction']))
+    return summary
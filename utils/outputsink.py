@@ -0,0 +1,272 @@
+'''
+Buffered (optionally compressed) output files, and sharded output written
+directly by worker processes.
+
+An OutputSink for output path OUT hands each worker its own ShardWriter
+(OUT.000, OUT.001, ..., plus .gz or .xz if compressed), so no single writer
+process has to receive every line.  When a shard is closed, its line count
+is recorded next to it (clearCounts() first deletes any left by an earlier
+run); writeManifest() then lists all shards and their line counts in
+OUT.shards.json, and merge() concatenates the shards into OUT (compressed
+shards are concatenated as-is, which is still a valid gzip or xz file).
+
+With format='ids', output is written as token-ID corpora instead of text
+(see utils.tokenids): each shard is a corpus with its own vocabulary, and
+merge() combines them under one vocabulary.
+
+Output path STDOUT ('-') writes to standard output instead (unsharded text
+only); see claimStdout.
+
+To merge shards after the fact:
+    python -m utils.outputsink OUT
+'''
+
+import glob
+import gzip
+import io
+import json
+import lzma
+import os
+import shutil
+import sys
+from . import tokenids
+
+FORMATS = ('text', 'ids')
+COMPRESSIONS = ('none', 'gzip', 'xz')
+_EXTENSIONS = {'none': '', 'gzip': '.gz', 'xz': '.xz'}
+
+DEFAULT_BUFFER_SIZE = 8 * 1024 * 1024
+
+STDOUT = '-'
+
+_stdout_fd = None
+
+def claimStdout():
+    '''Reserves standard output for corpus output, and points file
+    descriptor 1 (and so sys.stdout, and the standard output of child
+    processes started afterwards) at standard error, so that log messages
+    don't end up in the corpus.  Returns the reserved file descriptor.
+
+    Call before logging anything, in the main process; safe to call again.
+    '''
+    global _stdout_fd
+    if _stdout_fd is None:
+        sys.stdout.flush()
+        _stdout_fd = os.dup(1)
+        os.dup2(2, 1)
+    return _stdout_fd
+
+def compressedPath(path, compression):
+    '''Returns path with the file extension for compression added.'''
+    if path == STDOUT: return path
+    return '%s%s' % (path, _EXTENSIONS[compression])
+
+def openOutput(path, compression='none', buffer_size=DEFAULT_BUFFER_SIZE):
+    '''Opens path for writing UTF-8 text through a buffer of buffer_size
+    bytes, compressing with gzip or xz if requested.
+
+    Note that path is used as given (see compressedPath); STDOUT writes to
+    the standard output reserved by claimStdout.
+    '''
+    if not compression in COMPRESSIONS:
+        raise ValueError('Unknown compression "%s"' % compression)
+    if path == STDOUT:
+        raw = open(claimStdout(), 'wb', buffering=0, closefd=False)
+        if compression == 'gzip':
+            raw = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6)
+        elif compression == 'xz':
+            raw = lzma.LZMAFile(raw, 'wb')
+        return io.TextIOWrapper(io.BufferedWriter(raw, buffer_size), encoding='utf-8', newline='\n')
+    if compression == 'none':
+        return open(path, 'w', encoding='utf-8', newline='\n', buffering=buffer_size)
+    elif compression == 'gzip':
+        raw = gzip.open(path, 'wb', compresslevel=6)
+    else:
+        raw = lzma.open(path, 'wb')
+    return io.TextIOWrapper(io.BufferedWriter(raw, buffer_size), encoding='utf-8', newline='\n')
+
+class ShardWriter:
+    '''Writes lines to one shard, counting them.
+
+    Has the put/flush interface of a queue, so it can be handed to code that
+    would otherwise send lines to a writer process, as well as the write
+    method of a stream.
+    '''
+
+    def __init__(self, path, compression='none', buffer_size=DEFAULT_BUFFER_SIZE):
+        self.path = path
+        self.n_lines = 0
+        self._stream = openOutput(path, compression=compression, buffer_size=buffer_size)
+
+    def put(self, line):
+        self.write('%s\n' % line)
+
+    def write(self, text):
+        self._stream.write(text)
+        # count lines as written, in case of embedded newlines
+        self.n_lines += text.count('\n')
+
+    def flush(self):
+        self._stream.flush()
+
+    def close(self):
+        '''Closes the shard and records its line count next to it.'''
+        self._stream.close()
+        with open(_countPath(self.path), 'w') as stream:
+            stream.write('%d\n' % self.n_lines)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class TokenIdShardWriter(tokenids.TokenIdWriter):
+    '''TokenIdWriter that records its line count like a ShardWriter.'''
+
+    def close(self):
+        tokenids.TokenIdWriter.close(self)
+        with open(_countPath(self.path), 'w') as stream:
+            stream.write('%d\n' % self.n_lines)
+
+def _countPath(shard_path):
+    return '%s.linecount' % shard_path
+
+def manifestPath(outf):
+    return '%s.shards.json' % outf
+
+class OutputSink:
+
+    def __init__(self, outf, compression='none', buffer_size=DEFAULT_BUFFER_SIZE, format='text'):
+        '''
+        outf        :: base output path; shards are outf.000, outf.001, ...
+        compression :: one of COMPRESSIONS (text format only)
+        buffer_size :: write buffer size for each shard, in bytes
+        format      :: 'text', or 'ids' to write token-ID corpora
+        '''
+        if not compression in COMPRESSIONS:
+            raise ValueError('Unknown compression "%s"' % compression)
+        if not format in FORMATS:
+            raise ValueError('Unknown output format "%s"' % format)
+        if format == 'ids' and compression != 'none':
+            raise ValueError('Token-ID output cannot be compressed')
+        if outf == STDOUT:
+            if format == 'ids':
+                raise ValueError('Token-ID output cannot be written to standard output')
+            claimStdout()
+        self.outf = outf
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.format = format
+
+    def shardPath(self, shard_id):
+        return compressedPath('%s.%03d' % (self.outf, shard_id), self.compression)
+
+    def shard(self, shard_id):
+        '''Opens and returns the ShardWriter (or TokenIdShardWriter) for shard
+        number shard_id.
+        '''
+        if self.outf == STDOUT:
+            raise ValueError('Sharded output cannot be written to standard output')
+        if self.format == 'ids':
+            return TokenIdShardWriter(self.shardPath(shard_id))
+        return ShardWriter(self.shardPath(shard_id), compression=self.compression,
+            buffer_size=self.buffer_size)
+
+    def open(self):
+        '''Opens and returns a single buffered stream for unsharded output
+        (outf, with the extension for the compression added), or a
+        TokenIdWriter for outf.
+        '''
+        if self.format == 'ids':
+            return tokenids.TokenIdWriter(self.outf)
+        return openOutput(compressedPath(self.outf, self.compression),
+            compression=self.compression, buffer_size=self.buffer_size)
+
+    def _shardBytes(self, shard_path):
+        if self.format == 'ids':
+            return sum([os.path.getsize(f) for f in tokenids.corpusFiles(shard_path)])
+        return os.path.getsize(shard_path)
+
+    def _countPaths(self):
+        return glob.glob(_countPath('%s.[0-9]*' % glob.escape(self.outf)))
+
+    def clearCounts(self):
+        '''Deletes any shard line counts left for outf by an earlier run, so
+        that writeManifest lists only the shards of this one; call before
+        opening any shards.
+        '''
+        for count_path in self._countPaths():
+            os.remove(count_path)
+
+    def writeManifest(self):
+        '''Lists every closed shard and its line count in outf.shards.json,
+        and returns the manifest.
+        '''
+        count_paths = self._countPaths()
+        count_paths.sort(key=lambda path: int(path[len(self.outf)+1:].split('.')[0]))
+        shards = []
+        for count_path in count_paths:
+            shard_path = count_path[:-len('.linecount')]
+            with open(count_path, 'r') as stream:
+                n_lines = int(stream.read())
+            shards.append({
+                'path': os.path.basename(shard_path),
+                'lines': n_lines,
+                'bytes': self._shardBytes(shard_path),
+            })
+            os.remove(count_path)
+        manifest = {
+            'format': self.format,
+            'compression': self.compression,
+            'lines': sum([shard['lines'] for shard in shards]),
+            'shards': shards,
+        }
+        with open(manifestPath(self.outf), 'w') as stream:
+            json.dump(manifest, stream, indent=2)
+        return manifest
+
+    def merge(self, remove_shards=True):
+        '''Concatenates the shards listed in the manifest, in order, into a
+        single output file, and returns its path.
+        '''
+        with open(manifestPath(self.outf), 'r') as stream:
+            manifest = json.load(stream)
+        dirname = os.path.dirname(self.outf)
+        if manifest.get('format', 'text') == 'ids':
+            tokenids.mergeCorpora([os.path.join(dirname, shard['path']) for shard in manifest['shards']],
+                self.outf, remove=remove_shards)
+            if remove_shards:
+                os.remove(manifestPath(self.outf))
+            return self.outf
+
+        merged = compressedPath(self.outf, manifest['compression'])
+        with open(merged, 'wb') as out_stream:
+            for shard in manifest['shards']:
+                shard_path = os.path.join(dirname, shard['path'])
+                with open(shard_path, 'rb') as in_stream:
+                    shutil.copyfileobj(in_stream, out_stream, DEFAULT_BUFFER_SIZE)
+        if remove_shards:
+            for shard in manifest['shards']:
+                os.remove(os.path.join(dirname, shard['path']))
+            os.remove(manifestPath(self.outf))
+        return merged
+
+if __name__ == '__main__':
+    def _cli():
+        import optparse
+        parser = optparse.OptionParser(usage='Usage: %prog OUTPUT',
+                description='Merges the shards listed in OUTPUT.shards.json into a single OUTPUT file')
+        parser.add_option('--keep-shards', dest='keep_shards',
+                action='store_true', default=False,
+                help='keep the shards and manifest after merging')
+        (options, args) = parser.parse_args()
+        if len(args) != 1:
+            parser.print_help()
+            exit()
+        return args, options
+    (outf,), options = _cli()
+    with open(manifestPath(outf), 'r') as stream:
+        manifest = json.load(stream)
+    sink = OutputSink(outf, compression=manifest['compression'], format=manifest.get('format', 'text'))
+    print(sink.merge(remove_shards=not options.keep_shards))
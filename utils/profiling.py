@@ -0,0 +1,120 @@
+'''
+Opt-in cProfile profiling of the worker processes in the multi-process
+pipelines, where profiling the main process alone shows little.
+
+Each worker process starts profiling with start(profiles, stage, worker_id)
+and stops with stop(), which saves its profile as PREFIX.STAGE.WORKER.prof.
+Pool workers are profiled by passing startPoolWorker as the pool initializer;
+their profiles are saved when the pool is closed and joined.
+
+Once all workers are done, merge() combines the profiles of each stage into
+PREFIX.STAGE.prof (readable with pstats or snakeviz), deletes the
+per-process profiles, and writes PREFIX.txt, listing the functions with the
+most own time in each stage.
+'''
+
+import cProfile
+import glob
+import io
+import os
+import pstats
+import re
+from multiprocessing import util
+from drgriffis.common import log
+
+DEFAULT_TOP_N = 25
+
+class ProcessProfiles:
+    '''Where to save profiles; passed to each worker.'''
+
+    def __init__(self, prefix, top_n=DEFAULT_TOP_N):
+        self.prefix = prefix
+        self.top_n = top_n
+
+    def partialPath(self, stage, worker_id):
+        return '%s.%s.%d.prof' % (self.prefix, stage, worker_id)
+
+    def stagePath(self, stage):
+        return '%s.%s.prof' % (self.prefix, stage)
+
+    def reportPath(self):
+        return '%s.txt' % self.prefix
+
+    def partialPaths(self):
+        '''Returns a dict of {stage: [per-process profile paths]}.'''
+        pattern = re.compile(r'^%s\.([\w-]+)\.\d+\.prof$' % re.escape(self.prefix))
+        paths = {}
+        for path in sorted(glob.glob('%s.*.*.prof' % glob.escape(self.prefix))):
+            match = pattern.match(path)
+            if match:
+                paths.setdefault(match.group(1), []).append(path)
+        return paths
+
+    def clear(self):
+        '''Deletes per-process profiles left over from an earlier run.'''
+        for paths in self.partialPaths().values():
+            for path in paths:
+                os.remove(path)
+
+class _ActiveProfile:
+
+    def __init__(self, profiles, stage, worker_id):
+        self.path = profiles.partialPath(stage, worker_id)
+        self.profiler = cProfile.Profile()
+
+_active = None
+
+def start(profiles, stage, worker_id=0):
+    '''Starts profiling this process as worker worker_id of stage (does
+    nothing if profiles is None).
+    '''
+    global _active
+    if profiles is None: return
+    _active = _ActiveProfile(profiles, stage, worker_id)
+    _active.profiler.enable()
+
+def stop():
+    '''Stops profiling this process, and saves its profile.'''
+    global _active
+    if _active is None: return
+    _active.profiler.disable()
+    _active.profiler.dump_stats(_active.path)
+    _active = None
+
+def startPoolWorker(profiles, stage):
+    '''multiprocessing.Pool initializer; profiles each pool worker as part of
+    stage, saving its profile when the worker exits.
+    '''
+    global _active
+    if profiles is None: return
+    # a forked worker inherits its parent's running profiler; discard it
+    # without saving, as it would overwrite the parent's profile
+    if not _active is None:
+        _active.profiler.disable()
+        _active = None
+    start(profiles, stage, os.getpid())
+    util.Finalize(None, stop, exitpriority=10)
+
+def merge(profiles):
+    '''Merges the per-process profiles of each stage (see module
+    documentation), writes the report, and logs the top few functions of
+    each stage.
+    '''
+    report = io.StringIO()
+    log.writeln('Profiles (see %s):' % profiles.reportPath())
+    for (stage, paths) in sorted(profiles.partialPaths().items()):
+        stats = pstats.Stats(*paths, stream=report)
+        stats.dump_stats(profiles.stagePath(stage))
+        for path in paths:
+            os.remove(path)
+
+        report.write('=== %s: %d process%s, %.2fs total ===\n' % (
+            stage, len(paths), '' if len(paths) == 1 else 'es', stats.total_tt))
+        stats.strip_dirs().sort_stats('tottime', 'cumulative').print_stats(profiles.top_n)
+
+        log.writeln('  %s (%d process%s, %.2fs):' % (stage, len(paths), '' if len(paths) == 1 else 'es', stats.total_tt))
+        for func in stats.fcn_list[:3]:
+            (_, _, tottime, cumtime, _) = stats.stats[func]
+            log.writeln('    %7.2fs own %7.2fs cumulative  %s' % (tottime, cumtime, pstats.func_std_string(func)))
+    with open(profiles.reportPath(), 'w') as stream:
+        stream.write(report.getvalue())
@@ -0,0 +1,123 @@
+'''
+Pure-Python approximation of the CoreNLP tokenize and ssplit annotators, for
+tokenizing without starting a CoreNLP server.
+
+Follows PTB conventions as CoreNLP applies them: brackets are escaped
+(-LRB-, -RRB-, -LSB-, ...), double quotes become `` and '', common
+contractions are split (do n't, I 'm, John 's), periods are split from words
+except in acronyms and known abbreviations, and sentences end after ., ! or ?
+(and any closing quotes or brackets), or at a blank line.
+
+Agreement with CoreNLP on a sample corpus can be measured with
+    python -m utils.corenlp --sample=FILE
+'''
+
+import re
+
+_BLANK_LINE = re.compile(r'\n[^\S\n]*\n\s*')
+
+_TOKEN = re.compile(r'''
+      (?P<url>(?:https?://|www\.)[^\s<>"]*[^\s<>".,;:!?)\]}'])
+    | (?P<acronym>(?:[A-Za-z]\.){2,}(?![A-Za-z0-9]))
+    | (?P<word>\w+(?:[-&'’]\w+|(?<=[0-9])[.,:/][0-9]+)*)
+    | (?P<ellipsis>\.{2,}|…)
+    | (?P<terminal>[!?]+)
+    | (?P<dashes>-{2,}|[–—])
+    | (?P<quote>``|''|["“”‘’'`])
+    | (?P<other>[^\w\s])
+''', re.X)
+
+_CONTRACTION = re.compile(r"^(.+?)(n't|'s|'re|'ve|'ll|'d|'m)$", re.I)
+
+_ESCAPES = {
+    '(': '-LRB-',
+    ')': '-RRB-',
+    '[': '-LSB-',
+    ']': '-RSB-',
+    '{': '-LCB-',
+    '}': '-RCB-',
+}
+
+_ABBREVIATIONS = set([
+    'mr', 'mrs', 'ms', 'dr', 'prof', 'sr', 'jr', 'st', 'mt', 'ft',
+    'gen', 'gov', 'sen', 'rep', 'rev', 'lt', 'col', 'maj', 'capt', 'sgt', 'adm', 'cmdr',
+    'inc', 'ltd', 'co', 'corp', 'bros', 'dept', 'univ', 'assn',
+    'vs', 'etc', 'vol', 'pp', 'fig', 'approx',
+    'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov', 'dec',
+    'ave', 'blvd', 'rd',
+    # state abbreviations that aren't also common words
+    'ala', 'ariz', 'calif', 'colo', 'conn', 'fla', 'ga', 'kan', 'ky', 'md', 'mich',
+    'minn', 'mont', 'neb', 'nev', 'okla', 'tenn', 'tex', 'va', 'vt', 'wis', 'wyo',
+])
+
+_SENTENCE_FOLLOWERS = set(["''", "'", '-RRB-', '-RSB-', '-RCB-'])
+_OPENING_CONTEXT = set(['', ' ', '\t', '\n', '(', '[', '{', '-', '—', '–'])
+
+def _quoteToken(quote, preceding):
+    if quote in ('``', "''"): return quote
+    if quote == '“': return '``'
+    if quote == '”': return "''"
+    if quote in ('`', '‘'): return '`'
+    opening = preceding in _OPENING_CONTEXT
+    if quote == '"': return '``' if opening else "''"
+    # ' and ’
+    return '`' if opening else "'"
+
+def tokenize(text):
+    '''Returns the list of PTB-style tokens in text.'''
+    tokens = []
+    matches = list(_TOKEN.finditer(text))
+    for (i, m) in enumerate(matches):
+        kind, token = m.lastgroup, m.group()
+        if kind == 'word':
+            token = token.replace('’', "'")
+            # keep the period of a known abbreviation (Mr., Calif.)
+            if (text[m.end():m.end()+1] == '.' and text[m.end()+1:m.end()+2] != '.'
+                    and token.lower() in _ABBREVIATIONS):
+                token += '.'
+            contraction = _CONTRACTION.match(token)
+            if contraction and len(contraction.group(1)) > 0:
+                tokens.extend(contraction.groups())
+            else:
+                tokens.append(token)
+        elif kind == 'other' and token == '.' and len(tokens) > 0 and tokens[-1][-1:] == '.' \
+                and matches[i-1].end() == m.start() and matches[i-1].lastgroup == 'word':
+            # period already attached to an abbreviation
+            continue
+        elif kind == 'ellipsis':
+            tokens.append('...')
+        elif kind == 'dashes':
+            tokens.append('--')
+        elif kind == 'quote':
+            tokens.append(_quoteToken(token, text[m.start()-1:m.start()]))
+        elif kind == 'other':
+            tokens.append(_ESCAPES.get(token, token))
+        else:
+            tokens.append(token)
+    return tokens
+
+def splitSentences(tokens):
+    '''Splits a list of tokens into a list of sentences (lists of tokens).'''
+    sentences, current = [], []
+    i = 0
+    while i < len(tokens):
+        current.append(tokens[i])
+        if tokens[i] == '.' or tokens[i][0] in '!?':
+            while i + 1 < len(tokens) and tokens[i+1] in _SENTENCE_FOLLOWERS:
+                i += 1
+                current.append(tokens[i])
+            sentences.append(current)
+            current = []
+        i += 1
+    if len(current) > 0:
+        sentences.append(current)
+    return sentences
+
+def tokenizeSentences(text):
+    '''Returns the sentences (lists of tokens) in text, as CoreNLP's
+    tokenize and ssplit annotators would (approximately).
+    '''
+    sentences = []
+    for block in _BLANK_LINE.split(text):
+        sentences.extend(splitSentences(tokenize(block)))
+    return sentences
@@ -1,6 +1,11 @@
-import codecs
+import itertools
+import mmap
+import os
+import multiprocessing as mp
 from drgriffis.common import log
 
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+
 PUNCTUATION = set([
     ',',
     '.',
@@ -42,26 +47,112 @@ def filterTokens(tokens):
             new_tokens.append(t)
     return new_tokens
 
-def cleanPreTokenizedCorpus(inf, outf):
-    log.track(message='  >> Processed {0:,} lines', writeInterval=10000)
-    with codecs.open(inf, 'r', 'utf-8') as in_stream:
-        with codecs.open(outf, 'w', 'utf-8') as out_stream:
-            for line in in_stream:
-                tokens = [s.strip() for s in line.split()]
-                tokens = filterTokens(tokens)
-                out_stream.write(' '.join(tokens))
-                out_stream.write('\n')
-                log.tick()
-    log.flushTracker()
+def _caseVariants(token):
+    return set([
+        ''.join(chars)
+            for chars in itertools.product(*[(c.lower(), c.upper()) for c in token])
+    ])
+
+# every casing of every punctuation token, so tokens can be checked without
+# lowercasing each one (only ASCII characters lowercase to the letters used)
+_PUNCTUATION_ANY_CASE = frozenset().union(*[_caseVariants(p) for p in PUNCTUATION])
+
+def cleanText(text):
+    '''Removes punctuation tokens from each line of text (a str holding whole
+    lines), and returns the cleaned lines, each ending in a newline.
+    '''
+    punctuation = _PUNCTUATION_ANY_CASE
+    return ''.join([
+        '%s\n' % ' '.join([t for t in line.split() if not t in punctuation])
+            for line in text.splitlines()
+    ])
+
+def lineAlignedRanges(inf, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Splits file inf into byte ranges (start, end) of about chunk_size bytes,
+    each ending just after a newline (or at the end of the file).
+    '''
+    size = os.path.getsize(inf)
+    if size == 0: return []
+    ranges = []
+    with open(inf, 'rb') as stream:
+        with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = 0
+            while start < size:
+                end = data.find(b'\n', min(start + chunk_size, size) - 1)
+                end = size if end < 0 else end + 1
+                ranges.append((start, end))
+                start = end
+    return ranges
+
+def _cleanRange(args):
+    (inf, start, end, shardf) = args
+    with open(inf, 'rb') as stream:
+        with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            text = data[start:end].decode('utf-8')
+    cleaned = cleanText(text).encode('utf-8')
+    if shardf is None:
+        return cleaned
+    with open(shardf, 'wb') as out_stream:
+        out_stream.write(cleaned)
+    return shardf
+
+def cleanPreTokenizedCorpus(inf, outf, workers=1, sharded=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Removes punctuation tokens from every line of pre-tokenized corpus inf,
+    and writes the cleaned corpus to outf.
+
+    The input is memory-mapped and split into newline-aligned ranges of about
+    chunk_size bytes, which are cleaned in a pool of workers processes and
+    written back in order.  If sharded is True, each range is written to its
+    own shard (outf.000, outf.001, ...) instead.
+    '''
+    ranges = lineAlignedRanges(inf, chunk_size=chunk_size)
+    if sharded:
+        shardfs = ['%s.%03d' % (outf, i) for i in range(len(ranges))]
+    else:
+        shardfs = [None for _ in ranges]
+    tasks = [(inf, start, end, shardf) for ((start, end), shardf) in zip(ranges, shardfs)]
+
+    if workers > 1:
+        pool = mp.Pool(workers)
+        results = pool.imap(_cleanRange, tasks)
+    else:
+        pool = None
+        results = map(_cleanRange, tasks)
+
+    log.track(message='  >> Processed {0:,}/{1:,} chunks', writeInterval=1)
+    if sharded:
+        for _ in results:
+            log.tick(len(ranges))
+    else:
+        with open(outf, 'wb') as out_stream:
+            for cleaned in results:
+                out_stream.write(cleaned)
+                log.tick(len(ranges))
+    log.flushTracker(len(ranges))
+
+    if not pool is None:
+        pool.close()
+        pool.join()
 
 if __name__ == '__main__':
     def _cli():
         import optparse
         parser = optparse.OptionParser(usage='Usage: %prog IN OUT')
+        parser.add_option('--workers', dest='workers',
+                type='int', default=1,
+                help='number of processes to clean chunks of IN in parallel (default: %default)')
+        parser.add_option('--chunk-size', dest='chunk_size',
+                type='int', default=DEFAULT_CHUNK_SIZE // (1024 * 1024),
+                help='approximate size of each chunk of IN, in MB (default: %default)')
+        parser.add_option('--shard', dest='sharded',
+                action='store_true', default=False,
+                help='write each cleaned chunk to its own shard (OUT.000, OUT.001, ...)'
+                     ' instead of a single OUT file')
         (options, args) = parser.parse_args()
         if len(args) != 2:
             parser.print_help()
             exit()
-        return args
-    inf, outf = _cli()
-    cleanPreTokenizedCorpus(inf, outf)
+        return args, options
+    (inf, outf), options = _cli()
+    cleanPreTokenizedCorpus(inf, outf, workers=options.workers, sharded=options.sharded,
+        chunk_size=options.chunk_size * 1024 * 1024)
@@ -0,0 +1,166 @@
+'''
+On-disk cache of tokenize/ssplit output, so that reruns over the same text
+(e.g., with different lowercasing or punctuation settings) skip the
+tokenizer.
+
+Entries are keyed by a hash of the tokenizer backend name and the input
+text (after digitsToZero), and store the sentence and token structure as
+compressed, separator-delimited UTF-8.  The cache is a SQLite database that
+several tokenizer processes can share; once it grows past max_bytes, least
+recently used entries are evicted.  Lookups are read-only: the entries
+they hit are marked as used in batches (with the next put, every
+_USED_FLUSH_SIZE hits or _USED_FLUSH_INTERVAL seconds, and on close), so
+that reruns served from the cache don't serialize on writes.
+'''
+
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+
+DEFAULT_MAX_BYTES = 8 * 1024**3
+# evict down to this fraction of max_bytes, so eviction doesn't run on every put
+_EVICT_TO = 0.9
+_USED_FLUSH_SIZE = 10000
+_USED_FLUSH_INTERVAL = 60.0
+
+_TOKEN_SEPARATOR = '\x1f'
+_SENTENCE_SEPARATOR = '\x1e'
+
+def _encode(sentences):
+    return zlib.compress(_SENTENCE_SEPARATOR.join([
+        _TOKEN_SEPARATOR.join(sentence)
+            for sentence in sentences
+    ]).encode('utf-8'), 1)
+
+def _decode(value):
+    value = zlib.decompress(value).decode('utf-8')
+    if len(value) == 0: return []
+    return [
+        sentence.split(_TOKEN_SEPARATOR)
+            for sentence in value.split(_SENTENCE_SEPARATOR)
+    ]
+
+class TokenizationCache:
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        '''
+        path      :: SQLite file to keep the cache in (created if missing)
+        max_bytes :: maximum total size of cached values
+        '''
+        self.path = path
+        self.max_bytes = max_bytes
+        self._connection = None
+        self._lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+        # key -> time of last hit, not yet written back
+        self._used = {}
+        self._last_used_flush = time.time()
+
+    # connections can't be shared across processes; open one in each
+    def __getstate__(self):
+        return (self.path, self.max_bytes)
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=600, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS tokens '
+                '(key BLOB PRIMARY KEY, value BLOB, size INTEGER, used REAL)'
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS tokens_used ON tokens (used)')
+            self._connection.commit()
+            self._total_bytes = self._connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM tokens').fetchone()[0]
+        return self._connection
+
+    def key(self, text, namespace=''):
+        '''Returns the cache key for text; namespace (e.g., the tokenizer
+        backend name) keeps different tokenizers from sharing entries.
+        '''
+        return hashlib.blake2b(
+            ('%s\0%s' % (namespace, text)).encode('utf-8'),
+            digest_size=16
+        ).digest()
+
+    def getMany(self, keys):
+        '''Returns a dict mapping each cached key in keys to its list of
+        sentences (lists of tokens), and marks those entries as used (see
+        module docstring).
+        '''
+        found = {}
+        if len(keys) == 0: return found
+        with self._lock:
+            connection = self._connect()
+            unique_keys = list(set(keys))
+            # stay under SQLite's limit on query parameters
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i:i+500]
+                marks = ','.join(['?'] * len(chunk))
+                for (key, value) in connection.execute(
+                        'SELECT key, value FROM tokens WHERE key IN (%s)' % marks, chunk):
+                    found[key] = _decode(value)
+            self.hits += len([k for k in keys if k in found])
+            self.misses += len([k for k in keys if not k in found])
+            now = time.time()
+            for key in found:
+                self._used[key] = now
+            if len(self._used) >= _USED_FLUSH_SIZE or now - self._last_used_flush >= _USED_FLUSH_INTERVAL:
+                self._flushUsed(connection)
+                connection.commit()
+        return found
+
+    def _flushUsed(self, connection):
+        # writes back the times of hits since the last flush (uncommitted)
+        if len(self._used) > 0:
+            connection.executemany('UPDATE tokens SET used=? WHERE key=?',
+                [(used, key) for (key, used) in self._used.items()])
+            self._used = {}
+        self._last_used_flush = time.time()
+
+    def putMany(self, entries):
+        '''Caches each (key, sentences) pair in entries, evicting least
+        recently used entries if the cache is over max_bytes.
+        '''
+        if len(entries) == 0: return
+        with self._lock:
+            connection = self._connect()
+            now = time.time()
+            rows = []
+            for (key, sentences) in entries:
+                value = _encode(sentences)
+                rows.append((key, value, len(value), now))
+            self._flushUsed(connection)
+            connection.executemany('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)', rows)
+            connection.commit()
+            self._total_bytes += sum([row[2] for row in rows])
+            if self._total_bytes > self.max_bytes:
+                self._evict(connection)
+
+    def _evict(self, connection):
+        # other processes write too; recount before deciding what to drop
+        self._total_bytes = connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM tokens').fetchone()[0]
+        to_free = self._total_bytes - int(self.max_bytes * _EVICT_TO)
+        if to_free <= 0: return
+        freed, stale = 0, []
+        for (key, size) in connection.execute('SELECT key, size FROM tokens ORDER BY used'):
+            if freed >= to_free: break
+            stale.append((key,))
+            freed += size
+        connection.executemany('DELETE FROM tokens WHERE key=?', stale)
+        connection.commit()
+        self._total_bytes -= freed
+
+    def close(self):
+        if not self._connection is None:
+            with self._lock:
+                self._flushUsed(self._connection)
+                self._connection.commit()
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,276 @@
+'''
+Binary token-ID corpus format, for handing extracted corpora to trainers
+without re-reading and re-tokenizing text.
+
+A corpus at path OUT is four files:
+  OUT.vocab     one "token<TAB>count" line per token type; a token's ID is
+                its line number (from 0)
+  OUT.ids       every token ID in the corpus, as little-endian uint32
+  OUT.lines     little-endian uint64 offsets into OUT.ids of the start of
+                each line (sentence or document, as the extractor wrote
+                them), plus the total number of tokens
+  OUT.docs      little-endian uint64 offsets into OUT.lines of the start of
+                each document, plus the total number of lines (if the
+                extractor marks no documents, each line is a document)
+
+TokenIdWriter takes lines of whitespace-separated tokens in place of a text
+stream, numbering tokens in order of first appearance; each worker process
+writes its own corpus with its own vocabulary.  mergeCorpora combines them
+into one corpus whose vocabulary is sorted by total count.  TokenIdCorpus
+memory-maps a corpus for reading, returning memoryviews that numpy can wrap
+without copying, e.g. numpy.frombuffer(corpus.line(i), dtype='<u4').
+
+To merge worker corpora after the fact:
+    python -m utils.tokenids OUT SHARD1 SHARD2 ...
+'''
+
+import array
+import collections
+import mmap
+import os
+import sys
+
+EXTENSIONS = ('.vocab', '.ids', '.lines', '.docs')
+
+_ID_TYPE = 'I'
+_OFFSET_TYPE = 'Q'
+_FLUSH_EVERY = 1024 * 1024
+_MERGE_CHUNK = 4 * 1024 * 1024
+
+def corpusFiles(path):
+    '''Returns the paths of the files making up the corpus at path.'''
+    return ['%s%s' % (path, ext) for ext in EXTENSIONS]
+
+def _writeArray(stream, values):
+    if sys.byteorder != 'little': values.byteswap()
+    values.tofile(stream)
+
+def _readArray(path, typecode):
+    values = array.array(typecode)
+    with open(path, 'rb') as stream:
+        values.frombytes(stream.read())
+    if sys.byteorder != 'little': values.byteswap()
+    return values
+
+def _writeVocab(path, vocab):
+    with open(path, 'w', encoding='utf-8') as stream:
+        for (token, count) in vocab:
+            stream.write('%s\t%d\n' % (token, count))
+
+def readVocab(path):
+    '''Returns the list of (token, count) pairs in vocabulary file path.'''
+    vocab = []
+    with open(path, 'r', encoding='utf-8') as stream:
+        for line in stream:
+            (token, count) = line.rstrip('\n').rsplit('\t', 1)
+            vocab.append((token, int(count)))
+    return vocab
+
+class TokenIdWriter:
+    '''Writes lines of whitespace-separated tokens as a token-ID corpus.
+
+    Has the put/write/flush interface of the text writers in
+    utils.outputsink, so it can stand in for one.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.n_lines = 0
+        self.n_tokens = 0
+        self._n_docs = 0
+        self._doc_start = 0
+        self._ids = {}
+        self._counts = []
+        self._partial = ''
+        self._ids_stream = open('%s.ids' % path, 'wb')
+        self._lines_stream = open('%s.lines' % path, 'wb')
+        self._docs_stream = open('%s.docs' % path, 'wb')
+        self._id_buffer = array.array(_ID_TYPE)
+        self._line_buffer = array.array(_OFFSET_TYPE, [0])
+        self._doc_buffer = array.array(_OFFSET_TYPE, [0])
+
+    def put(self, line):
+        '''Adds one line (sentence or document) of tokens.'''
+        ids, counts, id_buffer = self._ids, self._counts, self._id_buffer
+        n_before = len(id_buffer)
+        for token in line.split():
+            token_id = ids.get(token)
+            if token_id is None:
+                token_id = ids[token] = len(counts)
+                counts.append(0)
+            counts[token_id] += 1
+            id_buffer.append(token_id)
+        self.n_tokens += len(id_buffer) - n_before
+        self.n_lines += 1
+        self._line_buffer.append(self.n_tokens)
+        if len(id_buffer) >= _FLUSH_EVERY or len(self._line_buffer) >= _FLUSH_EVERY:
+            self.flush()
+
+    def write(self, text):
+        '''Adds each complete line in text; a trailing partial line is held
+        until the rest of it is written.
+        '''
+        lines = (self._partial + text).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self.put(line)
+
+    def endDocument(self):
+        '''Marks the lines added since the last call as one document.'''
+        if self.n_lines > self._doc_start:
+            self._doc_buffer.append(self.n_lines)
+            self._doc_start = self.n_lines
+            self._n_docs += 1
+
+    def flush(self):
+        for (stream, buffer) in [
+                    (self._ids_stream, self._id_buffer),
+                    (self._lines_stream, self._line_buffer),
+                    (self._docs_stream, self._doc_buffer),
+                ]:
+            _writeArray(stream, buffer)
+            stream.flush()
+        self._id_buffer = array.array(_ID_TYPE)
+        self._line_buffer = array.array(_OFFSET_TYPE)
+        self._doc_buffer = array.array(_OFFSET_TYPE)
+
+    def close(self):
+        if len(self._partial) > 0:
+            self.put(self._partial)
+            self._partial = ''
+        if self._n_docs == 0:
+            # no documents marked; each line is its own document
+            for start in range(1, self.n_lines + 1, _FLUSH_EVERY):
+                self._doc_buffer.extend(range(start, min(start + _FLUSH_EVERY, self.n_lines + 1)))
+                self.flush()
+        else:
+            self.endDocument()
+        self.flush()
+        for stream in (self._ids_stream, self._lines_stream, self._docs_stream):
+            stream.close()
+        tokens = [None] * len(self._counts)
+        for (token, token_id) in self._ids.items():
+            tokens[token_id] = token
+        _writeVocab('%s.vocab' % self.path, zip(tokens, self._counts))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def mergeCorpora(paths, outf, remove=False):
+    '''Merges the token-ID corpora at paths, in order, into one corpus at
+    outf, with a vocabulary sorted by descending total count (ties broken by
+    token).  If remove is True, the merged corpora are deleted.
+    '''
+    vocabs = [readVocab('%s.vocab' % path) for path in paths]
+    counts = collections.Counter()
+    for vocab in vocabs:
+        for (token, count) in vocab:
+            counts[token] += count
+    merged_vocab = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    global_ids = dict([(token, i) for (i, (token, _)) in enumerate(merged_vocab)])
+    _writeVocab('%s.vocab' % outf, merged_vocab)
+
+    (n_tokens, n_lines) = (0, 0)
+    out_paths = ['%s%s' % (outf, ext) for ext in ('.ids', '.lines', '.docs')]
+    with open(out_paths[0], 'wb') as ids_stream, open(out_paths[1], 'wb') as lines_stream, \
+            open(out_paths[2], 'wb') as docs_stream:
+        _writeArray(lines_stream, array.array(_OFFSET_TYPE, [0]))
+        _writeArray(docs_stream, array.array(_OFFSET_TYPE, [0]))
+        for (path, vocab) in zip(paths, vocabs):
+            mapping = [global_ids[token] for (token, _) in vocab]
+            with open('%s.ids' % path, 'rb') as in_stream:
+                while True:
+                    chunk = in_stream.read(_MERGE_CHUNK)
+                    if len(chunk) == 0: break
+                    local_ids = array.array(_ID_TYPE)
+                    local_ids.frombytes(chunk)
+                    if sys.byteorder != 'little': local_ids.byteswap()
+                    _writeArray(ids_stream, array.array(_ID_TYPE, [mapping[i] for i in local_ids]))
+            # shift each corpus's offsets past the ones merged before it
+            line_offsets = _readArray('%s.lines' % path, _OFFSET_TYPE)
+            _writeArray(lines_stream, array.array(_OFFSET_TYPE, [n_tokens + offset for offset in line_offsets[1:]]))
+            doc_offsets = _readArray('%s.docs' % path, _OFFSET_TYPE)
+            _writeArray(docs_stream, array.array(_OFFSET_TYPE, [n_lines + offset for offset in doc_offsets[1:]]))
+            n_tokens += line_offsets[-1]
+            n_lines += len(line_offsets) - 1
+
+    if remove:
+        for path in paths:
+            for f in corpusFiles(path):
+                os.remove(f)
+
+def _mapArray(path, typecode):
+    with open(path, 'rb') as stream:
+        if os.fstat(stream.fileno()).st_size == 0:
+            return None, memoryview(b'').cast(typecode)
+        mapped = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    return mapped, memoryview(mapped).cast(typecode)
+
+class TokenIdCorpus:
+    '''Read access to a token-ID corpus, memory-mapped.
+
+    tokens, line(i) and document(i) return memoryviews of uint32 token IDs;
+    line_offsets and doc_offsets are memoryviews of uint64 offsets (see the
+    module docstring).  Assumes a little-endian machine.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.vocab = [token for (token, _) in readVocab('%s.vocab' % path)]
+        self._maps = []
+        for (attr, ext, typecode) in [
+                    ('tokens', '.ids', _ID_TYPE),
+                    ('line_offsets', '.lines', _OFFSET_TYPE),
+                    ('doc_offsets', '.docs', _OFFSET_TYPE),
+                ]:
+            (mapped, view) = _mapArray('%s%s' % (path, ext), typecode)
+            self._maps.append((mapped, view))
+            setattr(self, attr, view)
+
+    def __len__(self):
+        '''Number of lines.'''
+        return len(self.line_offsets) - 1
+
+    def numDocuments(self):
+        return len(self.doc_offsets) - 1
+
+    def line(self, i):
+        return self.tokens[self.line_offsets[i]:self.line_offsets[i+1]]
+
+    def document(self, i):
+        return self.tokens[self.line_offsets[self.doc_offsets[i]]:self.line_offsets[self.doc_offsets[i+1]]]
+
+    def words(self, ids):
+        '''Returns the token strings for a sequence of IDs.'''
+        return [self.vocab[i] for i in ids]
+
+    def close(self):
+        for (mapped, view) in self._maps:
+            view.release()
+            if not mapped is None: mapped.close()
+        self._maps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+if __name__ == '__main__':
+    def _cli():
+        import optparse
+        parser = optparse.OptionParser(usage='Usage: %prog OUTPUT CORPUS [CORPUS ...]',
+                description='Merges token-ID corpora (e.g., one per worker process) into OUTPUT')
+        parser.add_option('--remove', dest='remove',
+                action='store_true', default=False,
+                help='delete the input corpora after merging')
+        (options, args) = parser.parse_args()
+        if len(args) < 2:
+            parser.print_help()
+            exit()
+        return args, options
+    (outf, *paths), options = _cli()
+    mergeCorpora(paths, outf, remove=options.remove)
@@ -1,5 +1,9 @@
 INFILE=
-TMPFILE=${INFILE}.tmp
 OUTFILE=
 PY=python
+WORKERS=4
+# multistream target only
+INDEX=
+# parity target only
+SAMPLE=sample.xml
 PRL=perl
@@ -3,36 +3,569 @@ Script to extract only article pages from a Wikipedia data dump
 '''
 
 import codecs
+import bz2
+import functools
+import os
+import multiprocessing as mp
+import queue
+import traceback
 import parser
+import wikifil
 from denis.common.logging import log
 
-def extractAllArticles(infile, outfile):
-    log.track(message='  >> Extracted {0} articles...', writeInterval=5)
+ENGINES = ('stream', 'soup')
+FORMATS = ('xml', 'text', 'ids')
+# what the multistream workers send back for iterArticles
+_PAGES, _CLEANED = 'pages', 'cleaned'
+
+class _SIGNALS:
+    HALT = -1
+
+# seconds to wait for a multistream worker's result before checking that
+# the workers are still alive
+_RESULT_TIMEOUT = 5.0
+
+class _WorkerError:
+    # sent by a multistream worker whose task raised an exception
+    def __init__(self, worker_id, details):
+        self.worker_id = worker_id
+        self.details = details
+
+def formatPages(pages, output_format, stats=None, entries=None):
+    '''Returns the output string for a list of Page records.
+
+    output_format :: 'xml' to write each page as XML, or 'text' (or 'ids')
+                     to write the article text cleaned as wikifil.pl would
+    stats         :: utils.corpusstats.CorpusStats to count cleaned articles
+                     in (not used for XML)
+    entries       :: list to append the (page id, length in bytes) of each
+                     written article to, for the document index (see
+                     _indexEntries)
+    '''
+    if output_format == 'xml':
+        xml = ['%s\n' % parser.pageToXML(page) for page in pages]
+        if not entries is None:
+            entries.extend([(page.id, len(x.encode('utf-8'))) for (page, x) in zip(pages, xml)])
+        return ''.join(xml)
+    else:
+        return _cleanTexts([page.text for page in pages], stats=stats, ids=[page.id for page in pages],
+            entries=entries, output_format=output_format)
+
+def _cleanTexts(texts, stats=None, ids=None, entries=None, output_format='text'):
+    cleaned = [wikifil.cleanArticleText(text) for text in texts]
+    if not stats is None:
+        for c in cleaned:
+            if c is None: continue
+            stats.addLine(c.split())
+            stats.endDocument()
+    if not entries is None:
+        # each article is indexed with the newline that follows it
+        entries.extend([
+            (page_id, len(c.encode('utf-8')) + 1)
+                for (page_id, c) in zip(ids, cleaned)
+                    if not c is None
+        ])
+    # token-ID corpora are one article per line, with no empty lines
+    if output_format == 'ids':
+        return ''.join(['%s\n' % c for c in cleaned if not c is None])
+    # wikifil.pl starts each article with a newline
+    return ''.join(['\n%s' % c for c in cleaned if not c is None])
+
+def _openIndex(outfile, output_format):
+    doc_index = _docIndex().DocumentIndexWriter(outfile)
+    # skip the newline starting the first article (see _cleanTexts)
+    if output_format != 'xml': doc_index.skip(1)
+    return doc_index
+
+def _indexEntries(doc_index, entries):
+    if doc_index is None: return
+    for (page_id, n_bytes) in entries:
+        doc_index.add(page_id, n_bytes)
+
+def _formatFooter(output_format):
+    # ...and ends its output with one
+    return '\n' if output_format == 'text' else ''
+
+def _openOutput(outfile, output_format):
+    if output_format == 'ids':
+        # only needed for token-ID output; requires the repository root on
+        # the Python path
+        from utils import tokenids
+        return tokenids.TokenIdWriter(outfile)
+    if outfile == '-':
+        return _outputSink().openOutput(outfile)
+    return codecs.open(outfile, 'w', 'utf-8')
+
+def _outputSink():
+    # as for _openOutput, only imported when writing to standard output
+    from utils import outputsink
+    return outputsink
+
+def _docIndex():
+    # likewise only imported when indexing output
+    from utils import docindex
+    return docindex
+
+def _corpusStats():
+    # as for _openOutput, only imported when collecting statistics
+    from utils import corpusstats
+    return corpusstats
+
+def _profiling():
+    # likewise only imported when profiling
+    from utils import profiling
+    return profiling
+
+def _startProfile(profiles, stage, worker_id=0):
+    if not profiles is None: _profiling().start(profiles, stage, worker_id)
+
+def _stopProfile(profiles):
+    if not profiles is None: _profiling().stop()
+
+def _batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0: yield batch
+
+def _extractWithSoup(infile, outhook):
     inhook = codecs.open(infile, 'r', 'utf-8')
-    outhook = codecs.open(outfile, 'w', 'utf-8')
+    n_pages = 0
     while True:
         next_page = parser.getNextPage(inhook, articles_only=True)
         if next_page is None: break
         outhook.write('%s\n' % str(next_page))
-        log.tick()
-    outhook.close()
+        n_pages += 1
+        log.tick(n_pages)
     inhook.close()
-    log.flushTracker()
+    return n_pages
+
+def _extractWithStream(infile, outhook, output_format, workers, batch_size=1000, stats=None, profiles=None,
+        doc_index=None):
+    n_pages = 0
+    with open(infile, 'rb') as inhook:
+        pages = parser.iterPages(inhook, articles_only=True)
+        if output_format != 'xml' and workers > 1:
+            # parse here, clean in the pool
+            texts = ((page.id, page.text) for page in pages)
+            if profiles is None:
+                pool = mp.Pool(workers)
+            else:
+                pool = mp.Pool(workers, initializer=_profiling().startPoolWorker, initargs=(profiles, 'cleaner'))
+            clean = functools.partial(_countAndClean, collect_stats=not stats is None, index=not doc_index is None,
+                output_format=output_format)
+            for (batch_pages, cleaned, batch_stats, entries) in pool.imap(clean, _batches(texts, batch_size)):
+                outhook.write(cleaned)
+                _indexEntries(doc_index, entries)
+                if not batch_stats is None: stats.update(batch_stats)
+                n_pages += batch_pages
+                log.tick(n_pages)
+            pool.close()
+            pool.join()
+        else:
+            for batch in _batches(pages, batch_size):
+                entries = []
+                outhook.write(formatPages(batch, output_format, stats=stats, entries=entries))
+                _indexEntries(doc_index, entries)
+                n_pages += len(batch)
+                log.tick(n_pages)
+        outhook.write(_formatFooter(output_format))
+    return n_pages
+
+def _countAndClean(batch, collect_stats=False, index=False, output_format='text'):
+    # batch is a list of (page id, text) pairs
+    stats = _corpusStats().CorpusStats() if collect_stats else None
+    entries = [] if index else None
+    ids, texts = [page_id for (page_id, _) in batch], [text for (_, text) in batch]
+    cleaned = _cleanTexts(texts, stats=stats, ids=ids, entries=entries, output_format=output_format)
+    return len(texts), cleaned, stats, entries
+
+def _cleanArticles(texts):
+    cleaned = [wikifil.cleanArticleText(text) for text in texts]
+    return [c for c in cleaned if not c is None]
+
+def extractAllArticles(infile, outfile, engine='stream', output_format='xml', workers=1, stats=False,
+        profiles=None, index=False):
+    '''Writes the article pages in Wikipedia dump infile to outfile.
+
+    engine        :: 'stream' for the incremental parser (default), or 'soup'
+                     for the line-by-line BeautifulSoup parser
+    output_format :: 'xml' (default) or 'text' (see formatPages), or 'ids'
+                     to write the cleaned text as a token-ID corpus (see
+                     utils.tokenids); 'text' and 'ids' require the stream
+                     engine
+    workers       :: number of processes to clean article text with, when
+                     output_format is 'text' or 'ids'
+    stats         :: if True, collect statistics on the cleaned articles as
+                     they are written, into outfile.stats.json and
+                     outfile.stats.tsv (see utils.corpusstats); requires
+                     'text' or 'ids' output
+    profiles      :: utils.profiling.ProcessProfiles; if given, parsing and
+                     writing (stage "parser") and the processes cleaning
+                     text (stage "cleaner") are profiled
+    index         :: if True, save the byte offset, length and page id of
+                     each article in outfile.docidx, for random access with
+                     utils.docindex; requires the stream engine, and 'xml'
+                     or 'text' output to a file
+    '''
+    if not engine in ENGINES:
+        raise ValueError('Unknown extraction engine "%s"' % engine)
+    if not output_format in FORMATS:
+        raise ValueError('Unknown output format "%s"' % output_format)
+    if engine == 'soup' and output_format != 'xml':
+        raise ValueError('The soup engine only supports XML output')
+    if stats and output_format == 'xml':
+        raise ValueError('Statistics are only collected for text or ids output')
+    if index and (engine == 'soup' or output_format == 'ids' or outfile == '-'):
+        raise ValueError('Only xml or text output to a file from the stream engine can be indexed')
+    all_stats = _corpusStats().CorpusStats() if stats else None
+    if not profiles is None:
+        profiles.clear()
+    _startProfile(profiles, 'parser')
+    log.track(message='  >> Extracted {1:,} articles...', writeInterval=5)
+    outhook = _openOutput(outfile, output_format)
+    doc_index = _openIndex(outfile, output_format) if index else None
+    if engine == 'stream':
+        n_pages = _extractWithStream(infile, outhook, output_format, workers, stats=all_stats,
+            profiles=profiles, doc_index=doc_index)
+    else:
+        n_pages = _extractWithSoup(infile, outhook)
+    outhook.close()
+    if not doc_index is None: doc_index.close()
+    log.flushTracker(n_pages)
+    _stopProfile(profiles)
+    if stats:
+        all_stats.writeReport(outfile)
+    if not profiles is None:
+        _profiling().merge(profiles)
+
+def readStreamOffsets(dumpfile, indexfile, streams_per_task=1):
+    '''Reads the stream offset index for a multistream .bz2 dump, and returns
+    a list of (start, length) byte ranges, each covering streams_per_task
+    consecutive bz2 streams.
+
+    Index lines are formatted as offset:page_id:title; the index may itself
+    be bz2-compressed.
+    '''
+    opener = bz2.open if indexfile.endswith('.bz2') else open
+    offsets = []
+    with opener(indexfile, 'rb') as stream:
+        for line in stream:
+            offset = int(line.split(b':', 1)[0])
+            if len(offsets) == 0 or offset != offsets[-1]:
+                offsets.append(offset)
+    offsets.sort()
+    # the final range extends to EOF, to pick up the closing </mediawiki> stream
+    offsets = offsets[::streams_per_task] + [os.path.getsize(dumpfile)]
+    return [
+        (offsets[i], offsets[i+1] - offsets[i])
+            for i in range(len(offsets) - 1)
+    ]
+
+def _pagesInStreams(dumpf, start, length):
+    dumpf.seek(start)
+    data = bz2.decompress(dumpf.read(length))
+    # each stream holds a run of <page> elements with no enclosing root
+    # (the first and last streams also hold the <mediawiki> header/footer)
+    first, last = data.find(b'<page>'), data.rfind(b'</page>')
+    if first < 0 or last < 0: return []
+    chunks = [b'<pages>', data[first:last+len(b'</page>')], b'</pages>']
+    return list(parser.iterPagesFromChunks(chunks, articles_only=True))
+
+def _t_extractStreams(dumpfile, task_q, result_q, shard_file, output_format, stats_outf=None, worker_id=0,
+        profiles=None, index=False):
+    # always send HALT, and send back any exception, so the main process
+    # never waits on a failed worker
+    try:
+        _startProfile(profiles, 'extractor', worker_id)
+        shard = None if shard_file is None else _openOutput(shard_file, output_format)
+        stats = None if stats_outf is None else _corpusStats().CorpusStats()
+        with open(dumpfile, 'rb') as dumpf:
+            task = task_q.get()
+            while task != _SIGNALS.HALT:
+                (task_ix, start, length) = task
+                pages = _pagesInStreams(dumpf, start, length)
+                entries = [] if index else None
+                if output_format == _PAGES:
+                    text = pages
+                elif output_format == _CLEANED:
+                    text = _cleanArticles([page.text for page in pages])
+                else:
+                    text = formatPages(pages, output_format, stats=stats, entries=entries)
+                if shard is None:
+                    result_q.put((task_ix, len(pages), text, entries))
+                else:
+                    shard.write(text)
+                    result_q.put((task_ix, len(pages), None, None))
+                task = task_q.get()
+        if not shard is None:
+            shard.write(_formatFooter(output_format))
+            shard.close()
+        if not stats is None:
+            stats.save(_corpusStats().partialPath(stats_outf, worker_id))
+        _stopProfile(profiles)
+    except Exception:
+        result_q.put(_WorkerError(worker_id, traceback.format_exc()))
+    finally:
+        result_q.put(_SIGNALS.HALT)
+
+def _getResult(result_q, processes):
+    '''Returns the next result from the multistream workers, raising
+    RuntimeError if a worker failed or died without finishing.
+    '''
+    while True:
+        try:
+            result = result_q.get(timeout=_RESULT_TIMEOUT)
+            break
+        except queue.Empty:
+            # workers that finish cleanly send HALT first, so exit code 0 is fine
+            for (worker_id, p) in enumerate(processes):
+                if not p.exitcode in (None, 0):
+                    raise RuntimeError('Multistream worker %d died (exit code %d)' % (worker_id, p.exitcode))
+    if isinstance(result, _WorkerError):
+        raise RuntimeError('Multistream worker %d failed:\n%s' % (result.worker_id, result.details))
+    return result
+
+def _terminateWorkers(task_q, processes):
+    for p in processes:
+        p.terminate()
+    task_q.cancel_join_thread()
+
+def _startStreamWorkers(dumpfile, ranges, workers, output_format, shard_files=None, stats_outf=None,
+        profiles=None, index=False):
+    task_q, result_q = mp.Queue(), mp.Queue(maxsize=workers*4)
+    if shard_files is None:
+        shard_files = [None for _ in range(workers)]
+    processes = [
+        mp.Process(target=_t_extractStreams, args=(dumpfile, task_q, result_q, shard_files[i], output_format,
+            stats_outf, i, profiles, index))
+            for i in range(workers)
+    ]
+    for (task_ix, (start, length)) in enumerate(ranges):
+        task_q.put((task_ix, start, length))
+    for _ in processes:
+        task_q.put(_SIGNALS.HALT)
+    for p in processes:
+        p.start()
+    return task_q, result_q, processes
+
+def extractFromMultistream(dumpfile, indexfile, outfile, workers=4, streams_per_task=10, sharded=False, output_format='xml',
+        stats=False, profiles=None, index=False):
+    '''Writes the article pages in a multistream .bz2 Wikipedia dump to
+    outfile, decompressing and parsing independent bz2 streams in parallel
+    worker processes.
+
+    If sharded is True, each worker writes its own shard (outfile.000,
+    outfile.001, ...); otherwise, articles are written to outfile in dump
+    order.  See formatPages for output_format; token-ID shards each have their
+    own vocabulary, and can be merged with utils.tokenids.mergeCorpora.
+    If stats is True, each worker collects statistics on the articles it
+    cleans (see extractAllArticles), merged once all are done.  If profiles
+    (a utils.profiling.ProcessProfiles) is given, the workers (stage
+    "extractor") and the main process writing their output (stage "writer")
+    are profiled.  If index is True, unsharded xml or text output is
+    indexed as in extractAllArticles.
+    '''
+    if not output_format in FORMATS:
+        raise ValueError('Unknown output format "%s"' % output_format)
+    if stats and output_format == 'xml':
+        raise ValueError('Statistics are only collected for text or ids output')
+    if index and (sharded or output_format == 'ids' or outfile == '-'):
+        raise ValueError('Only unsharded xml or text output to a file can be indexed')
+    if stats:
+        _corpusStats().clearPartials(outfile)
+    if not profiles is None:
+        profiles.clear()
+    ranges = readStreamOffsets(dumpfile, indexfile, streams_per_task=streams_per_task)
+    log.writeln('Extracting articles from %d stream groups with %d workers' % (len(ranges), workers))
+
+    if sharded:
+        shard_files = ['%s.%03d' % (outfile, i) for i in range(workers)]
+    else:
+        shard_files = [None for _ in range(workers)]
+    (task_q, result_q, processes) = _startStreamWorkers(dumpfile, ranges, workers, output_format, shard_files,
+        outfile if stats else None, profiles, index)
+
+    _startProfile(profiles, 'writer')
+    log.track(message='  >> Extracted {1:,} articles ({2:,}/%d stream groups)' % len(ranges), writeInterval=10)
+    outhook = None if sharded else _openOutput(outfile, output_format)
+    doc_index = _openIndex(outfile, output_format) if index else None
+    n_pages, n_tasks, halts_seen = 0, 0, 0
+    pending, next_ix = {}, 0
+    try:
+        while halts_seen < workers:
+            result = _getResult(result_q, processes)
+            if result == _SIGNALS.HALT:
+                halts_seen += 1
+                continue
+            (task_ix, task_pages, text, entries) = result
+            n_pages += task_pages
+            n_tasks += 1
+            # restore dump order before writing
+            if not outhook is None:
+                pending[task_ix] = (text, entries)
+                while next_ix in pending:
+                    (text, entries) = pending.pop(next_ix)
+                    outhook.write(text)
+                    _indexEntries(doc_index, entries)
+                    next_ix += 1
+            log.tick(n_pages, n_tasks)
+    except BaseException:
+        _terminateWorkers(task_q, processes)
+        for p in processes:
+            p.join()
+        raise
+    log.flushTracker(n_pages, n_tasks)
+    if not outhook is None:
+        outhook.write(_formatFooter(output_format))
+        outhook.close()
+    if not doc_index is None: doc_index.close()
+    _stopProfile(profiles)
+
+    for p in processes:
+        p.join()
+    if stats:
+        _corpusStats().mergePartials(outfile)
+    if not profiles is None:
+        _profiling().merge(profiles)
+
+def iterArticles(infile, indexfile=None, workers=4, streams_per_task=10, clean=False, batch_size=1000):
+    '''Yields the article pages in Wikipedia dump infile, in dump order,
+    as parser.Page records, or, if clean is True, as their article text
+    cleaned as wikifil.pl would (skipping articles with no text left).
+
+    If indexfile is given, infile is a multistream .bz2 dump, whose streams
+    are decompressed and parsed (and cleaned) in workers processes, as in
+    extractFromMultistream.  Otherwise, infile is parsed here with the
+    stream engine, and batches of batch_size articles are cleaned in a pool
+    of workers processes.
+
+    If the caller stops iterating early, the worker processes are
+    terminated.
+    '''
+    if indexfile is None:
+        with open(infile, 'rb') as inhook:
+            pages = parser.iterPages(inhook, articles_only=True)
+            if not clean:
+                for page in pages:
+                    yield page
+            elif workers <= 1:
+                for batch in _batches(pages, batch_size):
+                    for text in _cleanArticles([page.text for page in batch]):
+                        yield text
+            else:
+                pool = mp.Pool(workers)
+                try:
+                    texts = (page.text for page in pages)
+                    for cleaned in pool.imap(_cleanArticles, _batches(texts, batch_size)):
+                        for text in cleaned:
+                            yield text
+                finally:
+                    pool.terminate()
+                    pool.join()
+        return
+
+    ranges = readStreamOffsets(infile, indexfile, streams_per_task=streams_per_task)
+    (task_q, result_q, processes) = _startStreamWorkers(infile, ranges, workers, _CLEANED if clean else _PAGES)
+    halts_seen, pending, next_ix = 0, {}, 0
+    try:
+        while halts_seen < workers:
+            result = _getResult(result_q, processes)
+            if result == _SIGNALS.HALT:
+                halts_seen += 1
+                continue
+            (task_ix, _, items, _) = result
+            # restore dump order
+            pending[task_ix] = items
+            while next_ix in pending:
+                for item in pending.pop(next_ix):
+                    yield item
+                next_ix += 1
+    finally:
+        if halts_seen < workers:
+            _terminateWorkers(task_q, processes)
+        for p in processes:
+            p.join()
 
 if __name__=='__main__':
     def _cli():
         import optparse
         parser = optparse.OptionParser(usage='Usage: %prog INFILE OUTFILE',
-                description='Extracts article-only subset of Wikipedia dump in INFILE and saves to OUTFILE')
+                description='Extracts article-only subset of Wikipedia dump in INFILE and saves to OUTFILE'
+                            ' (- for standard output; logging then goes to standard error).'
+                            ' If --index is given, INFILE is a multistream .bz2 dump, which is'
+                            ' processed in parallel.')
+        parser.add_option('--engine', dest='engine',
+                type='choice', choices=ENGINES, default='stream',
+                help='XML parsing engine to use: "stream" (incremental parser) or'
+                     ' "soup" (line-by-line BeautifulSoup; slow) (default: %default)')
+        parser.add_option('--format', dest='output_format',
+                type='choice', choices=FORMATS, default='xml',
+                help='output format: "xml" to write article pages as XML, "text" to'
+                     ' write cleaned article text (equivalent to running wikifil.pl over'
+                     ' the XML output), or "ids" to write the cleaned text as a token-ID'
+                     ' corpus (OUTFILE.vocab, OUTFILE.ids, ...; see utils/tokenids.py)'
+                     ' (default: %default)')
+        parser.add_option('--index', dest='index',
+                help='stream offset index for a multistream .bz2 dump in INFILE'
+                     ' (e.g., enwiki-latest-pages-articles-multistream-index.txt.bz2)',
+                default=None)
+        parser.add_option('--workers', dest='workers',
+                type='int', default=4,
+                help='number of worker processes for multistream extraction, or for'
+                     ' cleaning text with --format=text or ids (default: %default)')
+        parser.add_option('--streams-per-task', dest='streams_per_task',
+                type='int', default=10,
+                help='number of bz2 streams handed to a worker at a time (default: %default)')
+        parser.add_option('--shard', dest='sharded',
+                action='store_true', default=False,
+                help='write one output shard per worker (OUTFILE.000, OUTFILE.001, ...)'
+                     ' instead of a single ordered OUTFILE')
+        parser.add_option('--stats', dest='stats',
+                action='store_true', default=False,
+                help='with --format=text or ids, collect corpus statistics as articles are'
+                     ' cleaned, and write them to OUTFILE.stats.json and OUTFILE.stats.tsv'
+                     ' (see utils/corpusstats.py)')
+        parser.add_option('--doc-index', dest='doc_index',
+                action='store_true', default=False,
+                help='with --format=xml or text, save the byte offset, length and page id of'
+                     ' each article in OUTFILE.docidx, for random access with'
+                     ' utils/docindex.py (not used with --shard or --engine=soup)')
+        parser.add_option('--profile', dest='profile',
+                help='profile the main process and each worker process with cProfile,'
+                     ' and merge the profiles of each stage into PROFILE.STAGE.prof,'
+                     ' with the top functions of each stage listed in PROFILE.txt'
+                     ' (see utils/profiling.py)')
         (options, args) = parser.parse_args()
         if len(args) != 2:
             parser.print_help()
             exit()
         (infile, outfile) = args
-        return infile, outfile
+        if outfile == '-' and (options.sharded or options.stats or options.doc_index or options.output_format == 'ids'):
+            parser.error('--shard, --stats, --doc-index and --format=ids need an output file')
+        if options.doc_index and (options.sharded or options.output_format == 'ids'
+                or (options.engine == 'soup' and not options.index)):
+            parser.error('--doc-index needs unsharded xml or text output from the stream engine')
+        return infile, outfile, options
 
-    infile, outfile = _cli()
+    infile, outfile, options = _cli()
+    if outfile == '-':
+        _outputSink().claimStdout()
+    profiles = None
+    if options.profile:
+        profiles = _profiling().ProcessProfiles(options.profile)
 
     t_main = log.startTimer('Extracting article-only subset of Wikipedia dump %s' % infile)
-    extractAllArticles(infile, outfile)
+    if options.index:
+        extractFromMultistream(infile, options.index, outfile,
+            workers=options.workers, streams_per_task=options.streams_per_task,
+            sharded=options.sharded, output_format=options.output_format,
+            stats=options.stats, profiles=profiles, index=options.doc_index)
+    else:
+        extractAllArticles(infile, outfile, engine=options.engine,
+            output_format=options.output_format, workers=options.workers,
+            stats=options.stats, profiles=profiles, index=options.doc_index)
     log.stopTimer(t_main, message='Wrote subset to %s.\nProcessing time: {0:.2f}s')
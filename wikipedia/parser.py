@@ -4,9 +4,15 @@ Parser for Wikipedia XML dumps
 @uses Python >= 3.5
 '''
 
+import collections
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
 from bs4 import BeautifulSoup
 
 _ARTICLE_NAMESPACE_ID = 0
+_READ_CHUNK_SIZE = 1024 * 1024
+
+Page = collections.namedtuple('Page', ['id', 'ns', 'title', 'redirect', 'text'])
 
 def getNextPage(hook, articles_only=True):
     keep_looking, next_page = True, None
@@ -46,3 +52,82 @@ def getNextPage(hook, articles_only=True):
             keep_looking = False
 
     return next_page
+
+def _localName(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def _pageFromElement(elem):
+    page_id, ns, title, redirect, text = None, -1, '', False, ''
+    for child in elem:
+        tag = _localName(child.tag)
+        if tag == 'id':
+            page_id = int(child.text)
+        elif tag == 'ns':
+            try:
+                ns = int(child.text)
+            except:
+                ns = -1
+        elif tag == 'title':
+            title = child.text or ''
+        elif tag == 'redirect':
+            redirect = True
+        elif tag == 'revision':
+            for rev_child in child:
+                if _localName(rev_child.tag) == 'text':
+                    text = rev_child.text or ''
+    return Page(id=page_id, ns=ns, title=title, redirect=redirect, text=text)
+
+def iterPagesFromChunks(chunks, articles_only=True):
+    '''Yields Page records from an iterable of XML byte (or str) chunks.
+
+    Chunks are fed to an incremental parser, and each <page> element is
+    discarded as soon as its record has been built, so memory use is bounded
+    by the size of the largest single page.
+    '''
+    xml_parser = ET.XMLPullParser(events=('start', 'end'))
+    root = None
+    for chunk in chunks:
+        xml_parser.feed(chunk)
+        for (event, elem) in xml_parser.read_events():
+            if event == 'start':
+                if root is None: root = elem
+            elif _localName(elem.tag) == 'page':
+                page = _pageFromElement(elem)
+                # drop the finished page (and anything before it) from the tree
+                root.clear()
+                if (not articles_only) or page.ns == _ARTICLE_NAMESPACE_ID:
+                    yield page
+    xml_parser.close()
+
+def iterPages(hook, articles_only=True, chunk_size=_READ_CHUNK_SIZE):
+    '''Streams Page records (id, ns, title, redirect, text) from an open
+    Wikipedia XML dump, in constant memory.
+
+    Preferably, hook should be opened in binary mode.
+    '''
+    def _chunks():
+        while True:
+            chunk = hook.read(chunk_size)
+            if len(chunk) == 0: break
+            yield chunk
+    return iterPagesFromChunks(_chunks(), articles_only=articles_only)
+
+def pageToXML(page):
+    '''Returns a minimal <page> XML serialization of a Page record, in the
+    same shape as the original dump (readable by wikifil.pl).
+    '''
+    lines = [
+        '<page>',
+        '    <title>%s</title>' % escape(page.title),
+        '    <ns>%d</ns>' % page.ns,
+        '    <id>%s</id>' % ('' if page.id is None else page.id),
+    ]
+    if page.redirect:
+        lines.append('    <redirect />')
+    lines.extend([
+        '    <revision>',
+        '      <text xml:space="preserve">%s</text>' % escape(page.text),
+        '    </revision>',
+        '</page>'
+    ])
+    return '\n'.join(lines)
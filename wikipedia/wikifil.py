@@ -0,0 +1,77 @@
+'''
+In-process port of wikifil.pl, for cleaning Wikipedia article text
+without writing the articles out as XML first.
+
+Output matches wikifil.pl run over the XML written by
+extract_articles (see the parity target in the makefile).
+'''
+
+import re
+
+_REDIRECT = re.compile(r'#redirect', re.I | re.A)
+_REFERENCE = re.compile(r'<ref[^<]*</ref>')
+_XHTML_TAG = re.compile(r'<[^>]*>')
+_URL = re.compile(r'\[http:[^\] ]*')
+_THUMB = re.compile(r'\|thumb', re.I | re.A)
+_LEFT = re.compile(r'\|left', re.I | re.A)
+_RIGHT = re.compile(r'\|right', re.I | re.A)
+_PIXELS = re.compile(r'\|\d+px', re.I | re.A)
+_IMAGE = re.compile(r'\[\[image:[^\[\]]*\|', re.I | re.A)
+_CATEGORY = re.compile(r'\[\[category:([^|\]]*)[^\]]*\]\]', re.I | re.A)
+_INTERLANGUAGE = re.compile(r'\[\[[a-z\-]*:[^\]]*\]\]')
+_LINK_TARGET = re.compile(r'\[\[[^\|\]]*\|')
+_TEMPLATE = re.compile(r'{{[^}]*}}')
+_TABLE = re.compile(r'{[^}]*}')
+_ENTITY = re.compile(r'&[^;]*;')
+_NON_LETTERS = re.compile(r'[^a-z]+')
+
+_BRACKETS = str.maketrans('', '', '[]')
+_LOWER_AND_DIGITS = str.maketrans(dict(
+    [(chr(c), chr(c).lower()) for c in range(ord('A'), ord('Z')+1)] +
+    [
+        ('0', ' zero '),
+        ('1', ' one '),
+        ('2', ' two '),
+        ('3', ' three '),
+        ('4', ' four '),
+        ('5', ' five '),
+        ('6', ' six '),
+        ('7', ' seven '),
+        ('8', ' eight '),
+        ('9', ' nine '),
+    ]
+))
+
+def cleanArticleText(text):
+    '''Cleans the (unescaped) wikitext of one article to lowercase letters
+    and single spaces, as wikifil.pl does.
+
+    Returns None if wikifil.pl would skip the article (redirects); otherwise,
+    returns the string wikifil.pl prints after the article's leading newline.
+    '''
+    if _REDIRECT.search(text): return None
+
+    # wikifil.pl sees the text XML-escaped and decodes &amp;, &lt; and &gt;
+    # in that order, which leaves literal & and comes out the same as
+    # decoding only &lt; and &gt; in the unescaped text
+    text = text.replace('&lt;', '<').replace('&gt;', '>')
+    text = _REFERENCE.sub('', text)
+    text = _XHTML_TAG.sub('', text)
+    text = _URL.sub('[', text)
+    text = _THUMB.sub('', text)
+    text = _LEFT.sub('', text)
+    text = _RIGHT.sub('', text)
+    text = _PIXELS.sub('', text)
+    text = _IMAGE.sub('', text)
+    text = _CATEGORY.sub(r'[[\1]]', text)
+    text = _INTERLANGUAGE.sub('', text)
+    text = _LINK_TARGET.sub('[[', text)
+    text = _TEMPLATE.sub('', text)
+    text = _TABLE.sub('', text)
+    text = text.translate(_BRACKETS)
+    text = _ENTITY.sub(' ', text)
+
+    text = (' %s ' % text).translate(_LOWER_AND_DIGITS)
+    text = _NON_LETTERS.sub(' ', text)
+    # wikifil.pl chops the trailing space
+    return text[:-1]